@@ -1,12 +1,111 @@
-import re
 import pandas as pd
 import numpy as np
+import VariantEncoding as ve
+import VariantData as vd
+import VariantProfile as vpr
+
+
+# Prevalence and growth rates of every row over a window of months, as 2-D float arrays (rows x months) with the most
+# recent month first.  The interval is either the number of most recent months or a (first month, last month) pair
+# such as ('2023-01', '2023-06'), and every function below that takes an interval accepts both (see
+# VariantData.ReportSchema.window()).  Frames compacted with VariantData.compact_frame() give float32 arrays, so
+# thresholds are compared at the precision the values are stored in and a prevalence of exactly 0.05 stays at the
+# threshold rather than rounding above it.
+def recent_metrics(variant_df, interval):
+	schema = vd.report_schema(variant_df.columns)
+	recent_prevalence = variant_df.iloc[:, schema.indexes('Prevalence', interval)]
+	recent_growth_rates = variant_df.iloc[:, schema.indexes('Growth Rate', interval)]
+	dtype = np.result_type(np.float32, *recent_prevalence.dtypes, *recent_growth_rates.dtypes)
+	return(recent_prevalence.to_numpy(dtype = dtype), recent_growth_rates.to_numpy(dtype = dtype))
+
+# Integer code of every value of an entity column (covariant, lineage or mutation), with the entities in sorted order
+# as a groupby would list them.  Missing values get the code -1 and are left out of every count.
+def entity_codes(values):
+	codes, uniques = pd.factorize(values)
+	uniques = np.asarray(uniques, dtype = object)
+	order = np.argsort(uniques, kind = 'stable')
+	rank = np.empty(len(order) + 1, dtype = np.int64)
+	rank[order] = np.arange(len(order))
+	rank[-1] = -1
+	return(rank[codes], uniques[order])
+
+# Month labels of a window of months, e.g. ['2023-06', '2023-05', ...], in the order of recent_metrics()
+def recent_months(variant_df, interval):
+	return(vd.report_schema(variant_df.columns).month_labels(interval))
+
+# Variant Counts of every row in the most recent month of a window of months (by default of the whole sheet)
+def latest_counts(variant_df, interval = None):
+	return(variant_df[vd.metric_columns(variant_df, 'Variant Count', interval)[0]])
+
+# Mark a month as significant when its growth rate is above growth_threshold or its prevalence above
+# prevalence_threshold (None to only test growth).  With dropna, months missing either value are never significant.
+# Works elementwise, on rows x months arrays or on any selection of cells.
+def significant_months(prevalence, growth, growth_threshold = 5, prevalence_threshold = 0.05, dropna = True):
+	with np.errstate(invalid = 'ignore'):
+		significant = (growth > growth_threshold)
+		if (prevalence_threshold is not None):
+			significant |= (prevalence > prevalence_threshold)
+	if (dropna):
+		significant &= ~np.isnan(growth) & ~np.isnan(prevalence)
+	return(significant)
+
+# Significance kernel shared by the ranking functions.  Takes the entity code of every row and the prevalence and
+# growth rates of every row over the months of interest (rows x months), and marks the significant months with
+# significant_months(), unless a precomputed mask of them is passed in, together with the counts when they are known
+# (see VariantState.RankingState.significance()).  Returns the significance mask, the number of significant months of
+# every entity and the median prevalence of every entity over its significant months (NaN for entities without any),
+# without building any intermediate frames.
+@vpr.profiled
+def significance_counts(codes, n_entities, prevalence, growth, growth_threshold = 5, prevalence_threshold = 0.05, dropna = True, significant = None, counts = None):
+	if (significant is None):
+		significant = significant_months(prevalence, growth, growth_threshold, prevalence_threshold, dropna)
+	significant = significant & (codes >= 0)[:, None]
+	rows, months = np.nonzero(significant)
+	entity = codes[rows]
+	if (counts is None):
+		counts = np.bincount(entity, minlength = n_entities)
+	medians = grouped_median(entity, prevalence[rows, months], counts)
+	return(significant, counts, medians)
+
+# Median of values within each group, given the group code of every value and the group sizes from a bincount
+def grouped_median(codes, values, counts):
+	order = np.lexsort((values, codes))
+	values = values[order]
+	starts = np.cumsum(counts) - counts
+	lower = starts + (counts - 1) // 2
+	upper = starts + counts // 2
+	medians = np.full(len(counts), np.nan)
+	present = counts > 0
+	medians[present] = (values[lower[present]].astype(float) + values[upper[present]]) / 2
+	return(medians)
+
+# Rows with at least one significant month, ordered by the first month in which they are significant and then by
+# row, which is the order a month by month scan over the rows meets them in
+def significant_rows(significant):
+	months, rows = np.nonzero(significant.T)
+	return(pd.unique(rows))
 
 
 # Compute the Sequence Prevalence Score for single amino acid substitution either within a specific domain,
 # the entire spike protein, or for a user inputted list.  When ranking substitutions within a user inputted list,
 # the algorithm will simply rank the substitutions and not consider the domain.
-def mutation_ranking(variant_df, interval, domain, mutations = []):
+@vpr.profiled
+def mutation_ranking(variant_df, interval, domain, mutations = [], state = None):
+	variant_df = domain_mutations(variant_df, domain, mutations)
+	variant_df = variant_df[latest_counts(variant_df, interval) > 10]
+	recent_prevalence, recent_growth_rates = recent_metrics(variant_df, interval)
+	codes, mutations = entity_codes(variant_df['Variant'])
+	significant, counts = state.significance(variant_df, recent_months(variant_df, interval), recent_prevalence, recent_growth_rates, codes, mutations) if (state) else (None, None)
+	significant, counts, medians = significance_counts(codes, len(mutations), recent_prevalence, recent_growth_rates, significant = significant, counts = counts)
+	scored = counts > 0
+	mutation_ranking = pd.DataFrame({'Variant': mutations[scored], 'Mutation Prevalence Score': counts[scored]}).sort_values(by = 'Mutation Prevalence Score', ascending = False)
+	prevalence_median = pd.DataFrame({'Variant': mutations[scored], 'Prevalence Median': medians[scored]})
+	mutation_ranking = mutation_ranking.merge(prevalence_median, on = "Variant")
+	mutation_ranking = mutation_ranking.sort_values(by = ['Mutation Prevalence Score','Prevalence Median'], ascending = [False, False]).drop_duplicates().reset_index(drop = True)
+	return(mutation_ranking)
+
+# Substitutions within a domain of the spike (NTD, RBD, Other or the whole Spike), or within a user inputted list
+def domain_mutations(variant_df, domain, mutations = []):
 	if (mutations):
 		variant_df = variant_df[(variant_df['Variant'].isin(mutations))]
 	elif (domain == "NTD"):
@@ -14,35 +113,75 @@ def mutation_ranking(variant_df, interval, domain, mutations = []):
 	elif (domain == "RBD"):
 		variant_df = variant_df[(variant_df['Position'] >= 319) & (variant_df['Position'] <= 541)]
 	elif (domain == "Other"):
-		variant_df = variant_df[(variant_df['Position'] >= 542) & (variant_df['Position'] <= 1273)]	
-
-	variant_df = variant_df[variant_df[variant_df[variant_df.columns[pd.Series(variant_df.columns).str.startswith('Variant Count')]].iloc[:,0].name] > 10]
-	recent_prevalence = variant_df[variant_df.columns[pd.Series(variant_df.columns).str.startswith('Prevalence')]].iloc[:,:interval]
-	recent_growth_rates = variant_df[variant_df.columns[pd.Series(variant_df.columns).str.startswith('Growth Rate')]].iloc[:,:interval]
-	mut_growth_data = []
-	mut_prevalence_data = []
-	for i in range(interval):
-		growth_data = pd.DataFrame({'Variant': variant_df['Variant'], 'Growth Rate': recent_growth_rates[recent_growth_rates.iloc[:,i].name]})
-		prevalence_data = pd.DataFrame({'Variant': variant_df['Variant'], 'Prevalence': recent_prevalence[recent_prevalence.iloc[:,i].name]})
-		mut_growth_data.append(growth_data)
-		mut_prevalence_data.append(prevalence_data)
-	mut_growth_data = pd.concat(mut_growth_data, ignore_index = True)
-	mut_prevalence_data = pd.concat(mut_prevalence_data, ignore_index = True)
-	mut_data = pd.DataFrame(data = {'Variant': mut_growth_data['Variant'], 'Growth Rate': mut_growth_data['Growth Rate'], 'Prevalence': mut_prevalence_data['Prevalence']})
-	mut_data = mut_data.dropna()
-	significant_mutants = mut_data[(mut_data['Growth Rate'] > 5) | (mut_data['Prevalence'] > 0.05)]
-	mutation_ranking = significant_mutants.groupby('Variant').size().reset_index(name = 'Mutation Prevalence Score').sort_values(by = 'Mutation Prevalence Score', ascending = False)
-	prevalence_median = significant_mutants.groupby(['Variant'])['Prevalence'].median().reset_index(name = 'Prevalence Median')
-	mutation_ranking = mutation_ranking.merge(prevalence_median, on = "Variant")
-	mutation_ranking = mutation_ranking.sort_values(by = ['Mutation Prevalence Score','Prevalence Median'], ascending = [False, False]).drop_duplicates().reset_index(drop = True)
-	return(mutation_ranking)
+		variant_df = variant_df[(variant_df['Position'] >= 542) & (variant_df['Position'] <= 1273)]
+	return(variant_df)
+
+# Isolates Count of every location in every month (locations x months, most recent first): the number of sequences of
+# the location in the month, which every row of the location shares, so it is read off the rows rather than summed
+def location_isolates(isolates, locations, n_locations):
+	return(pd.DataFrame(isolates).groupby(locations).max().reindex(range(n_locations)).to_numpy(dtype = float))
+
+# Metric columns for summed Variant Counts (rows x months, most recent first, as metric_grids() gives them) and the
+# Isolates Count of every row, named after the columns of schema.  Prevalence and growth rates are recomputed the way
+# the report computes them (Variant Count over Isolates Count, and Variant Count over the Variant Count of the month
+# before), with months without any count left blank.
+def summed_metrics(schema, summed, isolates):
+	summed[summed == 0] = np.nan
+	with np.errstate(divide = 'ignore', invalid = 'ignore'):
+		prevalence = summed / isolates
+		growth = np.full(summed.shape, np.nan)
+		growth[:, :-1] = summed[:, :-1] / summed[:, 1:]
+	metrics = {'Variant Count': summed, 'Isolates Count': isolates, 'Prevalence': prevalence, 'Growth Rate': growth}
+	columns = {}
+	for month, label in enumerate(schema.month_labels()):
+		for metric, values in metrics.items():
+			position = schema.positions[metric][month]
+			columns[schema.columns[position] if (position >= 0) else metric+' - '+label] = values[:, month]
+	return(columns)
+
+# Point mutation rows derived from covariant rows, in the layout of the 'AA Mutations' sheet: for every location and
+# every mutation of its covariants, the Variant Counts of all rows carrying the mutation summed month by month, with
+# prevalence and growth recomputed from them (see summed_metrics()).  Works for any subset of a variants sheet, such as
+# the rows of one WHO Label or PANGO Lineage, or of a covariants file, and for reports without the 'AA Mutations' sheet.
+# The rows and their mutations form a sparse incidence matrix, held as its (row, mutation) pairs from the covariant
+# store, and the sums are its product with the monthly counts, taken one month at a time with bincount.
+@vpr.profiled
+def covariant_mutations(variant_df, location_column = 'Country', store = ve.covariant_store):
+	schema = vd.report_schema(variant_df.columns)
+	locations, location_names = pd.factorize(variant_df[location_column])
+	ids = store.encode(variant_df['Variant'])
+	kept = (locations >= 0) & (ids >= 0)
+	locations, ids = locations[kept], ids[kept]
+	counts, isolates = metric_grids(variant_df[kept], ['Variant Count', 'Isolates Count'])
+	counts = np.nan_to_num(counts.astype(float))
+
+	owner, mutation_ids, positions, residues = store.gather(ids)
+	vocabulary = np.flatnonzero(np.bincount(mutation_ids, minlength = len(store.mutations)))
+	lookup = np.zeros(len(store.mutations), dtype = np.int64)
+	lookup[vocabulary] = np.arange(len(vocabulary))
+	keys = locations[owner] * np.int64(len(vocabulary)) + lookup[mutation_ids]
+	present = np.bincount(keys, minlength = len(location_names) * len(vocabulary)) > 0
+	pairs = np.flatnonzero(present)
+	inverse = (np.cumsum(present) - 1)[keys]
+	summed = np.empty((len(pairs), counts.shape[1]), order = 'F')
+	for month in range(counts.shape[1]):
+		summed[:, month] = np.bincount(inverse, weights = counts[owner, month], minlength = len(pairs))
+	pair_locations, pair_mutations = pairs // len(vocabulary), vocabulary[pairs % len(vocabulary)]
+	all_positions = store.flat()[0]
+	order = np.lexsort((pair_mutations, all_positions[pair_mutations], pair_locations))
+	pair_locations, pair_mutations, summed = pair_locations[order], pair_mutations[order], summed[order]
+
+	columns = {location_column: np.asarray(location_names, dtype = object)[pair_locations], 'Variant': np.array(store.mutations, dtype = object)[pair_mutations], 'Position': all_positions[pair_mutations].astype(np.int64)}
+	columns.update(summed_metrics(schema, summed, location_isolates(isolates, locations, len(location_names))[pair_locations]))
+	return(pd.DataFrame(columns))
 
 # Compute the Composite Score by summing the Substitution Ranking score with the Functional Ranking score and then
 # ranking the results to get the 'Overall Spike Rank'.  This is then then a combined score for interpreting
 # the overall threat level of an emerging variant.
-def composite_ranking(variant_df, sfoc_df, interval, who = [], lineage = [], covariants = []):
-	sequence_prevalence_score = sequence_ranking(variant_df, interval, who, lineage, covariants)
-	functional_impact_score = functional_ranking(variant_df = pd.DataFrame({'Variant': sequence_prevalence_score['Variant']}), sfoc_df = sfoc_df, covariants = list(sequence_prevalence_score['Variant']))
+@vpr.profiled
+def composite_ranking(variant_df, sfoc_df, interval, who = [], lineage = [], covariants = [], protein = 'Spike', state = None, memo = None):
+	sequence_prevalence_score = sequence_ranking(variant_df, interval, who, lineage, covariants, state = state)
+	functional_impact_score = functional_ranking(variant_df = pd.DataFrame({'Variant': sequence_prevalence_score['Variant']}), sfoc_df = sfoc_df, covariants = list(sequence_prevalence_score['Variant']), protein = protein, memo = state or memo)
 	composite_score = pd.merge(sequence_prevalence_score, functional_impact_score, on = "Variant")
 	composite_score['Composite Score'] = composite_score['Sequence Prevalence Score'] + composite_score['Functional Impact Score']
 	overall_spike_rank = composite_score.sort_values(by = ['Composite Score', 'Prevalence Median'], ascending = [False, False]).drop_duplicates().reset_index(drop=True)
@@ -53,7 +192,8 @@ def composite_ranking(variant_df, sfoc_df, interval, who = [], lineage = [], cov
 # Richard's early detection presintation.  This basically ranks spike covariants by considering the
 # sequence prevalence dynamics, growth rates, and geographic spread by region.  This algorithm essentially 
 # ranks individual covariants based on their epedimological dynamics or lineage expansions.
-def sequence_ranking(variant_df, interval, who = [], lineage = [], covariants = []):
+@vpr.profiled
+def sequence_ranking(variant_df, interval, who = [], lineage = [], covariants = [], state = None):
 	all_data = True
 	if (who):
 		variant_df = variant_df[(variant_df['WHO Label'].isin(who))]
@@ -64,25 +204,15 @@ def sequence_ranking(variant_df, interval, who = [], lineage = [], covariants =
 	if (covariants):
 		variant_df = variant_df[(variant_df['Variant'].isin(covariants))]
 		all_data = False	
-	variant_df = variant_df[variant_df[variant_df[variant_df.columns[pd.Series(variant_df.columns).str.startswith('Variant Count')]].iloc[:,0].name] > 10]
-	recent_prevalence = variant_df[variant_df.columns[pd.Series(variant_df.columns).str.startswith('Prevalence')]].iloc[:,:interval]
-	recent_growth_rates = variant_df[variant_df.columns[pd.Series(variant_df.columns).str.startswith('Growth Rate')]].iloc[:,:interval]
-	variant_growth_data = []
-	variant_prevalence_data = []
-	for i in range(interval):
-		growth_data = pd.DataFrame({'WHO Label': variant_df['WHO Label'], 'Variant': variant_df['Variant'], 'Growth Rate': recent_growth_rates[recent_growth_rates.iloc[:,i].name]})
-		prevalence_data = pd.DataFrame({'WHO Label': variant_df['WHO Label'], 'Variant': variant_df['Variant'], 'Prevalence': recent_prevalence[recent_prevalence.iloc[:,i].name]})
-		variant_growth_data.append(growth_data)
-		variant_prevalence_data.append(prevalence_data)
-	variant_growth_data = pd.concat(variant_growth_data, ignore_index = True)
-	variant_prevalence_data = pd.concat(variant_prevalence_data, ignore_index = True)
-	variant_data = pd.DataFrame(data = {'WHO Label': variant_growth_data['WHO Label'], 'Variant': variant_growth_data['Variant'], 'Growth Rate': variant_growth_data['Growth Rate'], 'Prevalence': variant_prevalence_data['Prevalence']})
-	variant_data = variant_data.dropna()
-	significant_variants = variant_data[(variant_data['Growth Rate'] > 5) | (variant_data['Prevalence'] > 0.05)]
-	who_and_variants = significant_variants[["WHO Label", "Variant"]].drop_duplicates()
-	covariant_ranking = significant_variants.groupby(['Variant']).size().reset_index(name = 'Sequence Prevalence Score')
-	prevalence_median = significant_variants.groupby(['Variant'])['Prevalence'].median().reset_index(name = 'Prevalence Median')
-	covariant_ranking = covariant_ranking.merge(prevalence_median, on = "Variant")
+	variant_df = variant_df[latest_counts(variant_df, interval) > 10]
+	recent_prevalence, recent_growth_rates = recent_metrics(variant_df, interval)
+	codes, variants = entity_codes(variant_df['Variant'])
+	codes[variant_df['WHO Label'].isna().to_numpy()] = -1
+	significant, counts = state.significance(variant_df, recent_months(variant_df, interval), recent_prevalence, recent_growth_rates, codes, variants) if (state) else (None, None)
+	significant, counts, medians = significance_counts(codes, len(variants), recent_prevalence, recent_growth_rates, significant = significant, counts = counts)
+	who_and_variants = variant_df[["WHO Label", "Variant"]].iloc[significant_rows(significant)].drop_duplicates()
+	scored = counts > 0
+	covariant_ranking = pd.DataFrame({'Variant': variants[scored], 'Sequence Prevalence Score': counts[scored], 'Prevalence Median': medians[scored]})
 	unscored_variants = sorted(set(covariants) - set(list(covariant_ranking['Variant'])), key = covariants.index)
 	unscored_variant_df = pd.DataFrame({'Variant': unscored_variants, 'Sequence Prevalence Score': [0]*len(unscored_variants), 'Prevalence Median': [0]*len(unscored_variants)})
 	covariant_ranking = pd.concat([covariant_ranking, unscored_variant_df], axis = 0)
@@ -92,58 +222,80 @@ def sequence_ranking(variant_df, interval, who = [], lineage = [], covariants =
 	return(covariant_ranking)
 
 
+# Length of the proteins scored against the SFoCs tab.  Proteins not listed here are sized by the SFoCs themselves.
+protein_lengths = {'Spike': 1273}
+
+# Compile the "SFoCs" tab into a dense per-residue weight table for one protein.  Entry i of the returned array is the
+# Functional Impact Score a mutation at residue i contributes: one point for each mAb escape class (class 1-4),
+# for convalescent and Moderna vaccine serum escape, for increased ACE2 binding, and for a region of interest,
+# summed over every SFoC whose Start-End range covers the residue.  D614 additionally scores one point for every
+# SFoC covering it.  Entry 0 is unused so residue positions index the table directly.
+@vpr.profiled
+def sfoc_weights(sfoc_df, protein = 'Spike'):
+	if (protein and 'Protein' in sfoc_df.columns):
+		sfoc_df = sfoc_df[(sfoc_df['Protein'] == protein)]
+	sfoc_df = sfoc_df[sfoc_df['Start'].notna() & sfoc_df['End'].notna() & (sfoc_df['Start'] <= sfoc_df['End'])]
+	starts = np.ceil(sfoc_df['Start'].to_numpy(dtype = float)).astype(np.int64).clip(min = 0)
+	ends = np.floor(sfoc_df['End'].to_numpy(dtype = float)).astype(np.int64)
+	length = max(protein_lengths.get(protein, 0), int(ends.max()) if (len(ends)) else 0)
+
+	mab_escape = sfoc_df['mAb escape'].fillna('').astype(str)
+	serum_escape = sfoc_df['serum Ab escape'].fillna('').astype(str)
+	row_weights = np.zeros(len(sfoc_df), dtype = np.int64)
+	for mab_class in ['class 1', 'class 2', 'class 3', 'class 4']:
+		row_weights += mab_escape.str.contains(mab_class, regex = False).to_numpy()
+	for serum in ['convalescent serum', 'Moderna vaccine serum']:
+		row_weights += serum_escape.str.contains(serum, regex = False).to_numpy()
+	row_weights += sfoc_df['Increased ACE2 binding'].notna().to_numpy()
+	row_weights += sfoc_df['Region of interest'].notna().to_numpy()
+
+	# Spread each SFoC's weight over its residue range with a difference array
+	weights = np.zeros(length + 2, dtype = np.int64)
+	np.add.at(weights, starts, row_weights)
+	np.add.at(weights, ends + 1, -row_weights)
+	weights = np.cumsum(weights)[:length + 1]
+	if (length >= 614):
+		weights[614] += ((starts <= 614) & (ends >= 614)).sum()
+	return(weights)
+
+# Score covariants, given as IDs in the covariant store, against a weight table from sfoc_weights().  All covariants
+# are scored in one vectorized pass over their encoded mutations.  A deletion directly following another deletion is
+# skipped so that a multi-residue deletion only scores for its first residue.
+@vpr.profiled
+def functional_scores(covariant_ids, weights, store = ve.covariant_store):
+	owner, mutation_ids, positions, residues = store.gather(covariant_ids)
+	positions = positions.astype(np.int64)
+	deletions = (residues == store.residue_codes['-'])
+	consecutive = np.zeros(len(owner), dtype = bool)
+	consecutive[1:] = (positions[1:] == positions[:-1] + 1) & deletions[1:] & deletions[:-1] & (owner[1:] == owner[:-1])
+	in_table = ~consecutive & (positions < len(weights))
+	contributions = np.where(in_table, weights[np.where(in_table, positions, 0)], 0)
+	return(np.bincount(owner, weights = contributions, minlength = len(covariant_ids)).astype(np.int64))
+
 # Compute the Functional Score for a covariant based on the defined criteria for an SFoC.
 # Return a dataframe with the covariant and the Predcited Functional Score, ranked by the score.
 # This takes in the "World - Variants" tab extracted from the Emerging Variants Report and a the
 # "SFoCs" tab extracted from the Emerging Variants Report.  The SFoCs tab is a pre-defined table
 # of "Sequence Features of Concern", where the JCVI team manualy curated a list of sequence regions
 # based on experimental data to be defined as regions that could have a functional consequence on 
-# the spike, such antibody neutralization.
-def functional_ranking(variant_df, sfoc_df, who = [], lineage = [], covariants = []):
+# the spike, such antibody neutralization.  The SFoCs of the given protein are compiled into a per-residue
+# weight table once (or a table from sfoc_weights() can be passed in), and each distinct covariant is scored once
+# from its encoding in the covariant store with array lookups and sums.  A memo with a scores(covariant_ids, weights)
+# method, such as a RankingState or a ScoreStore, can be passed in to reuse scores computed earlier.
+@vpr.profiled
+def functional_ranking(variant_df, sfoc_df, who = [], lineage = [], covariants = [], protein = 'Spike', weights = None, memo = None):
 	if (who):
 		variant_df = variant_df[(variant_df['WHO Label'].isin(who))]
 	if (lineage):
 		variant_df = variant_df[(variant_df['PANGO Lineage'].isin(lineage))]
 	variant_df.drop_duplicates(subset = ['Variant']).reset_index(inplace = True, drop = True)
 	covariants = list(variant_df['Variant'])
-	scores = []
+	if (weights is None):
+		weights = sfoc_weights(sfoc_df, protein)
 	print('Computing Functional Impact Scores ...')
-	for i in range(len(covariants)):
-		mutations = covariants[i].split(",")
-		sfoc_score = 0
-		prev_pos = 1
-		prev_mut = "N"
-		for j in range(len(mutations)):
-			aa_pos = int(re.sub("[^0-9]", "", mutations[j]))
-			aa_muts = re.sub(r'[0-9]+', '', mutations[j])
-			mut = aa_muts[len(aa_muts) - 1]
-			sfocs = sfoc_df[(sfoc_df['Start'] <= aa_pos) & (sfoc_df['End'] >= aa_pos)]
-			sfocs.reset_index(inplace = True, drop = True)
-			if (not ((aa_pos == (prev_pos + 1)) and (mut == "-") and (prev_mut	== "-"))):
-				for k in range(len(sfocs)):
-					if (aa_pos == 614):
-						sfoc_score += 1
-					if (pd.notna(sfocs.at[k,"mAb escape"])):
-						if ("class 1" in sfocs.loc[k].at["mAb escape"]):
-							sfoc_score += 1
-						if ("class 2" in sfocs.loc[k].at["mAb escape"]):
-							sfoc_score += 1
-						if ("class 3" in sfocs.loc[k].at["mAb escape"]):
-							sfoc_score += 1
-						if ("class 4" in sfocs.loc[k].at["mAb escape"]):
-							sfoc_score += 1
-					if (pd.notna(sfocs.at[k,"serum Ab escape"])):
-						if ("convalescent serum" in sfocs.loc[k].at["serum Ab escape"]):
-							sfoc_score += 1
-						if ("Moderna vaccine serum" in sfocs.loc[k].at["serum Ab escape"]):
-							sfoc_score += 1
-					if (pd.notna(sfocs.at[k,"Increased ACE2 binding"])):
-						sfoc_score += 1
-					if (pd.notna(sfocs.at[k,"Region of interest"])):
-						sfoc_score += 1
-			prev_pos = aa_pos
-			prev_mut = mut
-		scores.append(sfoc_score)
+	covariant_ids, inverse = np.unique(ve.covariant_store.encode(variant_df['Variant']), return_inverse = True)
+	score = memo.scores if (memo) else functional_scores
+	scores = np.where(covariant_ids >= 0, score(covariant_ids.clip(min = 0), weights), 0)[inverse]
 	
 	functional_impact = pd.DataFrame({'Variant': covariants, 'Functional Impact Score': scores})
 	impact_ranking = functional_impact.sort_values(by = 'Functional Impact Score', ascending = False)
@@ -155,23 +307,266 @@ def functional_ranking(variant_df, sfoc_df, who = [], lineage = [], covariants =
 # Return a dataframe with the lineage and emergence score, ranked by the Emergence Score.
 # This takes in the "World - Variants" tab extracted from the Emerging Variants Report and
 # returns a score for lineages with at least 10 variants counts in the recent months and meets
-# a significant growth rate level.  Note, this heuristic is not used very  much in practice.
-def lineage_ranking(variant_df, interval):
-	variant_df = variant_df[variant_df[variant_df[variant_df.columns[pd.Series(variant_df.columns).str.startswith('Variant Count')]].iloc[:,0].name] > 10]
-	recent_growth_rates = variant_df[variant_df.columns[pd.Series(variant_df.columns).str.startswith('Growth Rate')]].iloc[:,:interval]
-	recent_prevalence = variant_df[variant_df.columns[pd.Series(variant_df.columns).str.startswith('Prevalence')]].iloc[:,:interval]
+# a significant growth rate level.  Note, this heuristic is not used very  much in practice.  Unlike the covariant
+# and mutation rankings, a month counts towards the Emergence Score whenever the lineage's growth rate is above 1,
+# whatever its prevalence (the rule the original "Growth Rates > 5 | Prevalence > 0.05" expression evaluated to).
+@vpr.profiled
+def lineage_ranking(variant_df, interval, state = None):
+	variant_df = variant_df[latest_counts(variant_df, interval) > 10]
+	recent_prevalence, recent_growth_rates = recent_metrics(variant_df, interval)
 	who_and_pango = variant_df[["WHO Label", "PANGO Lineage"]].drop_duplicates()
-	lineage_growth_data = []
-	lineage_prevalence_data = []
-	for i in range(interval):
-		growth_data = pd.DataFrame({'WHO Label': variant_df['WHO Label'], 'PANGO Lineage': variant_df['PANGO Lineage'], 'Growth Rates': recent_growth_rates[recent_growth_rates.iloc[:,i].name]})
-		prevalence_data = pd.DataFrame({'WHO Label': variant_df['WHO Label'], 'PANGO Lineage': variant_df['PANGO Lineage'], 'Prevalence': recent_prevalence[recent_prevalence.iloc[:,i].name]})
-		lineage_growth_data.append(growth_data)
-		lineage_prevalence_data.append(prevalence_data)
-	lineage_growth_data = pd.concat(lineage_growth_data, ignore_index = True)
-	lineage_prevalence_data = pd.concat(lineage_prevalence_data, ignore_index = True)
-	lineage_data = pd.DataFrame(data = {'WHO Label': lineage_growth_data['WHO Label'], 'PANGO Lineage': lineage_growth_data['PANGO Lineage'], 'Growth Rates': lineage_growth_data['Growth Rates'], 'Prevalence': lineage_prevalence_data['Prevalence']})
-	lineage_data = lineage_data[(lineage_data['Growth Rates']) > 5 | (lineage_data['Prevalence'] > 0.05)]
-	emergence_ranking = lineage_data.groupby('PANGO Lineage').size().reset_index(name = 'Emergence Score')
+	codes, lineages = entity_codes(variant_df['PANGO Lineage'])
+	significant, counts = state.significance(variant_df, recent_months(variant_df, interval), recent_prevalence, recent_growth_rates, codes, lineages, growth_threshold = 1, prevalence_threshold = None, dropna = False) if (state) else (None, None)
+	significant, counts, medians = significance_counts(codes, len(lineages), recent_prevalence, recent_growth_rates, growth_threshold = 1, prevalence_threshold = None, dropna = False, significant = significant, counts = counts)
+	scored = counts > 0
+	emergence_ranking = pd.DataFrame({'PANGO Lineage': lineages[scored], 'Emergence Score': counts[scored]})
 	emergence_ranking = who_and_pango.merge(emergence_ranking, on = 'PANGO Lineage').sort_values(by = 'Emergence Score', ascending = False).reset_index(drop=True)
-	return(emergence_ranking)
\ No newline at end of file
+	return(emergence_ranking)
+
+
+# Rankings of every country (or every region) at once.  Instead of filtering the sheet down to one location and ranking
+# it, every row is assigned to the (location, entity) pair it belongs to and the significance kernel counts all pairs
+# in a single pass.  Each returns one long table with the location column in front of the columns of the single
+# location ranking, holding exactly the rows that ranking gives for each location, ordered by location and then by
+# score.  Where the single location ranking leaves tied scores in an arbitrary order, ties are broken by entity.
+
+# Group code of every row for the (location, entity) pair it belongs to, with -1 where either is missing.  Returns the
+# codes together with the location and entity of every group, with groups ordered by location and then entity.
+def location_entity_codes(location_values, entity_values):
+	location_codes, locations = entity_codes(location_values)
+	codes, entities = entity_codes(entity_values)
+	valid = (location_codes >= 0) & (codes >= 0)
+	pairs, group_codes = np.unique(location_codes[valid] * max(len(entities), 1) + codes[valid], return_inverse = True)
+	row_codes = np.full(len(codes), -1, dtype = np.int64)
+	row_codes[valid] = group_codes
+	return(row_codes, locations[pairs // max(len(entities), 1)], entities[pairs % max(len(entities), 1)])
+
+# Emergence Scores of lineages within every location, as lineage_ranking() gives them for each location on its own
+@vpr.profiled
+def lineage_ranking_by_location(variant_df, interval, location_column = 'Country'):
+	variant_df = variant_df[latest_counts(variant_df, interval) > 10]
+	recent_prevalence, recent_growth_rates = recent_metrics(variant_df, interval)
+	who_and_pango = variant_df[[location_column, "WHO Label", "PANGO Lineage"]].drop_duplicates()
+	codes, locations, lineages = location_entity_codes(variant_df[location_column], variant_df['PANGO Lineage'])
+	significant, counts, medians = significance_counts(codes, len(locations), recent_prevalence, recent_growth_rates, growth_threshold = 1, prevalence_threshold = None, dropna = False)
+	scored = counts > 0
+	emergence_ranking = pd.DataFrame({location_column: locations[scored], 'PANGO Lineage': lineages[scored], 'Emergence Score': counts[scored]})
+	emergence_ranking = who_and_pango.merge(emergence_ranking, on = [location_column, 'PANGO Lineage'])
+	emergence_ranking = emergence_ranking.sort_values(by = [location_column, 'Emergence Score', 'PANGO Lineage'], ascending = [True, False, True], kind = 'stable').reset_index(drop = True)
+	return(emergence_ranking)
+
+# Sequence Prevalence Scores of the top 50 covariants within every location, as sequence_ranking() gives them for the
+# whole of each location on its own
+@vpr.profiled
+def sequence_ranking_by_location(variant_df, interval, location_column = 'Country'):
+	variant_df = variant_df[latest_counts(variant_df, interval) > 10]
+	recent_prevalence, recent_growth_rates = recent_metrics(variant_df, interval)
+	codes, locations, variants = location_entity_codes(variant_df[location_column], variant_df['Variant'])
+	codes[variant_df['WHO Label'].isna().to_numpy()] = -1
+	significant, counts, medians = significance_counts(codes, len(locations), recent_prevalence, recent_growth_rates)
+	who_and_variants = variant_df[[location_column, "WHO Label", "Variant"]].iloc[significant_rows(significant)].drop_duplicates()
+	scored = counts > 0
+	covariant_ranking = pd.DataFrame({location_column: locations[scored], 'Variant': variants[scored], 'Sequence Prevalence Score': counts[scored], 'Prevalence Median': medians[scored]})
+	covariant_ranking = who_and_variants.merge(covariant_ranking, on = [location_column, 'Variant'])
+	covariant_ranking = covariant_ranking.sort_values(by = [location_column, 'Sequence Prevalence Score', 'Prevalence Median'], ascending = [True, False, False], kind = 'stable').drop_duplicates()
+	covariant_ranking = covariant_ranking[covariant_ranking.groupby(location_column, sort = False).cumcount() < 50].reset_index(drop = True)
+	return(covariant_ranking)
+
+# Mutation Prevalence Scores of substitutions within a domain (or a user inputted list) in every location, as
+# mutation_ranking() gives them for each location on its own
+@vpr.profiled
+def mutation_ranking_by_location(variant_df, interval, domain, mutations = [], location_column = 'Country'):
+	variant_df = domain_mutations(variant_df, domain, mutations)
+	variant_df = variant_df[latest_counts(variant_df, interval) > 10]
+	recent_prevalence, recent_growth_rates = recent_metrics(variant_df, interval)
+	codes, locations, mutations = location_entity_codes(variant_df[location_column], variant_df['Variant'])
+	significant, counts, medians = significance_counts(codes, len(locations), recent_prevalence, recent_growth_rates)
+	scored = counts > 0
+	mutation_ranking = pd.DataFrame({location_column: locations[scored], 'Variant': mutations[scored], 'Mutation Prevalence Score': counts[scored], 'Prevalence Median': medians[scored]})
+	mutation_ranking = mutation_ranking.sort_values(by = [location_column, 'Mutation Prevalence Score', 'Prevalence Median', 'Variant'], ascending = [True, False, False, True], kind = 'stable').reset_index(drop = True)
+	return(mutation_ranking)
+
+
+# Rolling rankings: each ranking as it would have looked at every month of the report's history, with the window of
+# interval months slid across the whole sheet.  Months are tested for significance once, and the significant months of
+# every row inside every window are read off cumulative sums along the month axis, so scoring all windows costs about
+# as much as a single ranking.  As in the rankings, a row only counts towards a window when its Variant Count in the
+# most recent month of the window is above 10.  Each returns an entity x window end matrix: the entity column followed
+# by one column of scores per window, headed by the month the window ends in ('YYYY-MM', oldest first), holding the
+# entities scored in at least one window ordered by their score in the most recent window.  With ends, a (first month,
+# last month) pair, only the windows ending in that range are kept.
+
+# Values of metrics for every row and every month of a sheet (rows x months, most recent month first, as for an
+# interval covering the whole sheet), with NaN for months the sheet has no column of a metric for.  All are returned in
+# one dtype, float32 for compacted frames as in recent_metrics().
+def metric_grids(variant_df, metrics):
+	schema = vd.report_schema(variant_df.columns)
+	positions = [schema.positions[metric] for metric in metrics]
+	dtype = np.result_type(np.float32, *[d for p in positions for d in variant_df.dtypes.iloc[p[p >= 0]]])
+	grids = []
+	for metric_positions in positions:
+		present = metric_positions >= 0
+		grid = np.full((len(variant_df), len(metric_positions)), np.nan, dtype = dtype, order = 'F')
+		grid[:, present] = variant_df.iloc[:, metric_positions[present]].to_numpy(dtype = dtype)
+		grids.append(grid)
+	return(grids)
+
+# Whether every row passes the Variant Count cut of the window ending at every month (rows x months, most recent first).
+# The count is read from the most recent month of the window that has a Variant Count column, as latest_counts() does.
+def rolling_cut(variant_df, interval):
+	schema = vd.report_schema(variant_df.columns)
+	present = schema.positions['Variant Count'] >= 0
+	n_months = len(present)
+	nearest = np.full(n_months + 1, n_months, dtype = np.int64)
+	for month in range(n_months - 1, -1, -1):
+		nearest[month] = month if (present[month]) else nearest[month + 1]
+	nearest = nearest[:n_months]
+	usable = nearest < np.minimum(np.arange(n_months) + interval, n_months)
+	counts = variant_df.iloc[:, schema.positions['Variant Count'][nearest[usable]]].to_numpy(dtype = float)
+	passed = np.zeros((len(variant_df), n_months), dtype = bool)
+	with np.errstate(invalid = 'ignore'):
+		passed[:, usable] = counts > 10
+	return(passed)
+
+# Rolling significance kernel.  Takes the entity code of every row, its significance mask and Variant Count cut
+# (rows x months, oldest month first) and returns the number of significant months of every entity in the window of
+# interval months ending at each month (entities x windows, window w ending at month w + interval - 1).
+def rolling_counts(codes, n_entities, significant, passed, interval):
+	n_windows = max(significant.shape[1] - interval + 1, 0)
+	valid = codes >= 0
+	cumulative = np.zeros((int(valid.sum()), significant.shape[1] + 1), dtype = np.int32, order = 'F')
+	np.cumsum(significant[valid], axis = 1, out = cumulative[:, 1:])
+	windows = (cumulative[:, interval:] - cumulative[:, :n_windows]) * passed[valid][:, interval - 1:]
+	scores = np.zeros((n_entities, n_windows), dtype = np.int64)
+	for window in range(n_windows):
+		scores[:, window] = np.bincount(codes[valid], weights = windows[:, window], minlength = n_entities)
+	return(scores)
+
+# Score matrix of a rolling ranking, from the entity code of every row and the entities they stand for
+def rolling_ranking(variant_df, codes, entities, entity_column, interval, ends = None, growth_threshold = 5, prevalence_threshold = 0.05, dropna = True):
+	schema = vd.report_schema(variant_df.columns)
+	prevalence, growth = metric_grids(variant_df, ['Prevalence', 'Growth Rate'])
+	significant = significant_months(prevalence, growth, growth_threshold, prevalence_threshold, dropna)
+	passed = rolling_cut(variant_df, interval)
+	scores = rolling_counts(codes, len(entities), significant[:, ::-1], passed[:, ::-1], interval)
+	window_ends = schema.month_labels()[::-1][interval - 1:]
+	kept = [i for i, end in enumerate(window_ends) if (ends is None or end in set(schema.month_labels(ends)))]
+	scores = scores[:, kept]
+	scored = (scores > 0).any(axis = 1)
+	matrix = pd.concat([pd.DataFrame({entity_column: entities[scored]}), pd.DataFrame(scores[scored], columns = [window_ends[i] for i in kept])], axis = 1)
+	if (len(kept)):
+		matrix = matrix.sort_values(by = window_ends[kept[-1]], ascending = False, kind = 'stable')
+	return(matrix.reset_index(drop = True))
+
+# Sequence Prevalence Scores of covariants in every window, as sequence_ranking() gives them for each window
+@vpr.profiled
+def sequence_ranking_rolling(variant_df, interval, who = [], lineage = [], ends = None):
+	if (who):
+		variant_df = variant_df[(variant_df['WHO Label'].isin(who))]
+	if (lineage):
+		variant_df = variant_df[(variant_df['PANGO Lineage'].isin(lineage))]
+	codes, variants = entity_codes(variant_df['Variant'])
+	codes[variant_df['WHO Label'].isna().to_numpy()] = -1
+	return(rolling_ranking(variant_df, codes, variants, 'Variant', interval, ends))
+
+# Emergence Scores of lineages in every window, as lineage_ranking() gives them for each window
+@vpr.profiled
+def lineage_ranking_rolling(variant_df, interval, ends = None):
+	codes, lineages = entity_codes(variant_df['PANGO Lineage'])
+	return(rolling_ranking(variant_df, codes, lineages, 'PANGO Lineage', interval, ends, growth_threshold = 1, prevalence_threshold = None, dropna = False))
+
+# Mutation Prevalence Scores of substitutions within a domain (or a user inputted list) in every window, as
+# mutation_ranking() gives them for each window
+@vpr.profiled
+def mutation_ranking_rolling(variant_df, interval, domain, mutations = [], ends = None):
+	variant_df = domain_mutations(variant_df, domain, mutations)
+	codes, mutations = entity_codes(variant_df['Variant'])
+	return(rolling_ranking(variant_df, codes, mutations, 'Variant', interval, ends))
+
+
+# Threshold sweeps: the scores a ranking gives under every combination of a grid of growth rate, prevalence and minimum
+# Variant Count thresholds, for tuning the "Growth Rate > 5 | Prevalence > 0.05" and "Variant Count > 10" rules.  Every
+# month of every row is placed once by how many of the growth and prevalence thresholds it is above and every row by
+# how many count thresholds its Variant Count is above, and the scores of all combinations are read off cumulative sums
+# of the histogram of those places, so the sweep costs about as much as a single ranking whatever the size of the
+# grid.  Each returns a tidy table with a row for every (thresholds, entity) pair that scores: the growth, prevalence
+# and count thresholds (the prevalence threshold is NaN where prevalence is not tested), the entity, its score and its
+# rank among the entities of that combination (ties share the best rank).  Unlike the rankings, all scored entities
+# are kept rather than the top 50 covariants, and no prevalence medians are computed.
+
+# Number of thresholds (sorted ascending) each value is strictly above, 0 for missing values
+def thresholds_below(thresholds, values):
+	below = np.searchsorted(thresholds, values, side = 'left')
+	below[np.isnan(values)] = 0
+	return(below)
+
+# Threshold sweep kernel.  Takes the entity code of every row, the prevalence and growth rates of every row over the
+# months of interest (rows x months) and the Variant Count every row is cut on, with the sorted threshold grids, and
+# returns the entities that score under any combination and their scores (entities x count x growth x prevalence
+# thresholds).  A prevalence threshold of None leaves prevalence untested.  With dropna, months missing either value
+# are never significant, as in significant_months().
+def threshold_counts(codes, prevalence, growth, latest, growth_thresholds, prevalence_thresholds, count_thresholds, dropna = True):
+	growth_grid = np.asarray(growth_thresholds, dtype = growth.dtype)
+	prevalence_grid = np.asarray([np.inf if (t is None) else t for t in prevalence_thresholds], dtype = prevalence.dtype)
+	shape = (len(count_thresholds) + 1, len(growth_grid) + 1, len(prevalence_grid) + 1)
+	growth_places = thresholds_below(growth_grid, growth)
+	prevalence_places = thresholds_below(prevalence_grid, prevalence)
+	if (dropna):
+		missing = np.isnan(growth) | np.isnan(prevalence)
+		growth_places[missing] = 0
+		prevalence_places[missing] = 0
+	count_places = thresholds_below(np.asarray(count_thresholds, dtype = float), np.asarray(latest, dtype = float))
+	candidate = ((growth_places > 0) | (prevalence_places > 0)) & ((count_places > 0) & (codes >= 0))[:, None]
+	rows, months = np.nonzero(candidate)
+	entities, entity = np.unique(codes[rows], return_inverse = True)
+	places = np.ravel_multi_index((entity, count_places[rows], growth_places[rows, months], prevalence_places[rows, months]), (len(entities),) + shape)
+	histogram = np.bincount(places, minlength = len(entities) * np.prod(shape)).reshape((len(entities),) + shape)
+	passed = np.cumsum(histogram[:, ::-1], axis = 1)[:, ::-1][:, 1:]
+	insignificant = passed.cumsum(axis = 2).cumsum(axis = 3)
+	scores = insignificant[:, :, -1:, -1:] - insignificant[:, :, :-1, :-1]
+	return(entities, scores)
+
+# Tidy table of a threshold sweep, from the entity code of every row and the entities they stand for
+def threshold_sweep(variant_df, codes, entities, entity_column, interval, growth_thresholds, prevalence_thresholds, count_thresholds, dropna = True):
+	growth_thresholds = sorted(set(growth_thresholds))
+	prevalence_thresholds = sorted(set(prevalence_thresholds), key = lambda t: np.inf if (t is None) else t)
+	count_thresholds = sorted(set(count_thresholds))
+	prevalence, growth = recent_metrics(variant_df, interval)
+	scored, scores = threshold_counts(codes, prevalence, growth, latest_counts(variant_df, interval).to_numpy(dtype = float), growth_thresholds, prevalence_thresholds, count_thresholds, dropna)
+	entity, count, growth_threshold, prevalence_threshold = np.nonzero(scores)
+	sweep = pd.DataFrame({
+		'Growth Threshold': np.asarray(growth_thresholds, dtype = float)[growth_threshold],
+		'Prevalence Threshold': np.asarray([np.nan if (t is None) else t for t in prevalence_thresholds], dtype = float)[prevalence_threshold],
+		'Minimum Count': np.asarray(count_thresholds)[count],
+		entity_column: entities[scored[entity]],
+		'Score': scores[entity, count, growth_threshold, prevalence_threshold]})
+	combination = ['Growth Threshold', 'Prevalence Threshold', 'Minimum Count']
+	sweep = sweep.sort_values(by = combination + ['Score', entity_column], ascending = [True, True, True, False, True], kind = 'stable').reset_index(drop = True)
+	sweep['Rank'] = sweep.groupby(combination, dropna = False)['Score'].rank(method = 'min', ascending = False).astype(int)
+	return(sweep)
+
+# Sequence Prevalence Scores of covariants under every combination of thresholds
+@vpr.profiled
+def sequence_ranking_sweep(variant_df, interval, growth_thresholds = [5], prevalence_thresholds = [0.05], count_thresholds = [10], who = [], lineage = []):
+	if (who):
+		variant_df = variant_df[(variant_df['WHO Label'].isin(who))]
+	if (lineage):
+		variant_df = variant_df[(variant_df['PANGO Lineage'].isin(lineage))]
+	codes, variants = entity_codes(variant_df['Variant'])
+	codes[variant_df['WHO Label'].isna().to_numpy()] = -1
+	return(threshold_sweep(variant_df, codes, variants, 'Variant', interval, growth_thresholds, prevalence_thresholds, count_thresholds))
+
+# Emergence Scores of lineages under every combination of thresholds.  As in lineage_ranking(), only growth is tested
+# unless prevalence thresholds are given.
+@vpr.profiled
+def lineage_ranking_sweep(variant_df, interval, growth_thresholds = [1], prevalence_thresholds = [None], count_thresholds = [10]):
+	codes, lineages = entity_codes(variant_df['PANGO Lineage'])
+	return(threshold_sweep(variant_df, codes, lineages, 'PANGO Lineage', interval, growth_thresholds, prevalence_thresholds, count_thresholds, dropna = False))
+
+# Mutation Prevalence Scores of substitutions within a domain (or a user inputted list) under every combination of
+# thresholds
+@vpr.profiled
+def mutation_ranking_sweep(variant_df, interval, domain, mutations = [], growth_thresholds = [5], prevalence_thresholds = [0.05], count_thresholds = [10]):
+	variant_df = domain_mutations(variant_df, domain, mutations)
+	codes, mutations = entity_codes(variant_df['Variant'])
+	return(threshold_sweep(variant_df, codes, mutations, 'Variant', interval, growth_thresholds, prevalence_thresholds, count_thresholds))
@@ -0,0 +1,145 @@
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+import contextlib
+import numpy as np
+import pandas as pd
+import VariantAnalysis as va
+import VariantPlots as vp
+import VariantData as vd
+import VariantSynthetic as vsy
+import main
+
+# Scales whose synthetic report is also written and timed as an xlsx.  Writing and parsing a workbook of pandemic peak
+# size takes the better part of an hour, so the peak scale times loading from the TSV export unless asked otherwise.
+xlsx_scales = ['small', 'medium']
+default_interval = 4
+
+
+# Time a function over repeat runs.  Returns the wall time of every run in seconds and the result of the last run.
+# Anything the function prints is swallowed so the timings are not mixed with progress messages.
+def timed(function, repeat = 3):
+	seconds = []
+	for i in range(repeat):
+		with contextlib.redirect_stdout(io.StringIO()):
+			start = time.perf_counter()
+			result = function()
+			seconds.append(time.perf_counter() - start)
+	return(seconds, result)
+
+# One benchmark result, as saved in the JSON
+def result(scale, benchmark, rows, seconds):
+	return({'scale': scale, 'benchmark': benchmark, 'rows': int(rows), 'runs': [round(s, 6) for s in seconds], 'best': round(min(seconds), 6), 'median': round(float(np.median(seconds)), 6)})
+
+
+# Run every benchmark on a synthetic report of one scale.  The report is written to workdir and loaded back the way
+# main.py loads it (from the xlsx, once cold and then cached, and from the TSV export), then the rankings and the
+# covariant plot helper are timed on the World data exactly as main.py passes it to them.
+def benchmark_scale(scale, settings, workdir, repeat = 3, xlsx = False, seed = 0):
+	results = []
+	print("Generating the "+scale+" synthetic report ...")
+	sheets = vsy.synthetic_report(seed = seed, **settings)
+	requests = {'World - Variants': main.variant_columns, 'World - Lineages': main.lineage_columns, 'AA Mutations': main.mutation_columns, 'SFoCs': None}
+	rows = sum(len(sheets[name]) for name in requests)
+
+	if (xlsx):
+		path = os.path.join(workdir, scale+'.xlsx')
+		vsy.write_report(sheets, path)
+		cache_dir = tempfile.mkdtemp(dir = workdir)
+		seconds, report_sheets = timed(lambda: vd.EmergingVariantsReport(path, cache_dir).sheets(requests), 1)
+		results.append(result(scale, 'load_xlsx', rows, seconds))
+		seconds, report_sheets = timed(lambda: vd.EmergingVariantsReport(path, cache_dir).sheets(requests), repeat)
+		results.append(result(scale, 'load_xlsx_cached', rows, seconds))
+	paths = vsy.write_exports(sheets, os.path.join(workdir, scale))
+	seconds, export = timed(lambda: vd.DelimitedReport(paths['World - Variants']).sheet('World - Variants', main.variant_columns), repeat)
+	results.append(result(scale, 'load_tsv', len(sheets['World - Variants']), seconds))
+
+	report_sheets = main.encode_variants({name: sheets[name] for name in requests})
+	data = main.region_data(report_sheets)
+	variants = data['analysis_variants']
+	sfocs = data['sfocs']
+	benchmarks = [
+		('lineage_ranking', len(variants), lambda: va.lineage_ranking(variants, default_interval)),
+		('sequence_ranking', len(variants), lambda: va.sequence_ranking(variants, default_interval)),
+		('functional_ranking', len(variants), lambda: va.functional_ranking(variants, sfocs)),
+		('composite_ranking', len(variants), lambda: va.composite_ranking(variants, sfocs, default_interval)),
+		('mutation_ranking', len(data['analysis_subs']), lambda: va.mutation_ranking(data['analysis_subs'], default_interval, 'Spike')),
+	]
+	for benchmark, benchmark_rows, function in benchmarks:
+		print("Timing "+benchmark+" ("+scale+") ...")
+		seconds, ranking = timed(function, repeat)
+		results.append(result(scale, benchmark, benchmark_rows, seconds))
+	covariants = va.sequence_ranking(variants, default_interval)['Variant'].drop_duplicates().head(10).tolist()
+	print("Timing plot_covariants_help ("+scale+") ...")
+	seconds, plot_df = timed(lambda: vp.plot_covariants_help(data['graph_variants'], covariants), repeat)
+	results.append(result(scale, 'plot_covariants_help', len(data['graph_variants']), seconds))
+	return(results)
+
+
+# Commit of the code being benchmarked, so results from different versions can be told apart
+def code_version():
+	try:
+		return(subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd = os.path.dirname(os.path.abspath(__file__)), capture_output = True, text = True, check = True).stdout.strip())
+	except (OSError, subprocess.CalledProcessError):
+		return(None)
+
+
+# Run the benchmarks at the given scales and return them with the versions of the code and libraries they ran on
+def run_benchmarks(scale_names, repeat = 3, xlsx = None, seed = 0):
+	results = []
+	with tempfile.TemporaryDirectory() as workdir:
+		for scale in scale_names:
+			results += benchmark_scale(scale, vsy.scales[scale], workdir, repeat, (scale in xlsx_scales) if (xlsx is None) else xlsx, seed)
+	return({
+		'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+		'version': code_version(),
+		'python': platform.python_version(),
+		'numpy': np.__version__,
+		'pandas': pd.__version__,
+		'machine': platform.machine(),
+		'repeat': repeat,
+		'seed': seed,
+		'scales': {scale: vsy.scales[scale] for scale in scale_names},
+		'results': results,
+	})
+
+
+# Print a table of the best time of every benchmark, next to its time in a baseline run when one is given
+def print_results(benchmarks, baseline = None):
+	previous = {(r['scale'], r['benchmark']): r['best'] for r in (baseline or {}).get('results', [])}
+	table = pd.DataFrame([{'Scale': r['scale'], 'Benchmark': r['benchmark'], 'Rows': r['rows'], 'Best (s)': r['best'], 'Median (s)': r['median']} for r in benchmarks['results']])
+	if (baseline):
+		table['Baseline (s)'] = [previous.get((r['scale'], r['benchmark']), np.nan) for r in benchmarks['results']]
+		table['Ratio'] = (table['Best (s)'] / table['Baseline (s)']).round(2)
+	print(table.to_string(index = False))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'Time the rankings, plotting helper and sheet loading on synthetic reports')
+	parser.add_argument('--scales', dest = 'scales', type = str, default = 'small,medium,peak', help = 'comma separated, from: '+', '.join(vsy.scales))
+	parser.add_argument('--repeat', dest = 'repeat', type = int, default = 3)
+	parser.add_argument('--output', dest = 'output', type = str, default = 'benchmarks.json')
+	parser.add_argument('--compare', dest = 'compare', type = str, help = 'JSON of an earlier run to compare against')
+	parser.add_argument('--xlsx', dest = 'xlsx', action = 'store_true', help = 'time xlsx loading at every scale, peak included')
+	parser.add_argument('--seed', dest = 'seed', type = int, default = 0)
+	args = parser.parse_args()
+
+	scale_names = [s.strip() for s in args.scales.split(',') if (s.strip())]
+	if (any(s not in vsy.scales for s in scale_names) or args.repeat < 1):
+		sys.exit("Invalid scales or repeat count. Please give scales from: "+', '.join(vsy.scales))
+	baseline = None
+	if (args.compare):
+		with open(args.compare) as f:
+			baseline = json.load(f)
+	benchmarks = run_benchmarks(scale_names, args.repeat, True if (args.xlsx) else None, args.seed)
+	with open(args.output + '.tmp', 'w') as f:
+		json.dump(benchmarks, f, indent = 1)
+	os.replace(args.output + '.tmp', args.output)
+	print_results(benchmarks, baseline)
+	print("Benchmarks saved to "+args.output)
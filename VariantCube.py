@@ -0,0 +1,224 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+import VariantData as vd
+
+# Monthly metrics stored as the layers of a cube, and the sheets of the Emerging Variants Report converted to cubes
+layers = ['Variant Count', 'Isolates Count', 'Prevalence', 'Growth Rate']
+cube_sheets = ['World - Variants', 'World - Lineages', 'AA Mutations', 'USA - Variants', 'USA - Lineages']
+location_columns = ['Country', 'Region']
+
+
+# Split a monthly metric header such as 'Prevalence - 2023-06' (or 'Prevalence - 202306') into its layer and month
+# label ('2023-06'), or return None for a label column (see VariantData.parse_header())
+def split_header(header):
+	parsed = vd.parse_header(header)
+	if (parsed is None):
+		return(None)
+	return(parsed[0], str(parsed[1]))
+
+
+# Write the ordered labels of a cube axis
+def write_labels(path, labels):
+	with open(path, 'w') as f:
+		json.dump([None if (pd.isna(label)) else label for label in labels], f)
+
+def read_labels(path):
+	with open(path) as f:
+		return(json.load(f))
+
+
+# Convert one sheet of the Emerging Variants Report into a cube directory.  The report is really a 3-D tensor of
+# entity (covariant, lineage or mutation) x country/region x month, so every monthly metric becomes one numpy array of
+# that shape saved as a .npy file that can be memory mapped.  An entity is a distinct combination of the sheet's label
+# columns other than Country/Region, and entities are sorted by those columns so that every WHO Label, PANGO Lineage
+# or other leading label occupies a contiguous block and can be sliced as a view.  Side indexes hold the entity,
+# location and month labels, and rows.npy remembers the sheet row of every cell so the sheet can be rebuilt exactly.
+# The metric columns are also kept in sheet order in metrics.npy, one column major array with a column per metric
+# header, so the whole sheet can be rebuilt from views of the memory map instead of being gathered from the layers.
+def build_cube(sheet_df, path):
+	location_column = [c for c in sheet_df.columns if (c in location_columns)][0]
+	metric_columns = [c for c in sheet_df.columns if (split_header(c) is not None)]
+	entity_columns = [c for c in sheet_df.columns if (c not in metric_columns and c != location_column)]
+	months = list(dict.fromkeys(split_header(c)[1] for c in metric_columns))
+
+	entity_codes = sheet_df.groupby(entity_columns, dropna = False, sort = True).ngroup().to_numpy()
+	first_rows = pd.Series(np.arange(len(sheet_df))).groupby(entity_codes).first().to_numpy()
+	entities = sheet_df[entity_columns].iloc[first_rows].reset_index(drop = True)
+	location_codes, locations = pd.factorize(sheet_df[location_column], use_na_sentinel = False)
+	if (pd.Series(entity_codes * len(locations) + location_codes).duplicated().any()):
+		raise ValueError("Sheet has more than one row for the same entity and "+location_column+", cannot convert it to a cube")
+
+	os.makedirs(path, exist_ok = True)
+	shape = (len(entities), len(locations), len(months))
+	rows = np.lib.format.open_memmap(os.path.join(path, 'rows.npy'), mode = 'w+', dtype = np.int64, shape = shape[:2])
+	rows[:] = -1
+	rows[entity_codes, location_codes] = np.arange(len(sheet_df))
+	rows.flush()
+	for layer in layers:
+		cube = np.lib.format.open_memmap(os.path.join(path, vd.sheet_slug(layer) + '.npy'), mode = 'w+', dtype = np.float64, shape = shape)
+		cube[:] = np.nan
+		for c in metric_columns:
+			if (split_header(c)[0] == layer):
+				cube[entity_codes, location_codes, months.index(split_header(c)[1])] = sheet_df[c].to_numpy(dtype = float)
+		cube.flush()
+	sheet_metrics = np.lib.format.open_memmap(os.path.join(path, 'metrics.npy'), mode = 'w+', dtype = np.float64, shape = (len(sheet_df), len(metric_columns)), fortran_order = True)
+	for j, c in enumerate(metric_columns):
+		sheet_metrics[:, j] = sheet_df[c].to_numpy(dtype = float)
+	sheet_metrics.flush()
+	entities.to_pickle(os.path.join(path, 'entities.pkl'))
+	write_labels(os.path.join(path, 'locations.json'), list(locations))
+	write_labels(os.path.join(path, 'months.json'), months)
+	with open(os.path.join(path, 'meta.json'), 'w') as f:
+		json.dump({'location_column': location_column, 'columns': [str(c) for c in sheet_df.columns]}, f)
+
+
+# Convert every sheet of an Emerging Variants Report that main.py works with into cubes under path, one subdirectory per
+# sheet, and copy the SFoCs sheet alongside as a pickle so the cube directory can stand in for the report
+def build_report_cubes(variants_report, path):
+	os.makedirs(path, exist_ok = True)
+	for sheet in cube_sheets + ['SFoCs']:
+		try:
+			sheet_df = variants_report.sheet(sheet)
+		except ValueError:
+			continue
+		print("Converting '"+sheet+"' ...")
+		if (sheet == 'SFoCs'):
+			sheet_df.to_pickle(os.path.join(path, 'SFoCs.pkl'))
+		else:
+			build_cube(sheet_df, os.path.join(path, vd.sheet_slug(sheet)))
+
+
+# A cube of one sheet, opened with every layer memory mapped read only.  Several processes opening the same cube share
+# a single copy of the data through the page cache, and opening a cube reads nothing but its small side indexes.
+# Cubes built before metrics.npy was added are still read, rebuilding their sheets from the layers.
+class ReportCube:
+
+	def __init__(self, path):
+		self.path = path
+		with open(os.path.join(path, 'meta.json')) as f:
+			meta = json.load(f)
+		self.location_column = meta['location_column']
+		self.columns = meta['columns']
+		self.entities = pd.read_pickle(os.path.join(path, 'entities.pkl'))
+		self.locations = read_labels(os.path.join(path, 'locations.json'))
+		self.months = read_labels(os.path.join(path, 'months.json'))
+		self.rows = np.load(os.path.join(path, 'rows.npy'), mmap_mode = 'r')
+		self.layers = {layer: np.load(os.path.join(path, vd.sheet_slug(layer) + '.npy'), mmap_mode = 'r') for layer in layers}
+		metrics_file = os.path.join(path, 'metrics.npy')
+		self.metrics = np.load(metrics_file, mmap_mode = 'r') if (os.path.exists(metrics_file)) else None
+
+	# Entity selector matching label values, e.g. entity_selector(**{'PANGO Lineage': 'BA.5'}).  Values may be single
+	# labels or lists of labels.  Returns a slice when the matching entities are contiguous, which they are when
+	# filtering on leading label columns, and an index array otherwise.
+	def entity_selector(self, **labels):
+		match = np.ones(len(self.entities), dtype = bool)
+		for column, values in labels.items():
+			values = values if (isinstance(values, (list, tuple, set))) else [values]
+			match &= self.entities[column].isin(values).to_numpy()
+		return(contiguous(np.flatnonzero(match)))
+
+	# Location selector for a single country/region or a list of them
+	def location_selector(self, locations):
+		if (isinstance(locations, (list, tuple, set))):
+			return(contiguous(np.array([self.locations.index(l) for l in locations], dtype = np.int64)))
+		index = self.locations.index(locations)
+		return(slice(index, index + 1))
+
+	# Month selector for the first interval months (the most recent ones in report order), or for a single month label
+	# or a list of month labels
+	def month_selector(self, months):
+		if (isinstance(months, int)):
+			return(slice(0, months))
+		if (isinstance(months, (list, tuple, set))):
+			return(contiguous(np.array([self.months.index(m) for m in months], dtype = np.int64)))
+		index = self.months.index(months)
+		return(slice(index, index + 1))
+
+	# Window of one metric layer as an entity x location x month array.  Each selector may be None (everything), a slice
+	# or an index array as returned by the selector methods.  Windows selected with slices are zero-copy views of the
+	# memory map, while index arrays fall back to a copy.
+	def window(self, layer, entities = None, locations = None, months = None):
+		cube = self.layers[layer]
+		entities = slice(None) if (entities is None) else entities
+		locations = slice(None) if (locations is None) else locations
+		months = slice(None) if (months is None) else months
+		if (all(isinstance(s, slice) for s in [entities, locations, months])):
+			return(cube[entities, locations, months])
+		return(cube[entities][:, locations][:, :, months])
+
+	# Rebuild a window of the cube as a DataFrame in the layout of the original sheet, so it can be passed to any of
+	# the functions in VariantAnalysis and VariantPlots.  Rows come back in their original sheet order.  The whole sheet
+	# is rebuilt with its metric columns as read only views of metrics.npy, so only the label columns are copied.
+	def frame(self, entities = None, locations = None, months = None):
+		whole = (entities is None and locations is None and months is None and self.metrics is not None)
+		entity_index = np.arange(len(self.entities))[slice(None) if (entities is None) else entities]
+		location_index = np.arange(len(self.locations))[slice(None) if (locations is None) else locations]
+		month_labels = np.array(self.months, dtype = object)[slice(None) if (months is None) else months]
+		rows = self.rows[entity_index][:, location_index]
+		e, l = np.nonzero(rows >= 0)
+		order = np.argsort(rows[e, l], kind = 'stable')
+		e = e[order]
+		l = l[order]
+		data = {}
+		metric = 0
+		for column in self.columns:
+			header = split_header(column)
+			if (whole and header is not None):
+				data[column] = self.metrics[:, metric]
+				metric += 1
+			elif (column == self.location_column):
+				data[column] = np.array(self.locations, dtype = object)[location_index[l]]
+			elif (header is None):
+				data[column] = self.entities[column].to_numpy()[entity_index[e]]
+			elif (header[1] in month_labels):
+				data[column] = self.layers[header[0]][entity_index[e], location_index[l], self.months.index(header[1])]
+		return(pd.DataFrame(data, copy = False))
+
+
+# Turn sorted indexes into a slice when they form one contiguous run
+def contiguous(indexes):
+	if (not len(indexes)):
+		return(slice(0, 0))
+	if (np.all(np.diff(indexes) == 1)):
+		return(slice(int(indexes[0]), int(indexes[-1]) + 1))
+	return(indexes)
+
+
+# A directory of cubes built by build_report_cubes(), used in place of an Emerging Variants Report.  It offers the same
+# sheet() and sheets() interface as EmergingVariantsReport, rebuilding sheets from the memory mapped cubes instead of
+# parsing a spreadsheet.  The monthly columns of the sheets are views of the memory maps (see ReportCube.frame()), so
+# processes reading the same cubes share them, and callers must not modify the returned frames in place.
+class ReportCubes:
+
+	def __init__(self, path):
+		self.path = path
+		self.loaded = {}
+
+	def cube(self, name):
+		return(ReportCube(os.path.join(self.path, vd.sheet_slug(name))))
+
+	def sheet(self, name, columns = None):
+		if (name not in self.loaded):
+			if (name == 'SFoCs'):
+				self.loaded[name] = pd.read_pickle(os.path.join(self.path, 'SFoCs.pkl'))
+			elif (os.path.isdir(os.path.join(self.path, vd.sheet_slug(name)))):
+				self.loaded[name] = self.cube(name).frame()
+			else:
+				raise ValueError("Worksheet named '"+name+"' not found in "+self.path)
+		return(vd.select_columns(self.loaded[name], columns))
+
+	def sheets(self, requests):
+		return({name: self.sheet(name, requests[name]) for name in requests})
+
+	# Hash identifying the cubes, from the name, size and modification time of every file in them.  Rebuilding the
+	# cubes changes it.
+	def hash(self):
+		files = []
+		for directory, subdirectories, names in os.walk(self.path):
+			for name in names:
+				stat = os.stat(os.path.join(directory, name))
+				files.append([os.path.relpath(os.path.join(directory, name), self.path), stat.st_size, stat.st_mtime_ns])
+		return(hashlib.sha256(json.dumps(sorted(files)).encode('utf-8')).hexdigest())
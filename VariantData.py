@@ -0,0 +1,425 @@
+import os
+import re
+import json
+import hashlib
+import functools
+import shutil
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+# Parsed sheets are cached as Parquet when pyarrow is installed and as pickles otherwise.  Parquet can also fail on
+# sheets with mixed type object columns (pyarrow raises a ValueError or TypeError subclass), in which case that
+# sheet falls back to a pickle as well.
+try:
+	import pyarrow
+	import pyarrow.csv
+	cache_format = 'parquet'
+except ImportError:
+	pyarrow = None
+	cache_format = 'pickle'
+
+default_cache_dir = '.variants_cache'
+
+
+# Compute the SHA-256 content hash of a file, reading it in blocks so large reports are never held in memory
+def file_hash(file):
+	sha = hashlib.sha256()
+	with open(file, 'rb') as f:
+		for block in iter(lambda: f.read(1 << 20), b''):
+			sha.update(block)
+	return(sha.hexdigest())
+
+
+# Content hash of a file, as file_hash().  Hashing a large report is not free, so with a cache directory the hash is
+# remembered in its hashes.json against the file's path, size and modification time and only recomputed when one of
+# those changes.
+def indexed_hash(file, cache_dir):
+	stat = os.stat(file)
+	key = os.path.abspath(file)+'|'+str(stat.st_size)+'|'+str(stat.st_mtime_ns)
+	index_file = os.path.join(cache_dir, 'hashes.json') if (cache_dir) else None
+	index = {}
+	if (index_file and os.path.exists(index_file)):
+		try:
+			with open(index_file) as f:
+				index = json.load(f)
+		except (OSError, ValueError):
+			index = {}
+	if (key in index):
+		return(index[key])
+	digest = file_hash(file)
+	if (index_file):
+		index = {k: v for k, v in index.items() if (not k.startswith(os.path.abspath(file)+'|'))}
+		index[key] = digest
+		try:
+			os.makedirs(cache_dir, exist_ok = True)
+			with open(index_file + '.tmp', 'w') as f:
+				json.dump(index, f)
+			os.replace(index_file + '.tmp', index_file)
+		except OSError:
+			pass
+	return(digest)
+
+
+# Parse a single sheet straight from the xlsx.  This lives at module level so it can run in a worker process.
+def read_xlsx_sheet(file, name):
+	return(pd.read_excel(file, name))
+
+
+# Select the requested columns of a sheet.  Each entry in columns is either the exact header of a label column such
+# as 'Country', or the name of a monthly metric such as 'Prevalence', which keeps every 'Prevalence - [Month]' column.
+# Passing no columns keeps the whole sheet.
+def select_columns(sheet_df, columns = None):
+	if (columns is None):
+		return(sheet_df)
+	return(sheet_df[[c for c in sheet_df.columns if wanted_column(c, columns)]])
+
+def wanted_column(header, columns):
+	return((header in columns) or (str(header).split(' - ')[0] in columns))
+
+
+# Monthly metrics of the report, each with one 'Metric - YYYY-MM' column per month
+metrics = ['Variant Count', 'Isolates Count', 'Prevalence', 'Growth Rate']
+
+
+# Calendar month of the month part of a metric header, written 'YYYY-MM' or, as the report itself writes it, 'YYYYMM'
+# (e.g. 'Prevalence - 202301'), as a numpy datetime64[M], or None when it is not a month
+def parse_month(text):
+	found = re.fullmatch(r'(\d{4})-?(\d{2})', str(text).strip())
+	if (not found or not 1 <= int(found.group(2)) <= 12):
+		return(None)
+	return(np.datetime64(found.group(1)+'-'+found.group(2), 'M'))
+
+# Metric and calendar month of a 'Metric - Month' header, or None for a label column, including headers whose month
+# does not parse (see parse_month())
+def parse_header(header):
+	parts = str(header).split(' - ', 1)
+	if (len(parts) != 2 or parts[0] not in metrics):
+		return(None)
+	month = parse_month(parts[1])
+	return(None if (month is None) else (parts[0], month))
+
+
+# Parsed layout of a sheet's columns.  Every 'Metric - YYYY-MM' (or 'Metric - YYYYMM') header is parsed once into its
+# metric and calendar month (see parse_header()), the months form a typed time axis (numpy datetime64[M]) ordered from the most recent back, and for every
+# metric an array holds the position of its column for each month of the axis (-1 where the sheet lacks it).  Selecting
+# a window of months is then a slice of the axis and the columns of a metric an index into those arrays, with no
+# scanning of header strings.  Get schemas through report_schema(), which builds each one once.
+class ReportSchema:
+
+	def __init__(self, columns):
+		self.columns = pd.Index(columns)
+		parsed = [parse_header(c) for c in columns]
+		metric_months = {}
+		for position, header in enumerate(parsed):
+			if (header is not None):
+				metric_months.setdefault(header[1], {})[header[0]] = position
+		self.months = np.array(sorted(metric_months, reverse = True), dtype = 'datetime64[M]')
+		self.positions = {metric: np.array([metric_months[m].get(metric, -1) for m in self.months], dtype = np.int64) for metric in metrics}
+		self.labels = [c for c, header in zip(columns, parsed) if (header is None)]
+
+	# Slice of the time axis for a window of months.  The window is either a number of most recent months, as given to
+	# '--interval', or a (first month, last month) pair of 'YYYY-MM' strings, as given to '--from' and '--to', where
+	# either end may be None to leave it open.  None selects every month.
+	def window(self, interval = None):
+		if (interval is None):
+			return(slice(None))
+		if (isinstance(interval, (int, np.integer))):
+			return(slice(0, max(int(interval), 0)))
+		first, last = interval
+		ascending = self.months[::-1]
+		newest = 0 if (last is None) else len(ascending) - int(np.searchsorted(ascending, np.datetime64(last, 'M'), side = 'right'))
+		oldest = len(ascending) if (first is None) else len(ascending) - int(np.searchsorted(ascending, np.datetime64(first, 'M'), side = 'left'))
+		return(slice(newest, max(oldest, newest)))
+
+	# Month labels ('YYYY-MM') of a window, most recent first
+	def month_labels(self, interval = None):
+		return([str(m) for m in np.datetime_as_string(self.months[self.window(interval)], unit = 'M')])
+
+	# Positions of the columns of a metric over a window, most recent month first
+	def indexes(self, metric, interval = None):
+		positions = self.positions[metric][self.window(interval)]
+		return(positions[positions >= 0])
+
+	# Headers of the columns of a metric over a window, most recent month first
+	def metric_columns(self, metric, interval = None):
+		return(self.columns[self.indexes(metric, interval)])
+
+
+# Schema of a sheet with the given columns.  Schemas are cached by the column headers, so filtering a sheet or
+# selecting rows from it reuses the schema built for it.
+def report_schema(columns):
+	return(cached_schema(tuple(columns)))
+
+@functools.lru_cache(maxsize = 128)
+def cached_schema(columns):
+	return(ReportSchema(columns))
+
+# Headers of the columns of a metric in a sheet over a window of months (see ReportSchema.window()), most recent first
+def metric_columns(sheet_df, metric, interval = None):
+	return(report_schema(sheet_df.columns).metric_columns(metric, interval))
+
+
+# Convert a sheet to compact dtypes.  Label columns such as Country, WHO Label, PANGO Lineage and Variant become
+# categoricals, so every distinct label is held once, and numeric columns shrink to the smallest type that holds them:
+# whole numbers without blanks (counts, positions) become the smallest integer type, whole numbers with blanks become
+# float32 when it holds them exactly, and everything else, such as prevalences and growth rates, becomes float32.
+# Columns that already are categoricals are kept as they are.
+def compact_frame(sheet_df):
+	columns = {}
+	for column in sheet_df.columns:
+		values = sheet_df[column]
+		if (isinstance(values.dtype, pd.CategoricalDtype) or pd.api.types.is_bool_dtype(values.dtype)):
+			continue
+		if (not pd.api.types.is_numeric_dtype(values.dtype)):
+			columns[column] = values.astype('category')
+			continue
+		array = values.to_numpy(dtype = float)
+		missing = np.isnan(array)
+		whole = ((array[~missing] == np.round(array[~missing])) & (np.abs(array[~missing]) < 2**24)).all()
+		if (whole and not missing.any()):
+			columns[column] = pd.to_numeric(values, downcast = 'integer')
+		else:
+			columns[column] = values.astype(np.float32)
+	return(sheet_df.assign(**columns))
+
+# Memory used by a DataFrame in bytes, counting the contents of string and object columns
+def frame_memory(sheet_df):
+	return(int(sheet_df.memory_usage(deep = True).sum()))
+
+
+# Turn a sheet name such as 'World - Variants' into a safe file name such as 'World_-_Variants'
+def sheet_slug(sheet):
+	return(''.join(c if (c.isalnum() or c in '-_.') else '_' for c in sheet))
+
+
+# Handle on an Emerging Variants Report.  Sheets are read through sheet(), which parses the xlsx only the first time
+# a sheet is requested and stores it as a columnar file in the cache directory.  The cache is keyed by the content
+# hash of the report and the sheet name, so a report that changes on disk gets a new cache entry and the entries
+# of its previous version are removed.  Later runs against the same report load sheets without touching the xlsx.
+class EmergingVariantsReport:
+
+	def __init__(self, filename, cache_dir = default_cache_dir):
+		self.filename = filename
+		self.cache_dir = cache_dir
+		self.xlsx = None
+		self.digest = None
+		self.loaded = {}
+
+	# Content hash of the report file, remembered for the life of the handle and in the cache directory (see
+	# indexed_hash())
+	def hash(self):
+		if (self.digest is None):
+			self.digest = indexed_hash(self.filename, self.cache_dir)
+		return(self.digest)
+
+	# Directory holding the cached sheets for this version of the report
+	def cache_path(self):
+		return(os.path.join(self.cache_dir, self.hash()[:16]))
+
+	# Return a sheet of the report as a DataFrame, optionally keeping only some of its columns (see select_columns()).
+	# Each sheet is read at most once per process: later requests for the same sheet and columns, or for a sheet
+	# that was already read whole, are answered from memory.  Callers must not modify the returned frame in place.
+	def sheet(self, name, columns = None):
+		memo = self.memoized(name, columns)
+		if (memo is not None):
+			return(memo)
+		sheet_df = self.read_cached(name, columns)
+		if (sheet_df is None):
+			sheet_df = self.read_xlsx(name)
+			self.write_cached(name, sheet_df)
+			sheet_df = select_columns(sheet_df, columns)
+		self.loaded[name] = (columns, sheet_df)
+		return(sheet_df)
+
+	# Read several sheets at once.  The requests map each sheet name to the columns wanted from it (None for all of
+	# them) and the sheets are returned in a dictionary with the same keys.  Cached sheets are loaded in a thread pool,
+	# while sheets that still have to be parsed from the xlsx, which is CPU bound, are parsed in a process pool.
+	def sheets(self, requests):
+		pending = [name for name in requests if (self.memoized(name, requests[name]) is None)]
+		uncached = [name for name in pending if (not self.is_cached(name))]
+		cached = [name for name in pending if (name not in uncached)]
+		if (len(uncached) > 1):
+			with ProcessPoolExecutor(max_workers = len(uncached)) as pool:
+				parsed = list(pool.map(read_xlsx_sheet, [self.filename]*len(uncached), uncached))
+		else:
+			parsed = [self.read_xlsx(name) for name in uncached]
+		for name, sheet_df in zip(uncached, parsed):
+			self.write_cached(name, sheet_df)
+			self.loaded[name] = (requests[name], select_columns(sheet_df, requests[name]))
+		with ThreadPoolExecutor(max_workers = max(len(cached), 1)) as pool:
+			for name, sheet_df in zip(cached, pool.map(lambda n: self.read_cached(n, requests[n]), cached)):
+				self.loaded[name] = (requests[name], sheet_df)
+		return({name: self.sheet(name, requests[name]) for name in requests})
+
+	# Return the in-memory copy of a sheet if one was already read that covers the requested columns
+	def memoized(self, name, columns):
+		if (name not in self.loaded):
+			return(None)
+		loaded_columns, sheet_df = self.loaded[name]
+		if (loaded_columns is None):
+			return(select_columns(sheet_df, columns))
+		if (columns is not None and set(columns) <= set(loaded_columns)):
+			return(select_columns(sheet_df, columns))
+		return(None)
+
+	def is_cached(self, name):
+		if (not self.cache_dir):
+			return(False)
+		base = os.path.join(self.cache_path(), sheet_slug(name))
+		return(os.path.exists(base + '.parquet') or os.path.exists(base + '.pkl'))
+
+	def read_xlsx(self, name):
+		if (self.xlsx is None):
+			self.xlsx = pd.ExcelFile(self.filename)
+		return(pd.read_excel(self.xlsx, name))
+
+	# Load a sheet from the cache, or return None if it has not been cached yet.  Parquet files are read column
+	# pruned, so only the requested columns are ever decoded.
+	def read_cached(self, name, columns = None):
+		if (not self.cache_dir):
+			return(None)
+		base = os.path.join(self.cache_path(), sheet_slug(name))
+		if (os.path.exists(base + '.parquet')):
+			if (columns is None):
+				return(pd.read_parquet(base + '.parquet'))
+			import pyarrow.parquet
+			headers = pyarrow.parquet.read_schema(base + '.parquet').names
+			return(pd.read_parquet(base + '.parquet', columns = [c for c in headers if wanted_column(c, columns)]))
+		if (os.path.exists(base + '.pkl')):
+			return(select_columns(pd.read_pickle(base + '.pkl'), columns))
+		return(None)
+
+	# Write a parsed sheet to the cache.  Files are written under a temporary name and renamed into place so
+	# an interrupted run never leaves a truncated cache entry behind.  Failing to write the cache is not fatal.
+	def write_cached(self, name, sheet_df):
+		if (not self.cache_dir):
+			return
+		path = self.cache_path()
+		base = os.path.join(path, sheet_slug(name))
+		try:
+			if (not os.path.isdir(path)):
+				self.prune_cache()
+				os.makedirs(path)
+				with open(os.path.join(path, 'source.txt'), 'w') as f:
+					f.write(os.path.abspath(self.filename))
+			if (cache_format == 'parquet'):
+				try:
+					sheet_df.to_parquet(base + '.parquet.tmp', index = False)
+					os.replace(base + '.parquet.tmp', base + '.parquet')
+					return
+				except (ValueError, TypeError):
+					if (os.path.exists(base + '.parquet.tmp')):
+						os.remove(base + '.parquet.tmp')
+			sheet_df.to_pickle(base + '.pkl.tmp')
+			os.replace(base + '.pkl.tmp', base + '.pkl')
+		except OSError as e:
+			print("WARNING! Could not write the sheet cache for '"+name+"' ("+str(e)+"). Continuing without it.")
+
+	# Remove cache entries left over from earlier versions of this same report file
+	def prune_cache(self):
+		if (not os.path.isdir(self.cache_dir)):
+			return
+		source = os.path.abspath(self.filename)
+		for entry in os.listdir(self.cache_dir):
+			source_file = os.path.join(self.cache_dir, entry, 'source.txt')
+			if (os.path.exists(source_file)):
+				with open(source_file) as f:
+					if (f.read().strip() == source):
+						shutil.rmtree(os.path.join(self.cache_dir, entry), ignore_errors = True)
+
+
+# Size of the chunks a delimited export is streamed in: blocks of bytes when pyarrow reads it, and rows otherwise.
+# Only one chunk of the full width of the file is in memory at once.
+delimited_block_size = 1 << 20
+delimited_chunk_rows = 50000
+delimited_extensions = ['.txt', '.tsv', '.csv']
+
+
+# Name of the report sheet a flat export holds, told apart by its columns
+def delimited_sheet_name(columns):
+	if ('Region' in columns):
+		return('USA - Variants' if ('Variant' in columns) else 'USA - Lineages')
+	if ('Position' in columns):
+		return('AA Mutations')
+	return('World - Variants' if ('Variant' in columns) else 'World - Lineages')
+
+
+# Handle on a flat TSV (.txt/.tsv) or CSV (.csv) export of one sheet of an Emerging Variants Report, such as
+# July_2023_World_Variants.txt, used in place of the xlsx.  It offers the same sheet() and sheets() interface as
+# EmergingVariantsReport for the one sheet it holds.  The export is streamed in chunks: only the requested columns are
+# parsed, blank WHO Label and Classification values are filled with 'Unassigned' (as FixWhoBlanks.ipynb does), and
+# rows are filtered as they are read, so memory is bounded by one chunk plus the rows kept.  keep maps a column to the
+# values of it to keep (e.g. {'WHO Label': ['Omicron']}), drop maps a column to values to leave out (e.g.
+# {'Country': ['All', 'Unknown']}), and with min_count only rows whose first month Variant Count is above it are kept.
+# Filters on columns the export does not have are ignored.  The export is parsed with pyarrow's streaming CSV reader
+# when pyarrow is installed and with pandas otherwise, both reading numbers exactly as the xlsx holds them.
+class DelimitedReport:
+
+	def __init__(self, filename, keep = {}, drop = {}, min_count = None, chunk_rows = delimited_chunk_rows, cache_dir = default_cache_dir):
+		self.filename = filename
+		self.cache_dir = cache_dir
+		self.digest = None
+		self.keep = keep
+		self.drop = drop
+		self.min_count = min_count
+		self.chunk_rows = chunk_rows
+		self.sep = ',' if (filename.lower().endswith('.csv')) else '\t'
+		self.header = list(pd.read_csv(filename, sep = self.sep, nrows = 0).columns)
+		self.name = delimited_sheet_name(self.header)
+		self.loaded = {}
+
+	# Content hash of the export, remembered as EmergingVariantsReport.hash() does
+	def hash(self):
+		if (self.digest is None):
+			self.digest = indexed_hash(self.filename, self.cache_dir)
+		return(self.digest)
+
+	# Columns of the export to parse for the requested columns, plus those the row filters look at
+	def usecols(self, columns):
+		first_count = list(report_schema(self.header).metric_columns('Variant Count', 1))
+		filtered = [c for c in list(self.keep) + list(self.drop) if (c in self.header)] + (first_count if (self.min_count is not None) else [])
+		return([c for c in self.header if ((columns is None or wanted_column(c, columns)) or c in filtered)])
+
+	# Stream the given columns of the export as DataFrame chunks.  With pyarrow, label columns are always read as strings
+	# and prevalences and growth rates as floats, so blocks agree on their types whatever values come first, while
+	# counts and positions keep the integer type they are inferred as.
+	def chunks(self, usecols):
+		if (pyarrow is None):
+			yield from pd.read_csv(self.filename, sep = self.sep, usecols = usecols, chunksize = self.chunk_rows, float_precision = 'round_trip')
+			return
+		types = {c: pyarrow.float64() if (str(c).startswith(('Prevalence', 'Growth Rate'))) else pyarrow.string() for c in usecols if (not str(c).startswith(('Variant Count', 'Isolates Count', 'Position')))}
+		reader = pyarrow.csv.open_csv(self.filename, read_options = pyarrow.csv.ReadOptions(block_size = delimited_block_size), parse_options = pyarrow.csv.ParseOptions(delimiter = self.sep), convert_options = pyarrow.csv.ConvertOptions(include_columns = usecols, column_types = types, strings_can_be_null = True))
+		for batch in reader:
+			yield(batch.to_pandas())
+
+	# Fill blanks and apply the row filters to one chunk of the export
+	def filter_chunk(self, chunk):
+		for column in ['WHO Label', 'Classification']:
+			if (column in chunk.columns):
+				chunk[column] = chunk[column].fillna('Unassigned')
+		rows = np.ones(len(chunk), dtype = bool)
+		for column, values in self.keep.items():
+			if (column in chunk.columns):
+				rows &= chunk[column].isin(values).to_numpy()
+		for column, values in self.drop.items():
+			if (column in chunk.columns):
+				rows &= ~chunk[column].isin(values).to_numpy()
+		first_count = metric_columns(chunk, 'Variant Count', 1)
+		if (self.min_count is not None and len(first_count)):
+			rows &= (chunk[first_count[0]] > self.min_count).to_numpy()
+		return(chunk[rows])
+
+	def sheet(self, name, columns = None):
+		if (name != self.name):
+			raise ValueError("Worksheet named '"+name+"' not found in "+self.filename+", which holds '"+self.name+"'")
+		if (name not in self.loaded or not (self.loaded[name][0] is None or (columns is not None and set(columns) <= set(self.loaded[name][0])))):
+			usecols = self.usecols(columns)
+			chunks = [self.filter_chunk(chunk) for chunk in self.chunks(usecols)]
+			sheet_df = pd.concat(chunks, ignore_index = True) if (chunks) else pd.DataFrame(columns = usecols)
+			self.loaded[name] = (columns, sheet_df)
+		return(select_columns(self.loaded[name][1], columns))
+
+	# Read the requested sheets the export holds.  Sheets it does not hold are left out of the returned dictionary.
+	def sheets(self, requests):
+		return({name: self.sheet(name, requests[name]) for name in requests if (name == self.name)})
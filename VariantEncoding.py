@@ -0,0 +1,129 @@
+import re
+import threading
+import numpy as np
+import pandas as pd
+
+# Residue codes used in the compact covariant encoding.  Residues outside this alphabet get the next free code the
+# first time they are seen.
+residue_alphabet = 'ACDEFGHIKLMNPQRSTVWY-*X'
+
+
+# Clean a covariant string into its canonical comma separated form, e.g. "T19I, L24-, P25-," -> "T19I,L24-,P25-".
+# Covariant lists pasted from spreadsheets often carry spaces, stray 'Ê' characters and trailing commas between the
+# mutations, so empty mutations are dropped.
+def canonical_covariant(covariant):
+	return(','.join(m for m in covariant.replace(' ', '').replace('Ê', '').split(',') if (m)))
+
+
+# Interned store of covariants.  Every distinct mutation (e.g. 'L24-') gets an integer ID in a shared vocabulary with
+# its residue position (int16) and mutated residue code (uint8), and every distinct covariant gets a stable integer ID
+# and is stored once as the array of its mutation IDs (a CSR layout of offsets into one flat member array).  Covariant
+# strings are parsed a single time, when first added, and everything else works on the integer IDs.  Encoding and the
+# flat views are guarded by a lock, so threads can encode new covariants while others score ones already stored.
+class CovariantStore:
+
+	def __init__(self):
+		self.mutations = []
+		self.mutation_ids = {}
+		self.positions = []
+		self.residues = []
+		self.residue_codes = {r: i for i, r in enumerate(residue_alphabet)}
+		self.covariants = []
+		self.covariant_ids = {}
+		self.raw_ids = {}
+		self.members = []
+		self.arrays = None
+		self.lock = threading.RLock()
+
+	def __len__(self):
+		return(len(self.covariants))
+
+	# Return the ID of a mutation, adding it to the vocabulary if needed.  Raises a ValueError for a mutation without a
+	# single residue position, such as two mutations run together by a separator other than a comma.
+	def mutation_id(self, mutation):
+		if (mutation not in self.mutation_ids):
+			numbers = re.findall(r'[0-9]+', mutation)
+			if (len(numbers) != 1):
+				raise ValueError("Invalid mutation '"+mutation+"': every mutation needs one residue position, e.g. T19I, and the mutations of a covariant are separated by commas")
+			position = int(numbers[0])
+			if (position > np.iinfo(np.int16).max):
+				raise ValueError("Residue position out of range in mutation '"+mutation+"'")
+			residue = re.sub(r'[0-9]+', '', mutation)[-1:]
+			if (residue not in self.residue_codes):
+				self.residue_codes[residue] = len(self.residue_codes)
+			self.mutation_ids[mutation] = len(self.mutations)
+			self.mutations.append(mutation)
+			self.positions.append(position)
+			self.residues.append(self.residue_codes[residue])
+		return(self.mutation_ids[mutation])
+
+	# Return the ID of a covariant string, adding it to the store if needed.  Strings that only differ by the
+	# clean up in canonical_covariant() share an ID, and an empty string is the covariant without mutations.
+	def add(self, covariant):
+		if (covariant in self.raw_ids):
+			return(self.raw_ids[covariant])
+		canonical = canonical_covariant(covariant)
+		if (canonical not in self.covariant_ids):
+			members = np.array([self.mutation_id(m) for m in canonical.split(',') if (m)], dtype = np.int32)
+			self.covariant_ids[canonical] = len(self.covariants)
+			self.covariants.append(canonical)
+			self.members.append(members)
+			self.arrays = None
+		self.raw_ids[covariant] = self.covariant_ids[canonical]
+		return(self.raw_ids[covariant])
+
+	# Encode a column or list of covariant strings as an array of covariant IDs, with -1 for missing values.
+	# Each distinct string is only looked up once, however often it repeats.
+	def encode(self, values):
+		if (isinstance(values, pd.Series) and isinstance(values.dtype, pd.CategoricalDtype)):
+			codes = values.cat.codes.to_numpy()
+			uniques = values.cat.categories
+		else:
+			codes, uniques = pd.factorize(pd.Series(values, dtype = object))
+		with self.lock:
+			ids = np.array([self.add(u) for u in uniques] + [-1], dtype = np.int32)
+		return(ids[codes])
+
+	# Encode a column of covariant strings as a categorical whose categories are the store's canonical covariants,
+	# so its codes are the covariant IDs and each distinct string is held in memory only once
+	def categorical(self, values):
+		ids = self.encode(values)
+		index = values.index if (isinstance(values, pd.Series)) else None
+		return(pd.Series(pd.Categorical.from_codes(ids, categories = list(self.covariants)), index = index, name = getattr(values, 'name', None)))
+
+	# Canonical strings of a column or list of covariants, with missing values kept as NaN
+	def canonical(self, values):
+		ids = self.encode(values)
+		strings = np.array(self.covariants + [np.nan], dtype = object)
+		return(pd.Series(strings[ids], index = values.index if (isinstance(values, pd.Series)) else None))
+
+	# Flat numpy views of the store: per-mutation positions and residue codes, and the CSR offsets and members of
+	# every covariant.  Rebuilt only after new covariants have been added.
+	def flat(self):
+		with self.lock:
+			if (self.arrays is None):
+				lengths = np.array([len(m) for m in self.members], dtype = np.int64)
+				offsets = np.zeros(len(self.members) + 1, dtype = np.int64)
+				np.cumsum(lengths, out = offsets[1:])
+				members = np.concatenate(self.members) if (self.members) else np.zeros(0, dtype = np.int32)
+				self.arrays = (np.array(self.positions, dtype = np.int16), np.array(self.residues, dtype = np.uint8), offsets, members)
+			return(self.arrays)
+
+	# Gather the mutations of the given covariant IDs.  Returns the owning index (into ids) of every gathered
+	# mutation, and the mutation IDs, positions and residue codes, all in covariant order.
+	def gather(self, ids):
+		positions, residues, offsets, members = self.flat()
+		ids = np.asarray(ids, dtype = np.int64)
+		lengths = offsets[ids + 1] - offsets[ids]
+		owner = np.repeat(np.arange(len(ids)), lengths)
+		starts = np.repeat(offsets[ids] - (np.cumsum(lengths) - lengths), lengths)
+		mutation_ids = members[np.arange(len(owner)) + starts]
+		return(owner, mutation_ids, positions[mutation_ids], residues[mutation_ids])
+
+	# Mutation strings of a covariant ID
+	def mutations_of(self, covariant_id):
+		return([self.mutations[m] for m in self.members[covariant_id]])
+
+
+# Store shared by the whole process, so a covariant is parsed once no matter how many frames or functions see it
+covariant_store = CovariantStore()
@@ -0,0 +1,246 @@
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+import VariantData as vd
+import VariantCube as vc
+import VariantProfile as vpr
+
+# File listing the reports ingested into a history store, which also marks a directory as one
+history_file = 'history.json'
+
+
+# Whether a directory is a history store rather than a directory of cubes (see VariantCube.build_report_cubes())
+def is_history(path):
+	return(os.path.isfile(os.path.join(path, history_file)))
+
+# Date a report is filed under in a history store: the date given, else a YYYY-MM-DD date in the report's file name,
+# else the day the file was last modified
+def report_date(file, date = None):
+	if (date):
+		return(date)
+	found = re.search(r'[0-9]{4}-[0-9]{2}-[0-9]{2}', os.path.basename(os.path.normpath(file)))
+	if (found):
+		return(found.group(0))
+	return(time.strftime('%Y-%m-%d', time.localtime(os.path.getmtime(file))))
+
+
+# Write one sheet of a report into a directory as the cells it holds.  Every row of the sheet is an entity (a distinct
+# combination of its label columns other than Country/Region, kept in entities.pkl) in a location (locations.json),
+# stored as their codes in entity.npy and location.npy.  Every row and month with any metric is a cell, and the cells
+# are stored month by month, newest month first: cells.npy holds the row of every cell, starts.npy where the cells of
+# every month begin, and one float64 array per metric the values of the cells, so reading some months of some metrics
+# maps only those runs of those files.  Rows and months without any metric take no space.  Months are keyed by their
+# calendar month ('YYYY-MM'), however the sheet's headers write them (see VariantData.parse_header()).
+def write_sheet(sheet_df, path):
+	schema = vd.report_schema(sheet_df.columns)
+	location_column = [c for c in schema.labels if (c in vc.location_columns)][0]
+	entity_columns = [c for c in schema.labels if (c != location_column)]
+	entity_codes = sheet_df.groupby(entity_columns, dropna = False, sort = False).ngroup().to_numpy()
+	first_rows = pd.Series(np.arange(len(sheet_df))).groupby(entity_codes).first().to_numpy()
+	location_codes, locations = pd.factorize(sheet_df[location_column], use_na_sentinel = False)
+	if (pd.Series(entity_codes * len(locations) + location_codes).duplicated().any()):
+		raise ValueError("Sheet has more than one row for the same entity and "+location_column+", cannot add it to the history store")
+	cells = []
+	values = {layer: [] for layer in vc.layers}
+	for month in range(len(schema.months)):
+		grids = {layer: sheet_df[schema.columns[schema.positions[layer][month]]].to_numpy(dtype = float) if (schema.positions[layer][month] >= 0) else np.full(len(sheet_df), np.nan) for layer in vc.layers}
+		present = np.flatnonzero(~np.all([np.isnan(grid) for grid in grids.values()], axis = 0))
+		cells.append(present)
+		for layer in vc.layers:
+			values[layer].append(grids[layer][present])
+	os.makedirs(path, exist_ok = True)
+	np.save(os.path.join(path, 'entity.npy'), entity_codes.astype(np.int32))
+	np.save(os.path.join(path, 'location.npy'), location_codes.astype(np.int32))
+	np.save(os.path.join(path, 'starts.npy'), np.cumsum([0] + [len(c) for c in cells]).astype(np.int64))
+	np.save(os.path.join(path, 'cells.npy'), np.concatenate(cells + [np.zeros(0, dtype = np.int64)]).astype(np.int32))
+	for layer in vc.layers:
+		np.save(os.path.join(path, vd.sheet_slug(layer) + '.npy'), np.concatenate(values[layer] + [np.zeros(0)]))
+	sheet_df[entity_columns].iloc[first_rows].reset_index(drop = True).to_pickle(os.path.join(path, 'entities.pkl'))
+	vc.write_labels(os.path.join(path, 'locations.json'), list(locations))
+	with open(os.path.join(path, 'meta.json'), 'w') as f:
+		json.dump({'location_column': location_column, 'labels': [str(c) for c in schema.labels], 'months': schema.month_labels()}, f)
+
+
+# One sheet of a report in a history store, see write_sheet().  Opening it reads its small side indexes and memory maps
+# the rest, and the metric arrays are only mapped once asked for.
+class StoredSheet:
+
+	def __init__(self, path):
+		self.path = path
+		with open(os.path.join(path, 'meta.json')) as f:
+			meta = json.load(f)
+		self.location_column = meta['location_column']
+		self.labels = meta['labels']
+		self.months = meta['months']
+		self.entities = pd.read_pickle(os.path.join(path, 'entities.pkl'))
+		self.locations = vc.read_labels(os.path.join(path, 'locations.json'))
+		self.entity = np.load(os.path.join(path, 'entity.npy'), mmap_mode = 'r')
+		self.location = np.load(os.path.join(path, 'location.npy'), mmap_mode = 'r')
+		self.starts = np.load(os.path.join(path, 'starts.npy'))
+		self.cells = np.load(os.path.join(path, 'cells.npy'), mmap_mode = 'r')
+
+	def __len__(self):
+		return(len(self.entity))
+
+	# Rows of the cells of a month (by its position in months), and the values of those cells for the given metrics
+	def month(self, position, metrics):
+		run = slice(int(self.starts[position]), int(self.starts[position + 1]))
+		return(np.asarray(self.cells[run]), {metric: np.asarray(np.load(os.path.join(self.path, vd.sheet_slug(metric) + '.npy'), mmap_mode = 'r')[run]) for metric in metrics})
+
+
+# Write every sheet of a report that main.py works with into a partition directory, one subdirectory per sheet (see
+# write_sheet()), and the SFoCs sheet alongside as a pickle
+def write_partition(variants_report, path):
+	os.makedirs(path, exist_ok = True)
+	for sheet in vc.cube_sheets + ['SFoCs']:
+		try:
+			sheet_df = variants_report.sheet(sheet)
+		except ValueError:
+			continue
+		print("Adding '"+sheet+"' ...")
+		if (sheet == 'SFoCs'):
+			sheet_df.to_pickle(os.path.join(path, 'SFoCs.pkl'))
+		else:
+			write_sheet(sheet_df, os.path.join(path, vd.sheet_slug(sheet)))
+
+
+# Append-only store of every Emerging Variants Report ingested, so trends reach back further than the months a single
+# report holds.  Every report is kept as its own partition under reports/[report date], which is never changed once
+# written: one directory per sheet holding the cells of the sheet (see write_sheet()), keyed by entity, country or
+# region and month.  history.json lists the partitions with the hash of the report each came from.  Partitions are
+# written under a temporary name and renamed into place before the list is replaced, so an interrupted ingest leaves
+# the store as it was.
+#
+# Read through sheet() and sheets() like a report, the store gives every sheet as one frame covering every month of
+# every partition, keyed by entity (the sheet's label columns) and country or region.  Reports revise their most recent
+# months as late sequences come in, so every month of a row is taken from the newest report that lists the row and
+# holds the month.  Only the months and metrics of the columns asked for are read, straight from the memory mapped
+# partitions, and no spreadsheet is opened.
+class ReportHistory:
+
+	def __init__(self, path):
+		self.path = path
+		self.reports = []
+		if (is_history(path)):
+			with open(os.path.join(path, history_file)) as f:
+				self.reports = json.load(f)['reports']
+		self.loaded = {}
+
+	def __len__(self):
+		return(len(self.reports))
+
+	def partition(self, date):
+		return(os.path.join(self.path, 'reports', date))
+
+	# Add a report to the store under its report date.  Returns False without changing anything when the same report is
+	# already stored under that date, and raises a ValueError when a different one is.
+	@vpr.profiled
+	def ingest(self, variants_report, date, source = None):
+		digest = variants_report.hash()
+		for report in self.reports:
+			if (report['date'] == date):
+				if (report['hash'] == digest):
+					return(False)
+				raise ValueError("A different report dated "+date+" is already in the history store, which is append-only. Please give the report its own date with '--report_date'.")
+		temporary = os.path.join(self.path, 'reports', '.'+date+'.tmp')
+		shutil.rmtree(temporary, ignore_errors = True)
+		try:
+			write_partition(variants_report, temporary)
+			os.replace(temporary, self.partition(date))
+		finally:
+			shutil.rmtree(temporary, ignore_errors = True)
+		months = {}
+		for sheet in vc.cube_sheets:
+			if (os.path.isdir(os.path.join(self.partition(date), vd.sheet_slug(sheet)))):
+				months[sheet] = StoredSheet(os.path.join(self.partition(date), vd.sheet_slug(sheet))).months
+		entry = {'date': date, 'source': os.path.basename(os.path.normpath(source)) if (source) else None, 'hash': digest, 'ingested': time.strftime('%Y-%m-%dT%H:%M:%S'), 'months': months}
+		reports = sorted(self.reports + [entry], key = lambda report: report['date'])
+		with open(os.path.join(self.path, history_file + '.tmp'), 'w') as f:
+			json.dump({'reports': reports}, f, indent = 1)
+		os.replace(os.path.join(self.path, history_file + '.tmp'), os.path.join(self.path, history_file))
+		self.reports = reports
+		self.loaded = {}
+		return(True)
+
+	# A sheet in every partition that has it, newest report first
+	def stored(self, name):
+		paths = [os.path.join(self.partition(report['date']), vd.sheet_slug(name)) for report in reversed(self.reports)]
+		return([StoredSheet(path) for path in paths if (os.path.isdir(path))])
+
+	def sheet(self, name, columns = None):
+		if (name not in self.loaded or not (self.loaded[name][0] is None or (columns is not None and set(columns) <= set(self.loaded[name][0])))):
+			if (name == 'SFoCs'):
+				paths = [os.path.join(self.partition(report['date']), 'SFoCs.pkl') for report in reversed(self.reports)]
+				paths = [path for path in paths if (os.path.exists(path))]
+				if (not paths):
+					raise ValueError("Worksheet named '"+name+"' not found in "+self.path)
+				self.loaded[name] = (None, pd.read_pickle(paths[0]))
+			else:
+				stored = self.stored(name)
+				if (not stored):
+					raise ValueError("Worksheet named '"+name+"' not found in "+self.path)
+				self.loaded[name] = (columns, history_frame(stored, columns))
+		return(vd.select_columns(self.loaded[name][1], columns))
+
+	# Read the requested sheets the store holds.  Sheets it does not hold are left out of the returned dictionary.
+	def sheets(self, requests):
+		sheets = {}
+		for name in requests:
+			try:
+				sheets[name] = self.sheet(name, requests[name])
+			except ValueError:
+				continue
+		return(sheets)
+
+	# Hash identifying the reports in the store, which changes with every report ingested
+	def hash(self):
+		return(hashlib.sha256(json.dumps([[report['date'], report['hash']] for report in self.reports]).encode('utf-8')).hexdigest())
+
+
+# One sheet over every month of the given StoredSheets of it (newest report first), in the layout of the sheet with the
+# most recent month first, taking every month of a row from the first of them that lists the row and holds the month.
+# Rows are the distinct entity and location pairs of all of them, in the row order of the newest report followed by the
+# rows only older reports have.  Only the label columns, months and metrics wanted by columns (as in
+# VariantData.select_columns()) are read.
+@vpr.profiled
+def history_frame(stored, columns = None):
+	newest = stored[0]
+	label_columns = newest.labels
+	entity_columns = [c for c in label_columns if (c != newest.location_column)]
+	entities = pd.concat([sheet.entities.reindex(columns = entity_columns) for sheet in stored], ignore_index = True)
+	entity_codes = entities.groupby(entity_columns, dropna = False, sort = False).ngroup().to_numpy()
+	entity_starts = np.cumsum([0] + [len(sheet.entities) for sheet in stored])
+	locations = list(dict.fromkeys(l for sheet in stored for l in sheet.locations))
+	location_index = {location: i for i, location in enumerate(locations)}
+	keys = []
+	for i, sheet in enumerate(stored):
+		location_codes = np.array([location_index[location] for location in sheet.locations], dtype = np.int64)
+		keys.append(entity_codes[entity_starts[i] + np.asarray(sheet.entity)] * len(locations) + location_codes[np.asarray(sheet.location)])
+	codes, keys = pd.factorize(np.concatenate(keys))
+	starts = np.cumsum([0] + [len(sheet) for sheet in stored])
+	first = np.zeros(entity_codes.max() + 1 if (len(entity_codes)) else 0, dtype = np.int64)
+	first[entity_codes[::-1]] = np.arange(len(entity_codes))[::-1]
+	labels = entities.iloc[first[keys // len(locations)]].reset_index(drop = True)
+	labels[newest.location_column] = np.array(locations, dtype = object)[keys % len(locations)]
+
+	months = sorted(set(m for sheet in stored for m in sheet.months), reverse = True)
+	wanted = {month: [layer for layer in vc.layers if (columns is None or vd.wanted_column(layer+' - '+month, columns))] for month in months}
+	values = {(layer, month): np.full(len(keys), np.nan) for month in months for layer in wanted[month]}
+	filled = {month: np.zeros(len(keys), dtype = bool) for month in months}
+	for i, sheet in enumerate(stored):
+		rows = codes[starts[i]:starts[i + 1]]
+		for position, month in enumerate(sheet.months):
+			if (wanted[month]):
+				cells, cell_values = sheet.month(position, wanted[month])
+				take = ~filled[month][rows[cells]]
+				for layer in wanted[month]:
+					values[(layer, month)][rows[cells[take]]] = cell_values[layer][take]
+			filled[month][rows] = True
+	data = {c: labels[c].to_numpy() for c in label_columns if (columns is None or vd.wanted_column(c, columns))}
+	data.update({layer+' - '+month: values[(layer, month)] for month in months for layer in wanted[month]})
+	return(pd.DataFrame(data))
@@ -0,0 +1,160 @@
+import re
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+import VariantData as vd
+import VariantAnalysis as va
+import VariantProfile as vpr
+
+
+# Read a PANGO alias table, mapping alias prefixes to the lineage they stand for, e.g. {'BQ': 'B.1.1.529.5.3.1.1.1'}.
+# Takes the alias_key.json of pango-designation, where recombinants map to a list of their parents and A and B to '',
+# or a two column text file ('BQ<tab>B.1.1.529.5.3.1.1.1', one alias a line, '#' for comments).  Only aliases of a
+# single lineage are kept, so recombinants stay roots of their own.
+def read_aliases(file):
+	with open(file) as f:
+		if (file.endswith('.json')):
+			aliases = json.load(f)
+		else:
+			aliases = dict(re.split(r'[\t,= ]+', line.strip(), maxsplit = 1) for line in f if (line.strip() and not line.startswith('#')))
+	return({alias: full for alias, full in aliases.items() if (isinstance(full, str) and full and full != alias)})
+
+# Expand the alias prefix of a lineage, repeatedly, e.g. 'BQ.1.1' -> 'B.1.1.529.5.3.1.1.1.1.1'
+def expand_lineage(lineage, aliases):
+	for i in range(len(aliases) + 1):
+		head, dot, rest = lineage.partition('.')
+		if (head not in aliases):
+			break
+		lineage = aliases[head] + dot + rest
+	return(lineage)
+
+# Shorten an expanded lineage with the alias of its longest aliased ancestor, e.g. 'B.1.1.529.5.3.1.1.1.1' -> 'BQ.1'
+# given {'BQ': 'B.1.1.529.5.3.1.1.1'}.  Aliases are keyed by the lineage they stand for.
+def compress_lineage(lineage, aliased):
+	parts = lineage.split('.')
+	for k in range(len(parts) - 1, 0, -1):
+		prefix = '.'.join(parts[:k])
+		if (prefix in aliased):
+			return(aliased[prefix]+'.'+'.'.join(parts[k:]))
+	return(lineage)
+
+# Sort key of an expanded lineage that lists every lineage before its sublineages and the sublineages in natural
+# order (BA.2 before BA.10), so every subtree of the hierarchy is one contiguous run
+def hierarchy_key(lineage):
+	return(tuple((0, int(p), '') if (p.isdigit()) else (1, 0, p) for p in lineage.split('.')))
+
+
+# Prefix tree of PANGO lineages.  Every lineage is expanded through the alias table, if one is given, and every
+# ancestor of it by dropping the last part of its name becomes a node too, so BQ.1.1.13 sits under BQ.1.1, BQ.1, BE.1.1.1
+# and so on up to B.  Nodes are held in preorder, which makes the subtree of every node the contiguous run of nodes
+# from itself to end[node], so sums over subtrees are differences of prefix sums.  Nodes are named as the report
+# names them where the report has them, and by their alias otherwise.
+class LineageTree:
+
+	def __init__(self, lineages, aliases = {}):
+		self.aliases = dict(aliases)
+		lineages = sorted(set(str(l) for l in pd.unique(pd.Series(lineages, dtype = object).dropna())))
+		expanded = {l: expand_lineage(l, self.aliases) for l in lineages}
+		nodes = set()
+		for full in expanded.values():
+			parts = full.split('.')
+			nodes.update('.'.join(parts[:k]) for k in range(1, len(parts) + 1))
+		self.full = sorted(nodes, key = hierarchy_key)
+		self.position = {full: i for i, full in enumerate(self.full)}
+		self.depth = np.array([full.count('.') for full in self.full], dtype = np.int64)
+		self.parent = np.array([self.position.get(full.rpartition('.')[0], -1) for full in self.full], dtype = np.int64)
+		self.end = np.arange(1, len(self.full) + 1, dtype = np.int64)
+		for node in range(len(self.full) - 1, -1, -1):
+			if (self.parent[node] >= 0):
+				self.end[self.parent[node]] = max(self.end[self.parent[node]], self.end[node])
+		aliased = {full: alias for alias, full in self.aliases.items()}
+		names = [compress_lineage(full, aliased) for full in self.full]
+		for lineage, full in expanded.items():
+			names[self.position[full]] = lineage
+		self.names = np.array(names, dtype = object)
+		self.lookup = dict(zip(self.full, range(len(self.full))))
+		self.lookup.update({name: i for i, name in enumerate(names)})
+		self.lookup.update({lineage: self.position[full] for lineage, full in expanded.items()})
+
+	def __len__(self):
+		return(len(self.full))
+
+	# Node of a lineage given by its own name, its expanded name or its alias form, or -1 when not in the tree
+	def node(self, lineage):
+		if (lineage in self.lookup):
+			return(self.lookup[lineage])
+		return(self.position.get(expand_lineage(str(lineage), self.aliases), -1))
+
+	# Node of every value of a lineage column, with -1 for missing values and lineages not in the tree
+	def nodes(self, values):
+		codes, uniques = pd.factorize(values)
+		return(np.array([self.node(u) for u in uniques] + [-1], dtype = np.int64)[codes])
+
+	# Name of the node of a lineage, so a lineage can be given by any of its names, or the lineage itself when it is
+	# not in the tree
+	def name(self, lineage):
+		node = self.node(lineage)
+		return(self.names[node] if (node >= 0) else lineage)
+
+	# Names of the lineages of a column that are a lineage or one of its sublineages
+	def subtree(self, lineage, values):
+		node = self.node(lineage)
+		nodes = self.nodes(values)
+		return(pd.unique(values[(nodes >= node) & (nodes < self.end[node])]) if (node >= 0) else pd.unique(values[values == lineage]))
+
+	# Every node paired with every ancestor of it and itself, as two arrays
+	def ancestors(self):
+		nodes = np.arange(len(self.full))
+		ancestors = nodes.copy()
+		pairs = [(nodes, ancestors)]
+		while (len(nodes)):
+			ancestors = self.parent[ancestors]
+			nodes = nodes[ancestors >= 0]
+			ancestors = ancestors[ancestors >= 0]
+			pairs.append((nodes, ancestors))
+		return(np.concatenate([p[0] for p in pairs]), np.concatenate([p[1] for p in pairs]))
+
+	# Key of the alias table the tree was built with, so results rolled up with different tables are told apart
+	def key(self):
+		return(hashlib.sha256(json.dumps(sorted(self.aliases.items())).encode('utf-8')).hexdigest())
+
+
+# Roll a lineages or variants sheet up the lineage tree: one row for every location and every node with a lineage of
+# the location in its subtree, holding the Variant Counts of all rows of the subtree in the location summed month by
+# month.  The Isolates Count is the number of sequences of the location in the month, which every lineage of the
+# location shares, so it is carried over rather than summed.  Prevalence and growth rates are recomputed from the
+# summed counts the way the report computes them (Variant Count over Isolates Count, and Variant Count over the Variant
+# Count of the month before), with months without any count left blank.  The WHO Label of a node is kept where every
+# lineage under it has the same one.  All nodes are summed in one pass: rows are sorted by location and node, and the
+# sum over each subtree is the difference of the cumulative counts at the two ends of its run.
+@vpr.profiled
+def rollup_frame(frame, tree, location_column = 'Country'):
+	schema = vd.report_schema(frame.columns)
+	locations, location_names = pd.factorize(frame[location_column])
+	nodes = tree.nodes(frame['PANGO Lineage'])
+	kept = (locations >= 0) & (nodes >= 0)
+	locations, nodes = locations[kept], nodes[kept]
+	counts, isolates = va.metric_grids(frame[kept], ['Variant Count', 'Isolates Count'])
+	counts = np.nan_to_num(counts.astype(float))
+
+	keys = locations * len(tree) + nodes
+	order = np.argsort(keys, kind = 'stable')
+	keys = keys[order]
+	cumulative = np.zeros((len(keys) + 1, counts.shape[1]))
+	np.cumsum(counts[order], axis = 0, out = cumulative[1:])
+	pairs = np.unique(keys)
+	node_pairs, ancestor_pairs = tree.ancestors()
+	ancestor_of = pd.DataFrame({'node': node_pairs, 'ancestor': ancestor_pairs})
+	groups = pd.DataFrame({'location': pairs // len(tree), 'node': pairs % len(tree)}).merge(ancestor_of, on = 'node')[['location', 'ancestor']].drop_duplicates()
+	groups = groups.sort_values(by = ['location', 'ancestor']).to_numpy()
+	group_locations, group_nodes = groups[:, 0], groups[:, 1]
+	first = np.searchsorted(keys, group_locations * len(tree) + group_nodes, side = 'left')
+	last = np.searchsorted(keys, group_locations * len(tree) + tree.end[group_nodes], side = 'left')
+	summed = cumulative[last] - cumulative[first]
+
+	who = pd.DataFrame({'node': nodes, 'WHO Label': frame['WHO Label'].to_numpy(dtype = object)[kept]}).drop_duplicates().merge(ancestor_of, on = 'node')
+	who = who.groupby('ancestor')['WHO Label'].agg(lambda labels: labels.iloc[0] if (labels.nunique(dropna = False) == 1) else np.nan)
+	columns = {location_column: np.asarray(location_names, dtype = object)[group_locations], 'WHO Label': who.reindex(group_nodes).to_numpy(dtype = object), 'PANGO Lineage': tree.names[group_nodes]}
+	columns.update(va.summed_metrics(schema, summed, va.location_isolates(isolates, locations, len(location_names))[group_locations]))
+	return(pd.DataFrame(columns))
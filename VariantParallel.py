@@ -0,0 +1,142 @@
+import types
+import functools
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+import VariantEncoding as ve
+import VariantProfile as vpr
+
+
+# Whether a column is held in one of the shared numeric blocks: numbers and booleans in plain numpy dtypes, which is
+# every metric column of a report sheet, whether read as is or compacted (see VariantData.compact_frame())
+def is_numeric(dtype):
+	return(isinstance(dtype, np.dtype) and dtype.kind in 'iufb')
+
+
+# Report sheets copied into shared memory once, so every worker of a process pool reads the same copy rather than
+# being sent its own pickled DataFrames.  The numeric columns of a sheet are held as one 2-D block for every dtype,
+# column major so each column is one contiguous run, and every other column as integer codes into its distinct values
+# (the categories of a categorical, with -1 for missing values).  Workers rebuild the sheets from the layout() with
+# attach(): the numeric columns are views of the shared blocks and the label columns are decoded back to their own
+# dtypes, so the frames a worker ranks are the frames read.  The covariant vocabulary goes along, since the Variant
+# categoricals are coded by covariant ID (see main.encode_variants()).  The segments live until close().
+class SharedSheets:
+
+	def __init__(self, sheets):
+		self.segments = []
+		try:
+			self.sheets = {name: self.share(frame) for name, frame in sheets.items()}
+		except BaseException:
+			self.close()
+			raise
+		self.store = (list(ve.covariant_store.mutations), list(ve.covariant_store.covariants))
+
+	# A new shared segment holding a zeroed column major array of the given shape and dtype
+	def allocate(self, shape, dtype):
+		segment = shared_memory.SharedMemory(create = True, size = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1))
+		self.segments.append(segment)
+		array = np.ndarray(shape, dtype = dtype, buffer = segment.buf, order = 'F')
+		array[...] = 0
+		return(segment.name, array)
+
+	# Copy a frame into shared blocks and return its layout: the segment, shape and dtype of every block, which block
+	# and column every column is in, and the dtypes and values needed to decode the label columns
+	def share(self, frame):
+		numeric = {}
+		labels = []
+		for column in frame.columns:
+			if (is_numeric(frame[column].dtype)):
+				numeric.setdefault(frame[column].dtype.str, []).append(column)
+			else:
+				labels.append(column)
+		blocks = []
+		columns = {}
+		for dtype, names in numeric.items():
+			name, block = self.allocate((len(frame), len(names)), dtype)
+			for j, column in enumerate(names):
+				block[:, j] = frame[column].to_numpy()
+				columns[column] = (len(blocks), j, None)
+			blocks.append((name, block.shape, dtype))
+		if (labels):
+			name, block = self.allocate((len(frame), len(labels)), np.int32)
+			for j, column in enumerate(labels):
+				values = frame[column]
+				if (isinstance(values.dtype, pd.CategoricalDtype)):
+					block[:, j] = values.cat.codes.to_numpy()
+					decode = values.dtype
+				else:
+					block[:, j], decode = pd.factorize(values.array)
+				columns[column] = (len(blocks), j, decode)
+			blocks.append((name, block.shape, np.dtype(np.int32).str))
+		return({'blocks': blocks, 'columns': [(column, columns[column]) for column in frame.columns], 'index': frame.index})
+
+	# Everything a worker needs to attach to the sheets, see attach()
+	def layout(self):
+		return({'sheets': self.sheets, 'store': self.store})
+
+	def close(self):
+		for segment in self.segments:
+			segment.close()
+			segment.unlink()
+		self.segments = []
+
+
+# Rebuild the sheets of a SharedSheets layout in a worker.  The covariant store is filled in the order of the process
+# that shared the sheets first if the worker did not inherit it, so covariant and mutation IDs are the same in every
+# process.  Returns the sheets and the segments they are views of, which must be kept open as long as the sheets are
+# used.  The shared blocks are read only, so no worker can change the sheets under the others.
+def attach(layout):
+	mutations, covariants = layout['store']
+	store = ve.covariant_store
+	if (len(store) < len(covariants)):
+		for mutation in mutations:
+			store.mutation_id(mutation)
+		for covariant in covariants:
+			store.add(covariant)
+	segments = []
+	sheets = {}
+	for sheet, frame_layout in layout['sheets'].items():
+		blocks = []
+		for name, shape, dtype in frame_layout['blocks']:
+			segment = shared_memory.SharedMemory(name = name)
+			segments.append(segment)
+			block = np.ndarray(shape, dtype = dtype, buffer = segment.buf, order = 'F')
+			block.flags.writeable = False
+			blocks.append(block)
+		columns = {}
+		for column, (block, j, decode) in frame_layout['columns']:
+			values = blocks[block][:, j]
+			if (isinstance(decode, pd.CategoricalDtype)):
+				values = pd.Categorical.from_codes(values, dtype = decode)
+			elif (decode is not None):
+				values = decode.take(values, allow_fill = True)
+			columns[column] = values
+		sheets[sheet] = pd.DataFrame(columns, index = frame_layout['index'], copy = False)
+	return(sheets, segments)
+
+
+# What a worker of map_shared() attached to: the segments of the shared sheets and the context its setup built
+worker = types.SimpleNamespace(segments = [], context = None)
+
+def initialize(layout, setup):
+	sheets, worker.segments = attach(layout)
+	worker.context = setup(sheets) if (setup) else sheets
+
+def call(function, item):
+	return(function(item, worker.context))
+
+
+# Call function(item, context) for every item in a pool of processes that share the sheets given (a dictionary of
+# DataFrames), where context is what setup(sheets) returns, built once in every worker, or the sheets themselves
+# without a setup.  The sheets are copied into shared memory once, and only the items, the results and the layout of
+# the sheets pass between processes.  Returns the results in the order of the items.  The function and setup must be
+# picklable, i.e. defined at the top level of a module (or partials of such functions).
+@vpr.profiled
+def map_shared(function, items, sheets, processes = None, setup = None):
+	shared = SharedSheets(sheets)
+	try:
+		with ProcessPoolExecutor(max_workers = processes, initializer = initialize, initargs = (shared.layout(), setup)) as pool:
+			return(list(pool.map(functools.partial(call, function), items)))
+	finally:
+		shared.close()
@@ -1,19 +1,71 @@
+import sys
 import pandas as pd
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
 from matplotlib.pyplot import cm
 import seaborn as sns
 from functools import reduce
 from operator import itemgetter
+import VariantEncoding as ve
+import VariantData as vd
+import VariantProfile as vpr
 
+# Every plot function asks for its graph type and shows the figure in a window, unless it is given a graph_type and an
+# output file, in which case it runs without any prompt and saves the figure.  The format of a saved figure follows the
+# extension of its file name (.png, .svg or .pdf).
+graph_formats = ['png', 'svg', 'pdf']
+
+# Graph types every plot function can draw.  plot_covariants() only draws the proportion of covariants ranked from the
+# report, not of inputted ones.
+plot_graph_types = {'plot_mutations': ['prevalence', 'growth'], 'plot_covariants': ['prevalence', 'growth', 'proportion'], 'plot_single_lineage': ['prevalence', 'growth'], 'plot_lineages': ['prevalence', 'growth']}
+
+# Window of months every plot function draws unless it is given one, such as the window of the ranking it graphs: the 6
+# most recent months.  A window is a number of most recent months or a (first month, last month) pair of 'YYYY-MM'
+# strings, see VariantData.ReportSchema.window().
+default_window = 6
+
+
+# Graph types a plot function can draw, for inputted covariants or not
+def figure_graph_types(function, inputted = False):
+	return([t for t in plot_graph_types[function] if (not (t == 'proportion' and inputted))])
+
+
+# Show the current figure, or save it to output and close it
+def show_figure(output = None):
+	if (output):
+		plt.savefig(output, bbox_inches = 'tight')
+		plt.close()
+	else:
+		plt.show()
+
+
+# Render one figure to a file.  A figure is given as the name of one of the plot functions in this module with its
+# positional and keyword arguments, which must include graph_type and output.  Renders with the non-GUI Agg backend,
+# so this works on machines without a display, and lives at module level so it can run in a worker process.
+def render_figure(figure):
+	function, args, kwargs = figure
+	plt.switch_backend('Agg')
+	getattr(sys.modules[__name__], function)(*args, **kwargs)
+	return(kwargs['output'])
+
+# Render several figures to files, in parallel in a process pool when there is more than one.  Returns the files
+# written, in the order the figures were given.
+def render_figures(figures, processes = None):
+	if (len(figures) > 1):
+		with ProcessPoolExecutor(max_workers = processes) as pool:
+			return(list(pool.map(render_figure, figures)))
+	return([render_figure(figure) for figure in figures])
 
 
 
 # This function is meant to plot the prevalence ratios (as stacked plot) or the growth rate trends of single amino acid
 # point mutations either in a user specified domain (NTD, RBD, other), the entire spike protein, or a user inputted list.
-# For simplicity, this will only plot the 10 mutations with the highest prevalence or growth rates accross the past 6 months
-def plot_mutations(variant_df, region, domain, mutations = []):
-	graph_type = input("Plot the changes over time of the mutation's prevalence or growth rate in "+region+"? [prevalence/growth]: ")
+# For simplicity, this will only plot the 10 mutations with the highest prevalence or growth rates accross the window of
+# months given, the past 6 months by default
+def plot_mutations(variant_df, region, domain, mutations = [], graph_type = None, output = None, window = default_window):
+	if (graph_type is None):
+		graph_type = input("Plot the changes over time of the mutation's prevalence or growth rate in "+region+"? [prevalence/growth]: ")
 	if (mutations):
 		variant_df = variant_df[(variant_df['Variant'].isin(mutations))]
 	if (domain == "NTD"):
@@ -25,7 +77,7 @@ def plot_mutations(variant_df, region, domain, mutations = []):
 		domain = "'Other Domain'"
 
 	if (graph_type == 'prevalence'):
-		recent_prevalence = variant_df[variant_df.columns[pd.Series(variant_df.columns).str.startswith('Prevalence')]].iloc[:,:6]
+		recent_prevalence = variant_df[vd.metric_columns(variant_df, 'Prevalence', window)]
 		recent_prevalence = recent_prevalence.fillna(0)
 		mutation_prevalence_df = pd.concat([pd.DataFrame({'Variant': variant_df['Variant']}), recent_prevalence], axis = 1)
 		mutation_prevalence_df = mutation_prevalence_df.reindex(sorted(mutation_prevalence_df.columns), axis = 1)
@@ -42,10 +94,10 @@ def plot_mutations(variant_df, region, domain, mutations = []):
 		plt.xlabel('Year and Month')
 		plt.ylabel('Mutation Prevalence Ratio (Mutation Count/Isolates Count)')
 		plt.legend(loc = 'upper center', bbox_to_anchor = (0.5, 1.10), ncol = 5, fancybox = True, shadow = True)
-		plt.show()
+		show_figure(output)
 
 	elif (graph_type == 'growth'):
-		recent_growth_rate = variant_df[variant_df.columns[pd.Series(variant_df.columns).str.startswith('Growth Rate')]].iloc[:,:6]
+		recent_growth_rate = variant_df[vd.metric_columns(variant_df, 'Growth Rate', window)]
 		recent_growth_rate = recent_growth_rate.fillna(0)
 		mutation_growth_df = pd.concat([pd.DataFrame({'Variant': variant_df['Variant']}), recent_growth_rate], axis = 1)
 		mutation_growth_df = mutation_growth_df.reindex(sorted(mutation_growth_df.columns), axis = 1)
@@ -62,7 +114,7 @@ def plot_mutations(variant_df, region, domain, mutations = []):
 		plt.xlabel('Year and Month')
 		plt.ylabel('Growth Rate')
 		plt.legend(loc = 'upper center', bbox_to_anchor = (0.5, 1.10), ncol = 5, fancybox = True, shadow = True)
-		plt.show()
+		show_figure(output)
 	else:
 		sys.exit("Invalid graph type entry. Please try again and correctly specify the appropriate graph type (prevalence or growth)")
 
@@ -73,36 +125,36 @@ def plot_mutations(variant_df, region, domain, mutations = []):
 # by the pango lineage.  Since in those cases mentioned the covariants we wish to plot are duplicated, the prevalence
 # and growth rate dynamics need to be recalculated to reflect the sum of all variant counts for that particular
 # covariant.
-def plot_covariants_help(variant_df, covariants):
+@vpr.profiled
+def plot_covariants_help(variant_df, covariants, window = default_window):
 	
 	def div(x, y):
 		if y == 0:
 			return 0
 		return x/y	
 
-	prevalence_cols = variant_df[variant_df.columns[pd.Series(variant_df.columns).str.startswith('Prevalence')]].iloc[:,:6]
-	prevalence_cols = prevalence_cols.columns
-	growth_cols = variant_df[variant_df.columns[pd.Series(variant_df.columns).str.startswith('Growth Rate')]].iloc[:,:6]
-	growth_cols = growth_cols.columns
-	variant_cols = variant_df[variant_df.columns[pd.Series(variant_df.columns).str.startswith('Variant Count')]].iloc[:,:6]
-	variant_cols = variant_cols.columns
+	# The growth rate of the oldest month of the window needs the prevalence of the month before it
+	schema = vd.report_schema(variant_df.columns)
+	months = np.arange(len(schema.months))[schema.window(window)]
+	counted = np.concatenate([months, months[-1:] + 1]) if (len(months) and months[-1] + 1 < len(schema.months)) else months
+	prevalence_cols = schema.columns[schema.positions['Prevalence'][months]]
+	growth_cols = schema.columns[schema.positions['Growth Rate'][months]]
+	variant_cols = schema.columns[schema.positions['Variant Count'][months]]
+	covariant_ids = ve.covariant_store.encode(variant_df['Variant'])
 	new_data = []
-	for cov in covariants:
-		cov_df = variant_df[(variant_df['Variant'] == cov)]
-		isolates = cov_df[cov_df.columns[pd.Series(cov_df.columns).str.startswith('Isolates Count')]].iloc[:,:7].head(1)
+	for cov, cov_id in zip(covariants, ve.covariant_store.encode(covariants)):
+		cov_df = variant_df[(covariant_ids == cov_id)]
+		isolates = cov_df.iloc[:, schema.positions['Isolates Count'][counted]].head(1)
 		isolates = isolates.iloc[0].values.tolist()
-		variants = cov_df[cov_df.columns[pd.Series(cov_df.columns).str.startswith('Variant Count')]].iloc[:,:7]
+		variants = cov_df.iloc[:, schema.positions['Variant Count'][counted]]
 		variants = variants.fillna(0)
 		variants.loc['Variant Total'] = variants.sum()
 		count_sums = variants.loc['Variant Total'].values.tolist()
 		cov_prevalence = [i / j for i, j in zip(count_sums, isolates)]
-		prevalence_data = pd.DataFrame({'Variant': cov, prevalence_cols[5]: [cov_prevalence[5]], prevalence_cols[4]: [cov_prevalence[4]], prevalence_cols[3]: [cov_prevalence[3]], 
-			prevalence_cols[2]: [cov_prevalence[2]], prevalence_cols[1]: [cov_prevalence[1]], prevalence_cols[0]: [cov_prevalence[0]]})
-		growth_data = pd.DataFrame({'Variant': cov, growth_cols[5]: [div(cov_prevalence[5], cov_prevalence[6])], growth_cols[4]: [div(cov_prevalence[4],cov_prevalence[5])], 
-			growth_cols[3]: [div(cov_prevalence[3],cov_prevalence[4])], growth_cols[2]: [div(cov_prevalence[2],cov_prevalence[3])], growth_cols[1]: [div(cov_prevalence[1],cov_prevalence[2])], 
-			growth_cols[0]: [div(cov_prevalence[0],cov_prevalence[1])]})
-		variant_data = pd.DataFrame({'Variant': cov, variant_cols[5]: [count_sums[5]], variant_cols[4]: [count_sums[4]], variant_cols[3]: [count_sums[3]], 
-			variant_cols[2]: [count_sums[2]], variant_cols[1]: [count_sums[1]], variant_cols[0]: [count_sums[0]]})
+		earlier = cov_prevalence[1:] + [np.nan] * (len(months) + 1 - len(cov_prevalence))
+		prevalence_data = pd.DataFrame({'Variant': cov, **{prevalence_cols[k]: [cov_prevalence[k]] for k in reversed(range(len(months)))}})
+		growth_data = pd.DataFrame({'Variant': cov, **{growth_cols[k]: [div(cov_prevalence[k], earlier[k])] for k in reversed(range(len(months)))}})
+		variant_data = pd.DataFrame({'Variant': cov, **{variant_cols[k]: [count_sums[k]] for k in reversed(range(len(months)))}})
 		data_frames = [prevalence_data, growth_data, variant_data]
 		data = reduce(lambda left, right: pd.merge(left, right, on = ['Variant'], how = 'outer'), data_frames)
 		new_data.append(data)
@@ -116,36 +168,37 @@ def plot_covariants_help(variant_df, covariants):
 # or composite ranking) or be user inputted.  For the sake of simplicity, the functional will only allow plotting maximum 10
 # covariants at a time.  This function also offers the option to plot how the proportions of covariants that make up a lineage or a
 # WHO clade change overtime.
-def plot_covariants(variant_df, covariants, region, who = "", pango = "", name = {}, inputted = False):
-	if (inputted):
+def plot_covariants(variant_df, covariants, region, who = "", pango = "", name = {}, inputted = False, graph_type = None, output = None, window = default_window):
+	if (graph_type is None and inputted):
 		graph_type = input('Plot the change over time of covariant prevalence, growth rate, or proportion within the inputted list of covariants? [prevalence/growth]: ')
-	else:
+	elif (graph_type is None):
 		graph_type = input('Plot the change over time of covariant prevalence, growth rate, or proportion within the PANGO/WHO clade? [prevalence/growth/proportion]: ')
 	
 	# Safety --- only allow potential plotting of covariants actually in the data file if supplying user list
-	covariants = variant_df[(variant_df['Variant'].isin(covariants))]
-	covariants = covariants.drop_duplicates(subset = ['Variant'])
-	covariants = list(covariants['Variant'])
+	covariant_ids = ve.covariant_store.encode(variant_df['Variant'])
+	selected = np.isin(covariant_ids, ve.covariant_store.encode(covariants)) & (covariant_ids >= 0)
+	first_rows = np.unique(covariant_ids[selected], return_index = True)[1]
+	covariants = list(variant_df['Variant'][selected].iloc[np.sort(first_rows)])
 
 	if (pango):
 		variant_df = variant_df[(variant_df['PANGO Lineage'] == pango)]
 		variant_type = pango
 	elif (who):
 		variant_df = variant_df[(variant_df['WHO Label'] == who)]
-		variant_df = plot_covariants_help(variant_df, covariants)
+		variant_df = plot_covariants_help(variant_df, covariants, window)
 		variant_type = who
 	elif (inputted == False):
-		variant_df = variant_df[(variant_df['Variant'].isin(covariants))]
-		variant_df = plot_covariants_help(variant_df, covariants)
+		variant_df = variant_df[selected]
+		variant_df = plot_covariants_help(variant_df, covariants, window)
 		variant_type = ""
 	else:
-		variant_df = variant_df[(variant_df['Variant'].isin(covariants))]
-		variant_df = plot_covariants_help(variant_df, covariants)
+		variant_df = variant_df[selected]
+		variant_df = plot_covariants_help(variant_df, covariants, window)
 		variant_type = "User Inputted"
 
 
 	if (graph_type == 'prevalence'):
-		recent_prevalence = variant_df[variant_df.columns[pd.Series(variant_df.columns).str.startswith('Prevalence')]].iloc[:,:6]
+		recent_prevalence = variant_df[vd.metric_columns(variant_df, 'Prevalence', window)]
 		recent_prevalence = recent_prevalence.fillna(0)
 		covariant_prevalence_df = pd.concat([pd.DataFrame({'Variant': variant_df['Variant']}), recent_prevalence], axis = 1)
 		covariant_prevalence_df = covariant_prevalence_df.reindex(sorted(covariant_prevalence_df.columns), axis = 1)
@@ -164,9 +217,9 @@ def plot_covariants(variant_df, covariants, region, who = "", pango = "", name =
 		plt.xlabel('Year and Month')
 		plt.ylabel('Sequence Prevalence Ratio (Variant Count/Isolate Count)')
 		plt.legend(loc = 'upper right', prop = {'size': 8}, bbox_to_anchor = (0.4, 1.05))
-		plt.show()
+		show_figure(output)
 	elif (graph_type == 'growth'):
-		recent_growth_rate = variant_df[variant_df.columns[pd.Series(variant_df.columns).str.startswith('Growth Rate')]].iloc[:,:6]
+		recent_growth_rate = variant_df[vd.metric_columns(variant_df, 'Growth Rate', window)]
 		recent_growth_rate = recent_growth_rate.fillna(0)
 		covariant_growth_df = pd.concat([pd.DataFrame({'Variant': variant_df['Variant']}), recent_growth_rate], axis = 1)
 		covariant_growth_df = covariant_growth_df.reindex(sorted(covariant_growth_df.columns), axis = 1)
@@ -183,9 +236,9 @@ def plot_covariants(variant_df, covariants, region, who = "", pango = "", name =
 		plt.xlabel('Time Intervals')
 		plt.ylabel('Growth Rate')
 		plt.legend(loc = 'upper right', prop = {'size': 6.5}, bbox_to_anchor = (0.4, 1.05))
-		plt.show()
+		show_figure(output)
 	elif (graph_type == 'proportion' and not inputted):
-		recent_counts = variant_df[variant_df.columns[pd.Series(variant_df.columns).str.startswith('Variant Count')]].iloc[:,:6]
+		recent_counts = variant_df[vd.metric_columns(variant_df, 'Variant Count', window)]
 		recent_counts = recent_counts.fillna(0)
 		covariant_count_df = pd.concat([pd.DataFrame({'Variant': variant_df['Variant']}), recent_counts], axis = 1)
 		covariant_count_df = covariant_count_df.reindex(sorted(covariant_count_df.columns), axis = 1)
@@ -201,7 +254,7 @@ def plot_covariants(variant_df, covariants, region, who = "", pango = "", name =
 		plt.xlabel('Year and Month')
 		plt.ylabel('Covariant Proportional Abundance Relative to Clade')
 		plt.legend(loc = 'upper right', prop = {'size': 6.5}, bbox_to_anchor = (0.4, 1.05))
-		plt.show()
+		show_figure(output)
 	else:
 		sys.exit("Invalid graph type entry. Please try again and correctly specify the appropriate graph type (prevalence, growth, or proportion)")
 		
@@ -213,13 +266,14 @@ def plot_covariants(variant_df, covariants, region, who = "", pango = "", name =
 # data from certain countries, as potentially requested in main.py.  That said, the function will only work with data
 # on countries in the supplied variant_df and report a graph for a maximum of 10 countires, the countries with the
 # highest prevalence or growth rates for the variant.
-def plot_single_lineage(variant_df, lineage):
-	graph_type = input('Plot the changes overtime of the lineage prevalence or growth rate among the top/user inputted countries? [prevalence/growth]: ')
-	variant_df = variant_df[variant_df[variant_df[variant_df.columns[pd.Series(variant_df.columns).str.startswith('Variant Count')]].iloc[:,0].name] > 10]
+def plot_single_lineage(variant_df, lineage, graph_type = None, output = None, window = default_window):
+	if (graph_type is None):
+		graph_type = input('Plot the changes overtime of the lineage prevalence or growth rate among the top/user inputted countries? [prevalence/growth]: ')
+	variant_df = variant_df[variant_df[vd.metric_columns(variant_df, 'Variant Count', window)[0]] > 10]
 	variant_df = variant_df[(variant_df['PANGO Lineage'] == lineage)]
 
 	if (graph_type == 'prevalence'):
-		recent_prevalence = variant_df[variant_df.columns[pd.Series(variant_df.columns).str.startswith('Prevalence')]].iloc[:,:6]
+		recent_prevalence = variant_df[vd.metric_columns(variant_df, 'Prevalence', window)]
 		recent_prevalence = recent_prevalence.fillna(0)
 		lineage_prevalence_df = pd.concat([pd.DataFrame({'Country': variant_df['Country']}), recent_prevalence], axis = 1)
 		lineage_prevalence_df = lineage_prevalence_df.reindex(sorted(lineage_prevalence_df.columns), axis = 1)
@@ -236,9 +290,9 @@ def plot_single_lineage(variant_df, lineage):
 		plt.xlabel('Year and Month')
 		plt.ylabel('Sequence Prevalence Ratio (Variant Count/Isolates Count)')
 		plt.legend(loc = 'upper center', bbox_to_anchor = (0.5, 1.10), ncol = 5, fancybox = True, shadow = True)
-		plt.show()
+		show_figure(output)
 	elif (graph_type == 'growth'):
-		recent_growth_rate = variant_df[variant_df.columns[pd.Series(variant_df.columns).str.startswith('Growth Rate')]].iloc[:,:6]
+		recent_growth_rate = variant_df[vd.metric_columns(variant_df, 'Growth Rate', window)]
 		recent_growth_rate = recent_growth_rate.fillna(0)
 		lineage_growth_df = pd.concat([pd.DataFrame({'Country': variant_df['Country']}), recent_growth_rate], axis = 1)
 		lineage_growth_df = lineage_growth_df.reindex(sorted(lineage_growth_df.columns), axis = 1)
@@ -255,7 +309,7 @@ def plot_single_lineage(variant_df, lineage):
 		plt.xlabel('Year and Month')
 		plt.ylabel('Growth Rate')
 		plt.legend(loc = 'upper center', bbox_to_anchor = (0.5, 1.10), ncol = 5, fancybox = True, shadow = True)
-		plt.show()
+		show_figure(output)
 	else:
 		sys.exit("Invalid graph type entry. Please try again and correctly specify the appropriate graph type (prevalence or growth)")
 
@@ -266,12 +320,13 @@ def plot_single_lineage(variant_df, lineage):
 # this function is being called from a graph analysis option, then it will likely graph inputted lineages from the user
 # for a global analysis or for a single country analysis.  Note, this function must take in a prefiltered variant_df to
 # include only global prevalence/growth rates or prevalence/growth rates for a single country.  
-def plot_lineages(variant_df, lineages, region):
-	graph_type = input('Plot the changes over time of lineage prevalence or growth rate in '+region+'? [prevalence/growth]: ')
+def plot_lineages(variant_df, lineages, region, graph_type = None, output = None, window = default_window):
+	if (graph_type is None):
+		graph_type = input('Plot the changes over time of lineage prevalence or growth rate in '+region+'? [prevalence/growth]: ')
 	variant_df = variant_df[(variant_df['PANGO Lineage'].isin(lineages))]
 
 	if (graph_type == 'prevalence'):
-		recent_prevalence = variant_df[variant_df.columns[pd.Series(variant_df.columns).str.startswith('Prevalence')]].iloc[:,:6]
+		recent_prevalence = variant_df[vd.metric_columns(variant_df, 'Prevalence', window)]
 		recent_prevalence = recent_prevalence.fillna(0)
 		lineage_prevalence_df = pd.concat([pd.DataFrame({'Lineage': variant_df['PANGO Lineage']}), recent_prevalence], axis = 1)
 		lineage_prevalence_df = lineage_prevalence_df.reindex(sorted(lineage_prevalence_df.columns), axis = 1)
@@ -287,10 +342,10 @@ def plot_lineages(variant_df, lineages, region):
 		plt.xlabel('Year and Month')
 		plt.ylabel('Sequence Prevalence Ratio (Variant Count/Isolates Count)')
 		plt.legend(loc = 'upper center', bbox_to_anchor = (0.5, 1.10), ncol = 5, fancybox = True, shadow = True)
-		plt.show()
+		show_figure(output)
 
 	elif (graph_type == 'growth'):
-		recent_growth_rate = variant_df[variant_df.columns[pd.Series(variant_df.columns).str.startswith('Growth Rate')]].iloc[:,:6]
+		recent_growth_rate = variant_df[vd.metric_columns(variant_df, 'Growth Rate', window)]
 		recent_growth_rate = recent_growth_rate.fillna(0)
 		lineage_growth_df = pd.concat([pd.DataFrame({'Lineage': variant_df['PANGO Lineage']}), recent_growth_rate], axis = 1)
 		lineage_growth_df = lineage_growth_df.reindex(sorted(lineage_growth_df.columns), axis = 1)
@@ -307,7 +362,7 @@ def plot_lineages(variant_df, lineages, region):
 		plt.xlabel('Year and Month')
 		plt.ylabel('Growth Rate')
 		plt.legend(loc = 'upper center', bbox_to_anchor = (0.5, 1.10), ncol = 5, fancybox = True, shadow = True)
-		plt.show()
+		show_figure(output)
 	#elif (graph_type == 'emergence'):
 		#print("Emergence graph to come!")
 		#for i in range(interval):
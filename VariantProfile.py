@@ -0,0 +1,155 @@
+import os
+import sys
+import json
+import time
+import atexit
+import functools
+import contextlib
+import tracemalloc
+import pandas as pd
+
+# CPU time of worker processes is read with the resource module, which only Unix has.  Elsewhere spans only count the
+# CPU time of the process itself.
+try:
+	import resource
+except ImportError:
+	resource = None
+
+default_trace_file = 'profile_trace.json'
+
+
+# Number of rows of a DataFrame, Series or array, the total rows of those held in a dictionary (such as the sheets of
+# a report), or None for anything else
+def row_count(value):
+	if (isinstance(value, dict)):
+		counts = [row_count(v) for v in value.values()]
+		counts = [c for c in counts if (c is not None)]
+		return(sum(counts) if (counts) else None)
+	return(len(value) if (len(getattr(value, 'shape', ())) > 0) else None)
+
+
+# CPU time used by the worker processes of this process that have finished, e.g. those of a process pool once it is shut
+# down, in seconds
+def children_time():
+	if (resource is None):
+		return(0.0)
+	usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+	return(usage.ru_utime + usage.ru_stime)
+
+
+# Records spans of a run: the wall time, CPU time, peak traced memory and rows in and out of every stage.  Spans nest,
+# and a span's peak memory covers the spans inside it.  Profiling is off until enable() is called, and while it is off
+# span() and profiled functions cost a single attribute check.  The CPU time of a span includes the CPU time of the
+# worker processes it ran and waited for, such as the sheets parsed in a process pool, and is also given apart as the
+# child CPU time.  Memory is traced with tracemalloc in this process only, so the peak memory leaves out worker
+# processes.  Tracing slows the run down somewhat and only sees memory allocated through Python (numpy arrays
+# included, pyarrow buffers not).
+class Profiler:
+
+	def __init__(self):
+		self.enabled = False
+		self.spans = []
+		self.stack = []
+		self.origin = None
+		self.trace_file = None
+
+	# Start profiling, and write the trace to trace_file and print the summary table when the program exits
+	def enable(self, trace_file = default_trace_file):
+		self.enabled = True
+		self.trace_file = trace_file
+		self.origin = time.perf_counter()
+		tracemalloc.start()
+		atexit.register(self.finish)
+
+	# Record a span around a block, e.g.
+	#     with profiler.span('filter region', rows_in = len(variants)) as span:
+	#         ...
+	#         span['rows_out'] = len(analysis_variants)
+	@contextlib.contextmanager
+	def span(self, name, rows_in = None):
+		record = {'name': name, 'rows_in': rows_in, 'rows_out': None}
+		if (not self.enabled):
+			yield(record)
+			return
+		current, peak = tracemalloc.get_traced_memory()
+		if (self.stack):
+			self.stack[-1]['child_peak'] = max(self.stack[-1]['child_peak'], peak)
+		tracemalloc.reset_peak()
+		record.update({'depth': len(self.stack), 'parent': self.stack[-1]['name'] if (self.stack) else None, 'path': (self.stack[-1]['path'] + '/' if (self.stack) else '') + name, 'start': time.perf_counter() - self.origin, 'memory_start': current, 'child_peak': 0})
+		self.stack.append(record)
+		wall = time.perf_counter()
+		cpu = time.process_time()
+		child_cpu = children_time()
+		try:
+			yield(record)
+		finally:
+			record['wall'] = time.perf_counter() - wall
+			record['child_cpu'] = children_time() - child_cpu
+			record['cpu'] = time.process_time() - cpu + record['child_cpu']
+			self.stack.pop()
+			record['memory_peak'] = max(tracemalloc.get_traced_memory()[1], record.pop('child_peak'))
+			if (self.stack):
+				self.stack[-1]['child_peak'] = max(self.stack[-1]['child_peak'], record['memory_peak'])
+			self.spans.append(record)
+
+	# Spans in the Chrome trace event format, which chrome://tracing and Perfetto open as a timeline
+	def trace(self):
+		events = [{'name': s['name'], 'ph': 'X', 'pid': os.getpid(), 'tid': 0, 'ts': round(s['start'] * 1e6), 'dur': round(s['wall'] * 1e6), 'args': {
+			'cpu_ms': round(s['cpu'] * 1e3, 3), 'child_cpu_ms': round(s['child_cpu'] * 1e3, 3), 'peak_memory_mb': round(s['memory_peak'] / 2**20, 3), 'memory_growth_mb': round((s['memory_peak'] - s['memory_start']) / 2**20, 3),
+			'rows_in': s['rows_in'], 'rows_out': s['rows_out'], 'parent': s['parent'], 'depth': s['depth']}} for s in sorted(self.spans, key = lambda s: s['start'])]
+		return({'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': {'command': ' '.join(sys.argv)}})
+
+	# Table of the spans by stage, in the order the stages first ran, with the stages inside another indented below
+	# it: the number of calls, total wall and CPU time (with the part spent in worker processes), largest peak traced
+	# memory of this process and total rows in and out
+	def summary(self):
+		spans = pd.DataFrame(sorted(self.spans, key = lambda s: s['start']))
+		if (spans.empty):
+			return(spans)
+		stages = spans.groupby('path', sort = False)
+		table = stages.agg(Stage = ('name', 'first'), Depth = ('depth', 'first'), Calls = ('name', 'size'), Wall = ('wall', 'sum'), CPU = ('cpu', 'sum'), Child = ('child_cpu', 'sum'), Peak = ('memory_peak', 'max'))
+		table['Peak'] = (table['Peak'] / 2**20).round(1)
+		table[['Wall', 'CPU', 'Child']] = table[['Wall', 'CPU', 'Child']].round(3)
+		table['Rows In'] = stages['rows_in'].sum(min_count = 1).astype('Int64')
+		table['Rows Out'] = stages['rows_out'].sum(min_count = 1).astype('Int64')
+		table['Stage'] = ['  ' * d + n for d, n in zip(table.pop('Depth'), table['Stage'])]
+		return(table.rename(columns = {'Wall': 'Wall (s)', 'CPU': 'CPU (s)', 'Child': 'Child CPU (s)', 'Peak': 'Parent Peak (MB)'}).reset_index(drop = True))
+
+	# Write the trace and print the summary.  Failing to write the trace is not fatal.
+	def finish(self):
+		if (not self.enabled):
+			return
+		self.enabled = False
+		tracemalloc.stop()
+		try:
+			with open(self.trace_file + '.tmp', 'w') as f:
+				json.dump(self.trace(), f)
+			os.replace(self.trace_file + '.tmp', self.trace_file)
+		except OSError as e:
+			print("WARNING! Could not write the profile trace ("+str(e)+").")
+		print('\n')
+		print("PROFILE (trace saved to "+str(self.trace_file)+"):")
+		summary = self.summary()
+		width = summary['Stage'].str.len().max() if (len(summary)) else 0
+		print(summary.to_string(index = False, formatters = {'Stage': lambda stage: stage.ljust(width)}))
+
+
+# Profiler shared by the whole process
+profiler = Profiler()
+
+def span(name, rows_in = None):
+	return(profiler.span(name, rows_in))
+
+# Decorator recording every call of a function as a span named after it, with the rows of its first argument (or first
+# keyword argument) in and of its result out
+def profiled(function):
+	@functools.wraps(function)
+	def wrapper(*args, **kwargs):
+		if (not profiler.enabled):
+			return(function(*args, **kwargs))
+		first = args[0] if (args) else next(iter(kwargs.values()), None)
+		with profiler.span(function.__name__, row_count(first)) as record:
+			result = function(*args, **kwargs)
+			record['rows_out'] = row_count(result)
+		return(result)
+	return(wrapper)
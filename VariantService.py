@@ -0,0 +1,302 @@
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import threading
+import traceback
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pandas as pd
+import VariantData as vd
+import VariantEncoding as ve
+import main
+
+# Sheets kept in memory by the service, enough for every ranking of the World, any country and the USA
+service_sheets = {'World - Variants': main.variant_columns, 'USA - Variants': main.variant_columns, 'AA Mutations': main.mutation_columns, 'SFoCs': None}
+report_extensions = ['.xlsx'] + vd.delimited_extensions
+default_port = 8050
+default_poll = 5.0
+
+
+# One loaded report: its sheets read, encoded and held in memory, with the data of every region filtered the first time
+# a request asks for it, and its ranking functions answered through the result cache when given one.  A snapshot is
+# never changed once loaded, so requests holding one are not disturbed when the service swaps in a newer report.
+class ReportSnapshot:
+
+	def __init__(self, file, cache_dir = vd.default_cache_dir, compact = False, results = None):
+		self.file = file
+		variants_report = main.open_emerging_variants(file, cache_dir)
+		self.hash = variants_report.hash()
+		if (isinstance(variants_report, vd.DelimitedReport)):
+			requests = {name: columns for name, columns in service_sheets.items() if (name == variants_report.name)}
+		else:
+			requests = service_sheets
+		self.sheets = main.read_sheets(variants_report, requests, compact)
+		self.report = variants_report
+		self.compact = compact
+		self.results = results
+		self.rankings = main.report_rankings(variants_report, results, {}, compact)
+		self.loaded = time.strftime('%Y-%m-%dT%H:%M:%S')
+		self.regions = {}
+		self.lock = threading.Lock()
+
+	# Data of a region from main.region_data(), filtered once per snapshot
+	def region(self, country = None):
+		with self.lock:
+			if (country not in self.regions):
+				self.regions[country] = main.region_data(self.sheets, country)
+			return(self.regions[country])
+
+	# Data of a region with its point mutations derived from the covariant rows of a subset (see main.mutation_key()),
+	# derived once per snapshot, and the ranking functions for it
+	def derived_region(self, country, derived, pango = None, who = None, covariants_file = None):
+		data = self.region(country)
+		key = json.dumps([country, derived])
+		with self.lock:
+			if (key not in self.regions):
+				self.regions[key] = main.derived_mutation_data(data, pango, who, covariants_file)
+			return(self.regions[key], main.report_rankings(self.report, self.results, {}, self.compact, [derived]))
+
+	def status(self):
+		return({'report': os.path.basename(self.file), 'hash': self.hash, 'loaded': self.loaded, 'sheets': {name: len(sheet) for name, sheet in self.sheets.items()}})
+
+
+# A ranking request that cannot be answered, with the HTTP status to answer it with
+class RequestError(Exception):
+
+	def __init__(self, status, message):
+		Exception.__init__(self, message)
+		self.status = status
+
+
+# Query parameters of a ranking request, as named in a manifest job, and the commandline options they stand for
+query_options = {'PANGO': 'pango', 'WHO': 'who', 'covariants': 'covariant', 'country': 'country', 'interval': 'interval', 'from': 'start', 'to': 'end', 'domain': 'domain', 'mutations': 'mutation', 'by_location': 'by_location', 'rolling': 'rolling', 'growth_grid': 'growth_grid', 'prevalence_grid': 'prevalence_grid', 'count_grid': 'count_grid', 'derive_mutations': 'derive_mutations'}
+
+# Options of a ranking request, given like the parsed commandline (see main.job_problem()).  Covariants and mutations
+# are lists of values rather than files.
+def request_args(analysis, query):
+	single = {option: values[-1] for option, values in query.items()}
+	interval = single.get('interval')
+	if (interval is not None and not interval.isdigit()):
+		raise RequestError(400, "Invalid interval. Please give a whole number of months")
+	if (any(month and not re.fullmatch(r'[0-9]{4}-[0-9]{2}', month) for month in [single.get('from'), single.get('to')])):
+		raise RequestError(400, "Invalid month. Please give 'from' and 'to' as YYYY-MM, e.g. from=2023-01&to=2023-06")
+	mutations = [m.strip() for value in query.get('mutations', []) for m in value.split(',') if (m.strip())]
+	return(argparse.Namespace(analysis = analysis, pango = single.get('PANGO'), who = single.get('WHO'), covariant = query.get('covariants'), country = single.get('country'),
+		interval = int(interval) if (interval) else None, start = single.get('from'), end = single.get('to'), domain = single.get('domain'), mutation = mutations or None,
+		by_location = flag(single.get('by_location')), rolling = flag(single.get('rolling')), growth_grid = single.get('growth_grid'), prevalence_grid = single.get('prevalence_grid'), count_grid = single.get('count_grid'),
+		derive_mutations = flag(single.get('derive_mutations')), incremental = False, graph_type = None, graph_format = None))
+
+# Value of a true/false query parameter
+def flag(value):
+	return((value or 'false').lower() in ['1', 'true', 'yes'])
+
+
+# The newest report file in a directory, as (path, modification time, size), or None when there is none.  Hidden files,
+# Excel lock files ('~$...') and the .tmp files of atomic writes are skipped.
+def newest_report(directory):
+	reports = []
+	for entry in os.scandir(directory):
+		if (entry.is_file() and not entry.name.startswith(('.', '~$')) and os.path.splitext(entry.name)[1].lower() in report_extensions):
+			stat = entry.stat()
+			reports.append((stat.st_mtime, entry.path, stat.st_size))
+	if (not reports):
+		return(None)
+	mtime, path, size = max(reports)
+	return((path, mtime, size))
+
+
+# Keeps the current report snapshot and answers ranking requests against it.  With a watch directory, a thread polls it
+# for a new or changed report and loads it in the background.  A file is only loaded once it has stopped changing
+# between two polls, so a report still being copied in is not read half written.  The new snapshot then replaces the
+# old one in a single assignment: requests already running finish on the snapshot they started with, and later ones
+# get the new one.  A report that fails to load is reported and the service keeps the snapshot it has.
+class RankingService:
+
+	def __init__(self, file = None, watch_dir = None, cache_dir = vd.default_cache_dir, compact = False, poll = default_poll, persistent_results = False):
+		self.watch_dir = watch_dir
+		self.cache_dir = cache_dir
+		self.compact = compact
+		self.poll = poll
+		self.signature = None
+		self.snapshot = None
+		self.reloads = 0
+		self.requests = 0
+		self.reload_lock = threading.Lock()
+		self.count_lock = threading.Lock()
+		self.results = main.result_cache(cache_dir, persistent_results)
+		if (file is None and watch_dir):
+			newest = newest_report(watch_dir)
+			if (newest is None):
+				sys.exit("No Emerging Variants Report (.xlsx, .txt, .tsv or .csv) found in the watched directory. Please try again with a directory holding a report.")
+			file = newest[0]
+		if (watch_dir):
+			self.signature = newest_report(watch_dir)
+		self.snapshot = ReportSnapshot(file, cache_dir, compact, self.results)
+		self.stopped = threading.Event()
+		self.watcher = None
+
+	# Load a report and swap it in.  Returns False, keeping the current snapshot, if the report could not be loaded.
+	def reload(self, file):
+		with self.reload_lock:
+			try:
+				snapshot = ReportSnapshot(file, self.cache_dir, self.compact, self.results)
+			except (Exception, SystemExit) as e:
+				print("WARNING! Could not load '"+file+"', still serving '"+os.path.basename(self.snapshot.file)+"' ("+str(e)+").")
+				return(False)
+			self.snapshot = snapshot
+			self.reloads += 1
+			print("Now serving '"+os.path.basename(file)+"'")
+			return(True)
+
+	# Poll the watch directory until stopped
+	def watch(self):
+		pending = None
+		while (not self.stopped.wait(self.poll)):
+			try:
+				newest = newest_report(self.watch_dir)
+			except OSError as e:
+				print("WARNING! Could not read the watched directory ("+str(e)+").")
+				continue
+			if (newest is None or newest == self.signature):
+				pending = None
+			elif (newest == pending):
+				self.signature = newest
+				self.reload(newest[0])
+			else:
+				pending = newest
+
+	def start_watching(self):
+		if (self.watch_dir and self.watcher is None):
+			self.watcher = threading.Thread(target = self.watch, name = 'report-watcher', daemon = True)
+			self.watcher.start()
+
+	def stop(self):
+		self.stopped.set()
+
+	def status(self):
+		return(dict(self.snapshot.status(), reloads = self.reloads, requests = self.requests, watching = self.watch_dir, result_cache = self.results.stats()))
+
+	# Answer a ranking request, given the ranking analysis option and the query parameters as lists of values.  The
+	# parameters are named like the options of a manifest job: PANGO, WHO, covariants (repeated, one covariant each),
+	# country, interval, from, to, domain, mutations (repeated or comma separated), by_location, rolling, the threshold
+	# grids growth_grid, prevalence_grid and count_grid (comma separated) and derive_mutations.  Returns the ranking as
+	# a JSON ready dictionary, or raises a RequestError.
+	def rank(self, analysis, query):
+		with self.count_lock:
+			self.requests += 1
+		snapshot = self.snapshot
+		unknown = set(query) - set(query_options)
+		if (unknown):
+			raise RequestError(400, "The request has unknown parameters: "+', '.join(sorted(unknown)))
+		args = request_args(analysis, query)
+		problem = main.job_problem(args)
+		if (problem):
+			raise RequestError(400, "The request "+problem)
+		data = snapshot.region(args.country)
+		try:
+			covariants_file = pd.DataFrame({'Variant': ve.covariant_store.canonical(args.covariant)}) if (args.covariant) else None
+		except ValueError as e:
+			raise RequestError(400, "The request has an invalid covariant. "+str(e))
+		derived = main.mutation_key(args, covariants_file)
+		needed = 'analysis_subs' if (args.analysis == 'mutation_ranking' and not derived) else 'analysis_variants'
+		if (data[needed] is None or (args.analysis in ['functional_ranking', 'composite_ranking'] and data['sfocs'] is None)):
+			raise RequestError(404, "The report being served does not hold the sheets this ranking needs for "+data['region'])
+		rankings = snapshot.rankings
+		if (derived):
+			try:
+				data, rankings = snapshot.derived_region(args.country, derived, args.pango, args.who, covariants_file)
+			except SystemExit as e:
+				raise RequestError(404, str(e.code))
+			needed = 'analysis_subs'
+		interval = main.analysis_window(args)
+		if (args.rolling):
+			interval = main.rolling_window(args)[1]
+		if (interval is not None and not isinstance(interval, int) and not vd.report_schema(data[needed].columns).month_labels(interval)):
+			raise RequestError(400, "No months of the report fall between 'from' and 'to'")
+		grids = main.threshold_grids(args)
+		try:
+			if (grids):
+				ranking, output = main.run_sweep_ranking(args.analysis, data, interval, grids, args.pango, args.who, args.domain, args.mutation, rankings)
+			elif (args.rolling):
+				ranking, output = main.run_rolling_ranking(args.analysis, data, *main.rolling_window(args), args.pango, args.who, args.domain, args.mutation, rankings)
+			elif (args.by_location):
+				ranking, output = main.run_location_ranking(args.analysis, data, interval, args.domain, args.mutation, rankings)
+			else:
+				ranking, output = main.run_ranking(args.analysis, data, interval, args.pango, args.who, covariants_file, args.domain, args.mutation, rankings = rankings)
+		except SystemExit as e:
+			raise RequestError(404, str(e.code))
+		return({'report': os.path.basename(snapshot.file), 'hash': snapshot.hash, 'analysis': args.analysis, 'region': data['region'], 'output': output,
+			'columns': [str(c) for c in ranking.columns], 'rows': json.loads(ranking.to_json(orient = 'records'))})
+
+
+# HTTP handler of the service.  GET /status describes the report being served, and GET /[ranking analysis option], e.g.
+# /sequence_ranking?WHO=Omicron&interval=6, returns the ranking as JSON.
+class RankingHandler(BaseHTTPRequestHandler):
+
+	def send_json(self, status, body):
+		payload = json.dumps(body).encode('utf-8')
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(payload)))
+		self.end_headers()
+		self.wfile.write(payload)
+
+	def do_GET(self):
+		url = urllib.parse.urlsplit(self.path)
+		path = url.path.strip('/')
+		service = self.server.service
+		try:
+			if (path in ['', 'status']):
+				self.send_json(200, service.status())
+			elif (path in main.ranking_options):
+				self.send_json(200, service.rank(path, urllib.parse.parse_qs(url.query)))
+			else:
+				self.send_json(404, {'error': "Unknown endpoint. Use /status or one of /"+', /'.join(main.ranking_options)})
+		except RequestError as e:
+			self.send_json(e.status, {'error': str(e)})
+		except Exception as e:
+			traceback.print_exc()
+			self.send_json(500, {'error': str(e)})
+
+
+# HTTP server answering requests in threads, each holding the service's snapshot for as long as it runs
+class RankingServer(ThreadingHTTPServer):
+	daemon_threads = True
+
+	def __init__(self, address, service):
+		ThreadingHTTPServer.__init__(self, address, RankingHandler)
+		self.service = service
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'Serve rankings of an Emerging Variants Report kept in memory as JSON over HTTP')
+	parser.add_argument('--filename', dest = 'filename', type = str, help = 'report to serve (by default the newest report in --watch_dir)')
+	parser.add_argument('--watch_dir', dest = 'watch_dir', type = str, help = 'directory to watch for new reports to swap in')
+	parser.add_argument('--host', dest = 'host', type = str, default = '127.0.0.1')
+	parser.add_argument('--port', dest = 'port', type = int, default = default_port)
+	parser.add_argument('--poll', dest = 'poll', type = float, default = default_poll, help = 'seconds between checks of --watch_dir')
+	parser.add_argument('--cache_dir', '--cache-dir', dest = 'cache_dir', type = str, default = vd.default_cache_dir)
+	parser.add_argument('--compact', dest = 'compact', action = 'store_true')
+	parser.add_argument('--result_cache', dest = 'result_cache', action = 'store_true', help = 'keep rankings in the cache directory between runs as well as in memory')
+	args = parser.parse_args()
+
+	if (not args.filename and not args.watch_dir):
+		sys.exit("Please give the report to serve with '--filename', or a directory of reports to watch with '--watch_dir'.")
+	if (args.watch_dir and not os.path.isdir(args.watch_dir)):
+		sys.exit("The directory given to '--watch_dir' does not exist.")
+	if (args.poll <= 0):
+		sys.exit("Please give '--poll' as a positive number of seconds.")
+	service = RankingService(args.filename, args.watch_dir, args.cache_dir, args.compact, args.poll, args.result_cache)
+	service.start_watching()
+	server = RankingServer((args.host, args.port), service)
+	print("Serving rankings of '"+os.path.basename(service.snapshot.file)+"' on http://"+args.host+":"+str(server.server_address[1])+" (Control + C to stop)")
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		service.stop()
+		server.server_close()
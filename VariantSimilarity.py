@@ -0,0 +1,138 @@
+import numpy as np
+import pandas as pd
+import VariantEncoding as ve
+import VariantProfile as vpr
+
+# Similarity of covariants by their shared Spike substitutions, for finding the covariants of a report that are closest
+# to a new constellation.  Jaccard similarity is the number of shared mutations over the number of mutations in either
+# covariant, and the Hamming distance is the number of mutations in one covariant but not the other.
+metrics = ['jaccard', 'hamming']
+default_top = 10
+minhash_oversample = 4
+
+# Number of set bits in every byte, for counting bits where numpy has no bitwise_count (before numpy 2.0)
+byte_bits = np.array([bin(b).count('1') for b in range(256)], dtype = np.uint8)
+
+
+# Number of set bits of every element of an array of uint64 words
+def popcount(words):
+	if (hasattr(np, 'bitwise_count')):
+		return(np.bitwise_count(words))
+	return(byte_bits[words.view(np.uint8)].reshape(words.shape + (8,)).sum(axis = -1, dtype = np.uint8))
+
+
+# Index of a set of covariants in the covariant store for nearest neighbour queries.  Every distinct mutation of the
+# indexed covariants gets a bit, and every covariant is held as a fixed width bitset over those bits, stored word by
+# word across all covariants so a query only reads the words its own mutations fall in.  With minhash, the number of
+# hash functions, the index holds MinHash signatures instead of bitsets: a fixed number of integers per covariant
+# however large the mutation vocabulary, which keeps very large reports small in memory.  Candidates are then picked
+# by the Jaccard similarity the signatures estimate and re-scored exactly from the covariant store, so the scores
+# returned are exact either way, though a neighbour whose estimate falls short of the candidates can be missed.
+class SimilarityIndex:
+
+	def __init__(self, covariant_ids, store = ve.covariant_store, minhash = None, seed = 0):
+		self.store = store
+		self.ids = np.unique(np.asarray(covariant_ids, dtype = np.int64))
+		self.ids = self.ids[self.ids >= 0]
+		owner, mutation_ids, positions, residues = store.gather(self.ids)
+		self.vocabulary, bits = np.unique(mutation_ids, return_inverse = True)
+		self.sizes = np.bincount(owner, minlength = len(self.ids))
+		self.order = np.argsort(np.argsort(np.array([store.covariants[i] for i in self.ids], dtype = object), kind = 'stable'))
+		self.minhash = minhash
+		if (minhash):
+			self.hashes = np.random.default_rng(seed).integers(0, 2**32, size = (minhash, len(self.vocabulary)), dtype = np.uint64).astype(np.uint32)
+			self.signatures = np.empty((minhash, len(self.ids)), dtype = np.uint32)
+			starts = np.cumsum(self.sizes) - self.sizes
+			for first in range(0, minhash, 8):
+				self.signatures[first:first + 8] = np.minimum.reduceat(self.hashes[first:first + 8, bits], starts, axis = 1) if (len(bits)) else 0
+			self.words = None
+		else:
+			self.words = np.zeros(((len(self.vocabulary) + 63) // 64, len(self.ids)), dtype = np.uint64)
+			np.bitwise_or.at(self.words.reshape(-1), (bits >> 6) * len(self.ids) + owner, np.left_shift(np.uint64(1), (bits & 63).astype(np.uint64)))
+
+	def __len__(self):
+		return(len(self.ids))
+
+	# Bits of the mutations of a covariant ID that are in the vocabulary, and the number of its mutations that are not
+	def bits_of(self, covariant_id):
+		members = self.store.members[covariant_id]
+		bits = np.searchsorted(self.vocabulary, members)
+		known = (bits < len(self.vocabulary)) & (self.vocabulary[np.minimum(bits, len(self.vocabulary) - 1)] == members) if (len(self.vocabulary)) else np.zeros(len(members), dtype = bool)
+		return(np.unique(bits[known]), int((~known).sum()))
+
+	# Number of mutations every indexed covariant (or the indexed covariants at the given positions) shares with a query
+	# given as its bits
+	def shared(self, bits, positions = None):
+		if (self.words is not None):
+			words = self.words if (positions is None) else self.words[:, positions]
+			shared = np.zeros(words.shape[1], dtype = np.int64)
+			for word in np.unique(bits >> 6):
+				mask = np.bitwise_or.reduce(np.left_shift(np.uint64(1), (bits[(bits >> 6) == word] & 63).astype(np.uint64)))
+				shared += popcount(words[word] & mask)
+			return(shared)
+		positions = np.arange(len(self.ids)) if (positions is None) else positions
+		owner, mutation_ids, p, r = self.store.gather(self.ids[positions])
+		return(np.bincount(owner, weights = np.isin(mutation_ids, self.vocabulary[bits]), minlength = len(positions)).astype(np.int64))
+
+	# The top nearest indexed covariants to a covariant ID by Jaccard similarity (highest first) or Hamming distance
+	# (lowest first), ties broken by covariant.  Returns their positions in the index, shared mutation counts and scores.
+	def query(self, covariant_id, top = default_top, metric = 'jaccard'):
+		bits, unknown = self.bits_of(covariant_id)
+		size = len(bits) + unknown
+		if (self.minhash):
+			signature = self.hashes[:, bits].min(axis = 1) if (len(bits)) else np.full(self.minhash, np.iinfo(np.uint32).max, dtype = np.uint32)
+			estimate = (self.signatures == signature[:, None]).mean(axis = 0)
+			if (metric == 'hamming'):
+				estimate = -(self.sizes + size) * (1 - estimate) / (1 + estimate)
+			positions = nearest(estimate, top * minhash_oversample, self.order)
+			shared = self.shared(bits, positions)
+		else:
+			positions = np.arange(len(self.ids))
+			shared = self.shared(bits)
+		union = self.sizes[positions] + size - shared
+		score = shared / np.maximum(union, 1) if (metric == 'jaccard') else union - shared
+		best = nearest(score if (metric == 'jaccard') else -score, top, self.order[positions])
+		return(positions[best], shared[best], score[best])
+
+
+# Indexes of the top highest of a set of scores, highest first and ties broken by the given order
+def nearest(score, top, order):
+	if (top < len(score)):
+		kth = np.partition(score, len(score) - top)[len(score) - top]
+		candidates = np.nonzero(score >= kth)[0]
+	else:
+		candidates = np.arange(len(score))
+	return(candidates[np.lexsort((order[candidates], -score[candidates]))][:top])
+
+
+# Find the covariants of a variants sheet closest to each covariant of a covariants file (the Name and Variant
+# columns of open_covariants_file() in main.py) by shared Spike substitutions.  Returns a table in the same format, so
+# it can be passed back as a covariants file: for every query the top covariants, nearest first, named after the query
+# and their rank, with the query, the PANGO Lineage and WHO Label the covariant is first listed under, the number of
+# shared mutations and the Jaccard similarity or Hamming distance.
+@vpr.profiled
+def similar_covariants(variant_df, covariants_file, top = default_top, metric = 'jaccard', minhash = None, store = ve.covariant_store):
+	indexed = variant_df.drop_duplicates(subset = ['Variant'])
+	index = SimilarityIndex(store.encode(indexed['Variant']), store, minhash)
+	labels = indexed.assign(ID = store.encode(indexed['Variant'])).set_index('ID')
+	labels = labels[~labels.index.duplicated()]
+	queries = store.encode(covariants_file['Variant'])
+	names = list(covariants_file['Name']) if ('Name' in covariants_file.columns) else ['Query '+str(i + 1) for i in range(len(queries))]
+	score_column = 'Jaccard' if (metric == 'jaccard') else 'Hamming Distance'
+	results = []
+	for query, name, variant in zip(queries, names, covariants_file['Variant']):
+		if (query < 0):
+			continue
+		positions, shared, score = index.query(query, top, metric)
+		ids = index.ids[positions]
+		results.append(pd.DataFrame({
+			'Name': [str(name)+' #'+str(rank + 1) for rank in range(len(ids))],
+			'Variant': [store.covariants[i] for i in ids],
+			'Query': variant,
+			'PANGO Lineage': labels.loc[ids, 'PANGO Lineage'].to_numpy(),
+			'WHO Label': labels.loc[ids, 'WHO Label'].to_numpy(),
+			'Shared Mutations': shared,
+			score_column: np.round(score, 4) if (metric == 'jaccard') else score}))
+	if (not results):
+		return(pd.DataFrame(columns = ['Name', 'Variant', 'Query', 'PANGO Lineage', 'WHO Label', 'Shared Mutations', score_column]))
+	return(pd.concat(results, ignore_index = True))
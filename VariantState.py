@@ -0,0 +1,437 @@
+import os
+import json
+import pickle
+import sqlite3
+import hashlib
+import types
+import inspect
+import threading
+import collections
+import numpy as np
+import pandas as pd
+import VariantAnalysis as va
+import VariantData as vd
+import VariantEncoding as ve
+import VariantCube as vc
+
+
+# Key of every row of a sheet, hashed from its label columns (Country/Region, WHO Label, PANGO Lineage, Variant, ...),
+# so the same covariant, lineage or mutation in the same location gets the same key in every weekly report
+def row_keys(variant_df):
+	label_columns = [c for c in variant_df.columns if (vc.split_header(c) is None)]
+	return(pd.util.hash_pandas_object(variant_df[label_columns], index = False).to_numpy(dtype = np.uint64))
+
+# Content hash of every row (one per row) over the given prevalence and growth rates (rows x months), from the bits of
+# its values month by month.  Values are widened to float64 first, so a compacted sheet hashes as the sheet it came from.
+def row_hashes(prevalence, growth):
+	prevalence = np.asarray(prevalence, dtype = np.float64).view(np.uint64)
+	growth = np.asarray(growth, dtype = np.float64).view(np.uint64)
+	hashes = np.full(len(prevalence), 0xCBF29CE484222325, dtype = np.uint64)
+	for month in range(prevalence.shape[1]):
+		hashes = (hashes ^ (prevalence[:, month] * np.uint64(0x9E3779B97F4A7C15)) ^ growth[:, month]) * np.uint64(0x100000001B3)
+	return(hashes)
+
+# Prevalence and growth rates of every row of a sheet over the given month labels (rows x months), NaN for months the
+# sheet does not have
+def month_metrics(variant_df, months):
+	schema = vd.report_schema(variant_df.columns)
+	labels = schema.month_labels()
+	prevalence = np.full((len(variant_df), len(months)), np.nan)
+	growth = np.full((len(variant_df), len(months)), np.nan)
+	for j, month in enumerate(months):
+		if (month in labels):
+			for values, metric in [(prevalence, 'Prevalence'), (growth, 'Growth Rate')]:
+				position = schema.positions[metric][labels.index(month)]
+				if (position >= 0):
+					values[:, j] = variant_df.iloc[:, position].to_numpy(dtype = np.float64)
+	return(prevalence, growth)
+
+# Hash of a functional weight table from VariantAnalysis.sfoc_weights(), which changes whenever the SFoCs do
+def weights_hash(weights):
+	return(hashlib.sha256(np.ascontiguousarray(weights, dtype = np.int64).tobytes()).hexdigest())
+
+
+# State of a ranking kept between runs, so that ranking the next weekly report only redoes the work for what changed.
+# It holds the key and content hash of every row ranked last time, the significance of each of its months, the number
+# of significant months of every entity, the score of every ranked entity, and the functional impact score of every
+# covariant scored against the current SFoCs.  Pass it as the state of lineage_ranking(), sequence_ranking(),
+# mutation_ranking() or composite_ranking(), or as the memo of functional_ranking(): rows whose prevalence and growth
+# rates are unchanged reuse their significance and only their new months are tested, and only covariants not scored
+# before are scored.  The state is stored as a pickle at path.
+class RankingState:
+
+	def __init__(self, path = None, memo = None):
+		self.path = path
+		self.memo = memo
+		self.keys = np.zeros(0, dtype = np.uint64)
+		self.months = []
+		self.hashes = np.zeros(0, dtype = np.uint64)
+		self.significant = np.zeros((0, 0), dtype = bool)
+		self.codes = np.zeros(0, dtype = np.int64)
+		self.entities = np.zeros(0, dtype = object)
+		self.counts = pd.Series(dtype = np.int64)
+		self.thresholds = None
+		self.entity_scores = pd.Series(dtype = float)
+		self.functional = {}
+		self.weights_hash = None
+		self.reused = 0
+		self.computed = 0
+		self.scored = 0
+		if (path and os.path.exists(path)):
+			try:
+				with open(path, 'rb') as f:
+					self.__dict__.update(pickle.load(f))
+			except (OSError, pickle.UnpicklingError, EOFError):
+				print("WARNING! Could not read the ranking state in "+path+". Recomputing from scratch.")
+			self.path = path
+			self.memo = memo
+
+	# Significance mask of the given rows and months (see VariantAnalysis.significant_months()) and the number of
+	# significant months of every entity, given the entity code of every row (-1 for rows left out of the counts) and
+	# the entities the codes index.  A row seen in the previous run whose prevalence and growth rates over the months of
+	# that run are unchanged reuses their significance, and only its months new to this run are tested, while new and
+	# changed rows are tested in full.  The counts of the previous run are then patched with what the months that left
+	# the window, the new months and the new, changed and vanished rows add or take away.  The state then holds the rows
+	# and months given here.
+	def significance(self, variant_df, months, prevalence, growth, codes, entities, growth_threshold = 5, prevalence_threshold = 0.05, dropna = True):
+		thresholds = (growth_threshold, prevalence_threshold, dropna)
+		months = list(months)
+		keys = row_keys(variant_df)
+		hashes = row_hashes(prevalence, growth)
+		entities = np.asarray(entities, dtype = object)
+		if (thresholds != self.thresholds or len(self.keys) != len(self.hashes) or len(self.keys) != len(self.codes)):
+			self.keys, self.months, self.hashes, self.codes = keys[:0], [], hashes[:0], codes[:0]
+			self.significant = np.zeros((0, 0), dtype = bool)
+			self.counts = pd.Series(dtype = np.int64)
+		rows = np.searchsorted(self.keys, keys).clip(max = max(len(self.keys) - 1, 0))
+		columns = np.array([self.months.index(m) if (m in self.months) else -1 for m in months], dtype = np.int64)
+		kept = columns >= 0
+		same = np.zeros(len(keys), dtype = bool)
+		if (len(self.keys)):
+			previous_hashes = hashes if (months == self.months) else row_hashes(*month_metrics(variant_df, self.months))
+			same = (self.keys[rows] == keys) & (previous_hashes == self.hashes[rows])
+		reused = np.flatnonzero(same)
+		tested = np.flatnonzero(~same)
+		significant = np.zeros(prevalence.shape, dtype = bool)
+		significant[tested] = va.significant_months(prevalence[tested], growth[tested], *thresholds)
+		significant[np.ix_(reused, np.flatnonzero(kept))] = self.significant[np.ix_(rows[reused], columns[kept])]
+		significant[np.ix_(reused, np.flatnonzero(~kept))] = va.significant_months(prevalence[reused][:, ~kept], growth[reused][:, ~kept], *thresholds)
+		self.reused += int(len(reused) * kept.sum())
+		self.computed += int(significant.size - len(reused) * kept.sum())
+
+		# Patch the counts: take away the previous rows that are not reused and the months of the reused ones that left
+		# the window, and add the tested rows and the new months of the reused ones.  The entity of a row is one of the
+		# labels its key is hashed from, so a reused row still counts towards the same entity.
+		gone = np.ones(len(self.keys), dtype = bool)
+		gone[rows[reused]] = False
+		dropped = np.setdiff1d(np.arange(len(self.months)), columns[kept])
+		removed = [(self.codes[gone], self.significant[gone].sum(axis = 1))]
+		if (len(dropped)):
+			removed.append((self.codes[rows[reused]], self.significant[np.ix_(rows[reused], dropped)].sum(axis = 1)))
+		added = [(codes[tested], significant[tested].sum(axis = 1))]
+		if ((~kept).any()):
+			added.append((codes[reused], significant[np.ix_(reused, np.flatnonzero(~kept))].sum(axis = 1)))
+		delta = [pd.Series(sign * values[(c >= 0) & (values > 0)], index = labels[c[(c >= 0) & (values > 0)]], dtype = np.int64) for sign, labels, changes in [(-1, self.entities, removed), (1, entities, added)] for c, values in changes]
+		delta = pd.concat(delta)
+		counts = self.counts
+		if (len(delta)):
+			counts = counts.add(delta.groupby(level = 0).sum(), fill_value = 0).astype(np.int64)
+			counts = counts[counts != 0]
+
+		order = np.argsort(keys, kind = 'stable')
+		self.keys = keys[order]
+		self.months = months
+		self.hashes = hashes[order]
+		self.significant = significant[order]
+		self.codes = codes[order]
+		self.entities = entities
+		self.counts = counts
+		self.thresholds = thresholds
+		return(significant, counts.reindex(pd.Index(entities, dtype = object), fill_value = 0).to_numpy(dtype = np.int64))
+
+	# Functional impact scores of covariant IDs against a weight table, scoring only the covariants not scored against
+	# the same table before (see VariantAnalysis.functional_scores()).  When the state was given a memo such as a
+	# ScoreStore, scores are kept there instead.
+	def scores(self, covariant_ids, weights, store = ve.covariant_store):
+		if (self.memo):
+			scored = self.memo.scored
+			scores = self.memo.scores(covariant_ids, weights, store)
+			self.scored += self.memo.scored - scored
+			return(scores)
+		digest = weights_hash(weights)
+		if (digest != self.weights_hash):
+			self.functional = {}
+			self.weights_hash = digest
+		covariants = np.array([store.covariants[i] for i in covariant_ids], dtype = object)
+		known = np.array([c in self.functional for c in covariants], dtype = bool)
+		scores = np.zeros(len(covariants), dtype = np.int64)
+		scores[known] = [self.functional[c] for c in covariants[known]]
+		if ((~known).any()):
+			scores[~known] = va.functional_scores(np.asarray(covariant_ids)[~known], weights, store)
+			self.functional.update(zip(covariants[~known], scores[~known].tolist()))
+			self.scored += int((~known).sum())
+		return(scores)
+
+	# Remember the scores of a ranking and return how many entities are new, dropped out or changed score since the
+	# previous run
+	def record(self, ranking, entity_column, score_column):
+		scores = ranking.drop_duplicates(subset = [entity_column]).set_index(entity_column)[score_column].astype(float)
+		scores.index = scores.index.astype(object)
+		previous = self.entity_scores
+		common = scores.index.intersection(previous.index)
+		changes = {'new': int((~scores.index.isin(previous.index)).sum()), 'dropped': int((~previous.index.isin(scores.index)).sum()), 'changed': int((scores[common] != previous[common]).sum())}
+		self.entity_scores = scores
+		return(changes)
+
+	# Write the state to its path.  Written under a temporary name and renamed into place, like the sheet cache, and
+	# failing to write it is not fatal.
+	def save(self):
+		state = {k: v for k, v in self.__dict__.items() if (k not in ['path', 'memo', 'reused', 'computed', 'scored'])}
+		try:
+			os.makedirs(os.path.dirname(self.path) or '.', exist_ok = True)
+			with open(self.path + '.tmp', 'wb') as f:
+				pickle.dump(state, f, protocol = pickle.HIGHEST_PROTOCOL)
+			os.replace(self.path + '.tmp', self.path)
+		except OSError as e:
+			print("WARNING! Could not save the ranking state ("+str(e)+"). The next run will recompute from scratch.")
+
+
+# Number of functional impact scores a ScoreStore keeps by default, how many seconds it waits for another process
+# writing to it, and how many lookups may pass before a score that keeps being looked up has its last use refreshed
+default_score_store_size = 1000000
+default_score_store_timeout = 60
+touch_interval = 64
+
+
+# 64-bit key of every canonical covariant string, as stored in a ScoreStore
+def covariant_keys(covariants):
+	return(pd.util.hash_array(np.asarray(covariants, dtype = object)).view(np.int64))
+
+
+# Persistent store of functional impact scores in an SQLite database, keyed by canonical covariant (as a 64-bit hash)
+# and the hash of the SFoC weight table it was scored against.  The score of a covariant only depends on those two, so
+# a covariant is scored once and every later run, report or ranking just looks it up.  The scores for the current SFoC
+# table are read into sorted arrays the first time they are needed, so lookups are a vectorized binary search rather
+# than one query per covariant.  The store holds at most max_entries scores and evicts the least recently used ones
+# beyond that.  Recency is tracked approximately: a score's last use is only rewritten once it is touch_interval
+# lookups old, so looking up scores that are in steady use writes nothing.  Processes ranking in parallel can share a
+# store: new covariants are scored before the store is written to, so each holds the write lock only briefly and the
+# others wait for it.  Pass it as the memo of VariantAnalysis.functional_ranking() or composite_ranking().
+class ScoreStore:
+
+	def __init__(self, path, max_entries = default_score_store_size, timeout = default_score_store_timeout):
+		self.path = path
+		self.max_entries = max_entries
+		self.scored = 0
+		self.looked_up = 0
+		self.digest = None
+		self.keys = np.zeros(0, dtype = np.int64)
+		self.values = np.zeros(0, dtype = np.int64)
+		self.used = np.zeros(0, dtype = np.int64)
+		if (os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path), exist_ok = True)
+		self.connection = sqlite3.connect(path, timeout = timeout)
+		self.connection.execute('CREATE TABLE IF NOT EXISTS scores (sfocs TEXT NOT NULL, covariant INTEGER NOT NULL, score INTEGER NOT NULL, used INTEGER NOT NULL, PRIMARY KEY (sfocs, covariant)) WITHOUT ROWID')
+		self.connection.execute('CREATE INDEX IF NOT EXISTS scores_used ON scores (used)')
+		self.clock, self.entries = self.connection.execute('SELECT COALESCE(MAX(used), 0), COUNT(*) FROM scores').fetchone()
+
+	# Read the scores stored for an SFoC table into sorted arrays
+	def load(self, digest):
+		rows = np.array(self.connection.execute('SELECT covariant, score, used FROM scores WHERE sfocs = ? ORDER BY covariant', (digest,)).fetchall(), dtype = np.int64).reshape(-1, 3)
+		self.digest = digest
+		self.keys = rows[:, 0]
+		self.values = rows[:, 1]
+		self.used = rows[:, 2]
+
+	# Functional impact scores of covariant IDs against a weight table.  Covariants already in the store cost one lookup,
+	# the rest are scored with VariantAnalysis.functional_scores() and added to it.
+	def scores(self, covariant_ids, weights, store = ve.covariant_store):
+		digest = weights_hash(weights)
+		if (digest != self.digest):
+			self.load(digest)
+		covariant_ids = np.asarray(covariant_ids)
+		keys = covariant_keys([store.covariants[i] for i in covariant_ids])
+		positions = np.searchsorted(self.keys, keys).clip(max = max(len(self.keys) - 1, 0))
+		known = (self.keys[positions] == keys) if (len(self.keys)) else np.zeros(len(keys), dtype = bool)
+		scores = np.where(known, self.values[positions] if (len(self.values)) else 0, 0)
+		self.clock += 1
+		missing = ~known
+		if (missing.any()):
+			scores[missing] = va.functional_scores(covariant_ids[missing], weights, store)
+		with self.connection:
+			stale = np.unique(positions[known & (self.used[positions] < self.clock - touch_interval)]) if (len(self.used)) else np.zeros(0, dtype = np.int64)
+			self.connection.executemany('UPDATE scores SET used = ? WHERE sfocs = ? AND covariant = ?', ((self.clock, digest, int(k)) for k in self.keys[stale]))
+			self.used[stale] = self.clock
+			if (missing.any()):
+				new_keys, first = np.unique(keys[missing], return_index = True)
+				new_scores = scores[missing][first]
+				self.connection.executemany('INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?)', ((digest, int(k), int(v), self.clock) for k, v in zip(new_keys, new_scores)))
+				order = np.argsort(np.concatenate([self.keys, new_keys]), kind = 'stable')
+				self.keys = np.concatenate([self.keys, new_keys])[order]
+				self.values = np.concatenate([self.values, new_scores])[order]
+				self.used = np.concatenate([self.used, np.full(len(new_keys), self.clock)])[order]
+				self.entries += len(new_keys)
+				self.scored += len(new_keys)
+			self.looked_up += int(known.sum())
+			if (self.entries > self.max_entries):
+				self.connection.execute('DELETE FROM scores WHERE (sfocs, covariant) IN (SELECT sfocs, covariant FROM scores ORDER BY used LIMIT ?)', (self.entries - self.max_entries,))
+				self.entries = self.max_entries
+				self.digest = None
+		return(scores)
+
+	def close(self):
+		self.connection.close()
+
+
+# Number of rankings a ResultCache keeps in memory, and on disk, by default
+default_result_cache_size = 256
+default_result_disk_size = 4096
+
+# Ranking functions of VariantAnalysis whose results a ResultCache can hold
+cached_rankings = ['lineage_ranking', 'sequence_ranking', 'functional_ranking', 'composite_ranking', 'mutation_ranking', 'lineage_ranking_by_location', 'sequence_ranking_by_location', 'mutation_ranking_by_location', 'lineage_ranking_rolling', 'sequence_ranking_rolling', 'mutation_ranking_rolling', 'lineage_ranking_sweep', 'sequence_ranking_sweep', 'mutation_ranking_sweep']
+
+# Filters whose order does not change a ranking, so they are keyed as sorted sets
+unordered_filters = ['who', 'lineage']
+
+
+# Cheap fingerprint of a frame passed to a ranking: its shape, columns, dtypes and a hash of its row labels.  The frames
+# of one report only differ by which of its rows they hold, so this tells apart a region, a filtered subset or a
+# report cut, without hashing every cell.
+def frame_fingerprint(frame):
+	index = pd.util.hash_array(np.asarray(frame.index)).sum(dtype = np.uint64) if (len(frame)) else 0
+	columns = frame.columns if (isinstance(frame, pd.DataFrame)) else [frame.name]
+	dtypes = frame.dtypes if (isinstance(frame, pd.DataFrame)) else [frame.dtype]
+	return([len(frame), [str(c) for c in columns], [str(d) for d in dtypes], str(index)])
+
+# JSON ready form of an argument of a ranking, the same for any two arguments that give the same ranking
+def normalized_argument(name, value):
+	if (isinstance(value, (pd.DataFrame, pd.Series))):
+		return(frame_fingerprint(value))
+	if (isinstance(value, np.ndarray)):
+		return(weights_hash(value))
+	if (isinstance(value, tuple)):
+		return([normalized_argument(name, v) for v in value])
+	if (isinstance(value, (list, pd.Index))):
+		values = [str(v) for v in value]
+		if (name == 'covariants'):
+			values = [ve.canonical_covariant(v) for v in values]
+		return(sorted(set(values)) if (name in unordered_filters) else values)
+	if (isinstance(value, (np.integer, np.floating))):
+		return(value.item())
+	return(value)
+
+
+# Cache of ranking results keyed by the report they were computed from, the ranking function, its normalized filters
+# and its interval.  The most recent results are held in memory in an LRU of max_entries rankings, and with a directory
+# every result is also pickled there, so later runs against the same report answer the same query without ranking
+# again.  The directory keeps at most max_disk_entries results and removes the least recently used beyond that.  Use
+# functions() to get VariantAnalysis ranking functions answered through the cache.  Calls given a RankingState (as
+# the state or memo) are always computed, as they update the state, and the memo of functional impact scores is not
+# part of the key since it never changes a score.  Hits, hits from disk and misses are counted.
+class ResultCache:
+
+	def __init__(self, directory = None, max_entries = default_result_cache_size, max_disk_entries = default_result_disk_size):
+		self.directory = directory
+		self.max_entries = max_entries
+		self.max_disk_entries = max_disk_entries
+		self.memory = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.disk_hits = 0
+		self.misses = 0
+		if (directory):
+			os.makedirs(directory, exist_ok = True)
+
+	# Key of a call of a ranking function: a hash of the source (anything JSON serializable that identifies the report,
+	# e.g. its hash), the function and its normalized arguments
+	def key(self, source, function, arguments):
+		arguments = {name: normalized_argument(name, value) for name, value in arguments.items() if (name not in ['state', 'memo'])}
+		return(hashlib.sha256(json.dumps([source, function.__module__+'.'+function.__name__, arguments], sort_keys = True, default = str).encode('utf-8')).hexdigest())
+
+	def path(self, key):
+		return(os.path.join(self.directory, key+'.pkl'))
+
+	# Cached result of a key, or None.  Results read from disk are moved into memory and refreshed on disk.
+	def lookup(self, key):
+		with self.lock:
+			if (key in self.memory):
+				self.memory.move_to_end(key)
+				self.hits += 1
+				return(self.memory[key])
+		if (self.directory):
+			try:
+				with open(self.path(key), 'rb') as f:
+					result = pickle.load(f)
+				os.utime(self.path(key))
+			except (OSError, pickle.UnpicklingError, EOFError):
+				result = None
+			if (result is not None):
+				self.remember(key, result)
+				with self.lock:
+					self.hits += 1
+					self.disk_hits += 1
+				return(result)
+		with self.lock:
+			self.misses += 1
+		return(None)
+
+	def remember(self, key, result):
+		with self.lock:
+			self.memory[key] = result
+			self.memory.move_to_end(key)
+			while (len(self.memory) > self.max_entries):
+				self.memory.popitem(last = False)
+
+	# Cache a result.  Failing to write it to disk is not fatal.
+	def store(self, key, result):
+		self.remember(key, result)
+		if (not self.directory):
+			return
+		try:
+			with open(self.path(key) + '.tmp', 'wb') as f:
+				pickle.dump(result, f, protocol = pickle.HIGHEST_PROTOCOL)
+			os.replace(self.path(key) + '.tmp', self.path(key))
+			entries = [e for e in os.scandir(self.directory) if (e.name.endswith('.pkl'))]
+			if (len(entries) > self.max_disk_entries):
+				for entry in sorted(entries, key = lambda e: e.stat().st_mtime)[:len(entries) - self.max_disk_entries]:
+					os.remove(entry.path)
+		except OSError as e:
+			print("WARNING! Could not save a ranking to the result cache ("+str(e)+").")
+
+	# A ranking function answered through the cache for data of the given source.  Results are copied on the way in and
+	# out, so callers may change the rankings they get.
+	def wrap(self, function, source):
+		signature = inspect.signature(function)
+		def cached(*args, **kwargs):
+			arguments = signature.bind(*args, **kwargs)
+			arguments.apply_defaults()
+			if (any(isinstance(arguments.arguments.get(name), RankingState) for name in ['state', 'memo'])):
+				return(function(*args, **kwargs))
+			key = self.key(source, function, arguments.arguments)
+			result = self.lookup(key)
+			if (result is None):
+				result = function(*args, **kwargs)
+				self.store(key, result.copy())
+			return(result.copy())
+		cached.__name__ = function.__name__
+		cached.__doc__ = function.__doc__
+		return(cached)
+
+	# The ranking functions of VariantAnalysis, as attributes named after them, answered through the cache for data of
+	# the given source.  Pass it in place of the VariantAnalysis module.
+	def functions(self, source):
+		return(types.SimpleNamespace(**{name: self.wrap(getattr(va, name), source) for name in cached_rankings}))
+
+	# Add the hits and misses another cache counted, such as the caches of the workers of a parallel run
+	def count(self, stats):
+		with self.lock:
+			self.hits += stats['hits']
+			self.disk_hits += stats['disk_hits']
+			self.misses += stats['misses']
+
+	def stats(self):
+		return({'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses, 'entries': len(self.memory)})
+
+	# One line summary of the statistics, e.g. 'Result cache: 3 hits (1 from disk), 2 misses'
+	def summary(self):
+		return("Result cache: "+str(self.hits)+" hits ("+str(self.disk_hits)+" from disk), "+str(self.misses)+" misses")
@@ -0,0 +1,212 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import VariantData as vd
+
+# Labels and ranges used to make up synthetic reports
+who_labels = ['Omicron', 'Delta', 'Alpha', 'Beta', 'Gamma']
+pango_prefixes = ['BA', 'BQ', 'XBB', 'EG', 'JN', 'CH', 'AY', 'B.1']
+residue_letters = 'ACDEFGHIKLMNPQRSTVWY'
+spike_length = 1273
+mab_classes = ['class 1', 'class 2', 'class 3', 'class 4']
+serum_escapes = ['convalescent serum', 'Moderna vaccine serum']
+regions_of_interest = ['NTD supersite', 'RBM', 'furin cleavage site', 'fusion peptide']
+
+# Sizes of the synthetic reports the benchmarks run on.  'peak' is about the size of a World - Variants sheet at the
+# height of the pandemic, several hundred thousand rows.
+scales = {
+	'small': {'countries': 20, 'lineages': 10, 'covariants_per_lineage': 5, 'months': 9, 'sfoc_rows': 50},
+	'medium': {'countries': 80, 'lineages': 60, 'covariants_per_lineage': 20, 'months': 12, 'sfoc_rows': 500},
+	'peak': {'countries': 200, 'lineages': 300, 'covariants_per_lineage': 40, 'months': 12, 'sfoc_rows': 2000},
+}
+
+
+# Month labels of a report with the given number of months, most recent first, e.g. ['2023-09', '2023-08', ...]
+def month_labels(months, last_month = '2023-09'):
+	return([str(m) for m in np.datetime64(last_month, 'M') - np.arange(months)])
+
+
+# Make up the lineages and covariants of a report.  Every lineage gets a WHO Label (a few are left blank, as in the
+# real report) and a set of Spike mutations it is defined by, and every covariant of a lineage is that set with a few
+# mutations added or dropped, written in the report's comma separated form, e.g. 'T19I,L24-,P25-'.  Returns a frame
+# with the WHO Label, PANGO Lineage and Variant of every covariant, and the mutations of every covariant.
+def synthetic_covariants(lineages, covariants_per_lineage, rng):
+	positions = np.sort(rng.choice(np.arange(1, spike_length + 1), size = min(400, spike_length), replace = False))
+	wild_type = rng.choice(list(residue_letters), size = len(positions))
+	mutated = np.where(rng.random(len(positions)) < 0.1, '-', rng.choice(list(residue_letters), size = len(positions)))
+	mutations = np.array([w + str(p) + m for w, p, m in zip(wild_type, positions, mutated)], dtype = object)
+	rows = []
+	covariant_mutations = []
+	seen = set()
+	for i in range(lineages):
+		who = np.nan if (rng.random() < 0.05) else who_labels[0] if (rng.random() < 0.7) else rng.choice(who_labels[1:])
+		pango = pango_prefixes[i % len(pango_prefixes)] + '.' + str(i // len(pango_prefixes) + 1)
+		base = rng.choice(len(positions), size = rng.integers(8, 15), replace = False)
+		for j in range(covariants_per_lineage):
+			members = set(base.tolist())
+			members.difference_update(rng.choice(base, size = rng.integers(0, 3), replace = False).tolist())
+			members.update(rng.choice(len(positions), size = rng.integers(0, 4)).tolist())
+			members = sorted(members)
+			variant = ','.join(mutations[members])
+			if (variant in seen):
+				continue
+			seen.add(variant)
+			rows.append((who, pango, variant))
+			covariant_mutations.append(members)
+	covariants = pd.DataFrame(rows, columns = ['WHO Label', 'PANGO Lineage', 'Variant'])
+	return(covariants, covariant_mutations, mutations, positions)
+
+
+# Monthly metric columns of a sheet, in the report's layout ('Variant Count - [Month]', 'Isolates Count - [Month]',
+# 'Prevalence - [Month]', 'Growth Rate - [Month]' for every month, most recent first).  Takes the counts (rows x
+# months, oldest month first) and the isolates of the location of every row (same shape).  Months without sequences
+# are left blank, as are growth rates without a count the month before.
+def metric_columns(counts, isolates, months):
+	counts = np.where(counts > 0, counts, np.nan)
+	with np.errstate(divide = 'ignore', invalid = 'ignore'):
+		prevalence = counts / isolates
+		growth = np.full(counts.shape, np.nan)
+		growth[:, 1:] = counts[:, 1:] / counts[:, :-1]
+	columns = {}
+	for t, month in enumerate(months):
+		column = counts.shape[1] - 1 - t
+		columns['Variant Count - '+month] = counts[:, column]
+		columns['Isolates Count - '+month] = isolates[:, column]
+		columns['Prevalence - '+month] = prevalence[:, column]
+		columns['Growth Rate - '+month] = growth[:, column]
+	return(columns)
+
+
+# Sum rows of counts (rows x months) by group code, keeping only the groups that occur
+def group_sums(codes, counts):
+	groups, inverse = np.unique(codes, return_inverse = True)
+	sums = np.zeros((len(groups), counts.shape[1]))
+	np.add.at(sums, inverse, counts)
+	return(groups, sums)
+
+
+# Make up the variants, lineages and point mutation sheets of one set of locations.  Every covariant is seen in each
+# location with probability density, with a count that grows or shrinks along the months at its own rate, and the
+# 'All' rows sum every location.  Isolates are the sequences of a location in a month, of which the covariants make up
+# a part.  Mutation rows sum the covariants holding the mutation.
+def synthetic_location_sheets(covariants, covariant_mutations, mutations, positions, locations, location_column, months, density, rng):
+	n_months = len(months)
+	trend = rng.normal(0, 0.35, size = len(covariants))
+	share = rng.lognormal(0, 1.5, size = len(covariants))
+	size = rng.lognormal(3, 1.2, size = len(locations))
+	present = rng.random((len(locations), len(covariants))) < density
+	location_rows, covariant_rows = np.nonzero(present)
+	expected = size[location_rows, None] * share[covariant_rows, None] * np.exp(trend[covariant_rows, None] * (np.arange(n_months) - n_months + 1))
+	counts = rng.poisson(expected).astype(float)
+	isolates = np.zeros((len(locations) + 1, n_months))
+	np.add.at(isolates, location_rows, counts)
+	isolates[-1] = isolates[:-1].sum(axis = 0)
+	isolates = np.maximum(np.round(isolates * rng.uniform(1.5, 3, size = (len(locations) + 1, 1))), 1)
+
+	all_covariants, all_counts = group_sums(covariant_rows, counts)
+	location_rows = np.concatenate([np.full(len(all_covariants), len(locations)), location_rows])
+	covariant_rows = np.concatenate([all_covariants, covariant_rows])
+	counts = np.concatenate([all_counts, counts])
+	location_names = np.array(['All'] + list(locations), dtype = object)[(location_rows + 1) % (len(locations) + 1)]
+	labels = covariants.iloc[covariant_rows].reset_index(drop = True)
+	variants = pd.concat([pd.DataFrame({location_column: location_names}), labels, pd.DataFrame(metric_columns(counts, isolates[location_rows], months))], axis = 1)
+
+	lineage_codes, lineage_names = pd.factorize(covariants['PANGO Lineage'])
+	groups, lineage_counts = group_sums(location_rows * len(lineage_names) + lineage_codes[covariant_rows], counts)
+	group_locations = groups // len(lineage_names)
+	first_covariant = pd.Series(np.arange(len(covariants))).groupby(lineage_codes).first().to_numpy()
+	lineage_labels = covariants[['WHO Label', 'PANGO Lineage']].iloc[first_covariant[groups % len(lineage_names)]].reset_index(drop = True)
+	group_names = np.array(['All'] + list(locations), dtype = object)[(group_locations + 1) % (len(locations) + 1)]
+	lineages = pd.concat([pd.DataFrame({location_column: group_names}), lineage_labels, pd.DataFrame(metric_columns(lineage_counts, isolates[group_locations], months))], axis = 1)
+
+	lengths = np.array([len(m) for m in covariant_mutations])
+	offsets = np.cumsum(lengths) - lengths
+	members = np.concatenate(covariant_mutations)
+	row_lengths = lengths[covariant_rows]
+	row_index = np.repeat(np.arange(len(covariant_rows)), row_lengths)
+	row_member = members[np.repeat(offsets[covariant_rows] - (np.cumsum(row_lengths) - row_lengths), row_lengths) + np.arange(row_lengths.sum())]
+	groups, mutation_counts = group_sums(location_rows[row_index] * len(mutations) + row_member, counts[row_index])
+	group_locations = groups // len(mutations)
+	group_names = np.array(['All'] + list(locations), dtype = object)[(group_locations + 1) % (len(locations) + 1)]
+	point_mutations = pd.concat([pd.DataFrame({'Country': group_names, 'Variant': mutations[groups % len(mutations)], 'Position': positions[groups % len(mutations)]}), pd.DataFrame(metric_columns(mutation_counts, isolates[group_locations], months))], axis = 1)
+	return(variants, lineages, point_mutations)
+
+
+# Make up the SFoCs sheet: sfoc_rows sites of concern, mostly on Spike, each covering a residue range and marked with
+# the mAb escape classes, serum escapes, ACE2 binding and regions of interest that functional_ranking() scores
+def synthetic_sfocs(sfoc_rows, rng):
+	starts = rng.integers(1, spike_length, size = sfoc_rows)
+	ends = np.minimum(starts + rng.geometric(0.2, size = sfoc_rows) - 1, spike_length)
+	mab = [', '.join(c for c in mab_classes if (rng.random() < 0.2)) or np.nan for i in range(sfoc_rows)]
+	serum = [' and '.join(s for s in serum_escapes if (rng.random() < 0.2)) or np.nan for i in range(sfoc_rows)]
+	return(pd.DataFrame({
+		'Protein': np.where(rng.random(sfoc_rows) < 0.9, 'Spike', 'N'),
+		'Start': starts,
+		'End': ends,
+		'mAb escape': mab,
+		'serum Ab escape': serum,
+		'Increased ACE2 binding': np.where(rng.random(sfoc_rows) < 0.2, 'yes', None),
+		'Region of interest': np.where(rng.random(sfoc_rows) < 0.3, rng.choice(regions_of_interest, size = sfoc_rows), None),
+	}))
+
+
+# Make up a whole Emerging Variants Report with the sheets and column conventions main.py expects: 'World - Variants',
+# 'World - Lineages', 'AA Mutations', 'USA - Variants', 'USA - Lineages' and 'SFoCs'.  Returns a dictionary of sheet
+# name to DataFrame.  The same arguments and seed always give the same report.
+def synthetic_report(countries = 20, lineages = 10, covariants_per_lineage = 5, months = 9, sfoc_rows = 50, usa_regions = 10, density = 0.3, last_month = '2023-09', seed = 0):
+	rng = np.random.default_rng(seed)
+	labels = month_labels(months, last_month)
+	covariants, covariant_mutations, mutations, positions = synthetic_covariants(lineages, covariants_per_lineage, rng)
+	country_names = ['Country '+str(i + 1) for i in range(countries)] + ['Unknown']
+	world_variants, world_lineages, point_mutations = synthetic_location_sheets(covariants, covariant_mutations, mutations, positions, country_names, 'Country', labels, density, rng)
+	region_names = ['Region '+str(i + 1) for i in range(usa_regions)]
+	usa_variants, usa_lineages, usa_mutations = synthetic_location_sheets(covariants, covariant_mutations, mutations, positions, region_names, 'Region', labels, density, rng)
+	usa_mutations = usa_mutations[usa_mutations['Country'] == 'All'].assign(Country = 'USA')
+	return({
+		'World - Variants': world_variants,
+		'World - Lineages': world_lineages,
+		'AA Mutations': pd.concat([point_mutations, usa_mutations], ignore_index = True),
+		'USA - Variants': usa_variants,
+		'USA - Lineages': usa_lineages,
+		'SFoCs': synthetic_sfocs(sfoc_rows, rng),
+	})
+
+
+# Write a synthetic report as an xlsx workbook, one sheet per entry
+def write_report(sheets, path):
+	with pd.ExcelWriter(path) as writer:
+		for name, sheet_df in sheets.items():
+			sheet_df.to_excel(writer, sheet_name = name, index = False)
+
+# Write every sheet of a synthetic report as a flat export that can be passed to '--filename', e.g.
+# 'World_-_Variants.txt' (tab separated) or, with sep = ',', 'World_-_Variants.csv'
+def write_exports(sheets, directory, sep = '\t'):
+	os.makedirs(directory, exist_ok = True)
+	paths = {}
+	for name, sheet_df in sheets.items():
+		paths[name] = os.path.join(directory, vd.sheet_slug(name) + ('.csv' if (sep == ',') else '.txt'))
+		sheet_df.to_csv(paths[name], sep = sep, index = False)
+	return(paths)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'Write a synthetic Emerging Variants Report')
+	parser.add_argument('--output', dest = 'output', type = str, required = True, help = 'xlsx workbook, or a directory for TSV exports')
+	parser.add_argument('--scale', dest = 'scale', type = str, choices = list(scales))
+	parser.add_argument('--countries', dest = 'countries', type = int)
+	parser.add_argument('--lineages', dest = 'lineages', type = int)
+	parser.add_argument('--covariants_per_lineage', dest = 'covariants_per_lineage', type = int)
+	parser.add_argument('--months', dest = 'months', type = int)
+	parser.add_argument('--sfoc_rows', dest = 'sfoc_rows', type = int)
+	parser.add_argument('--seed', dest = 'seed', type = int, default = 0)
+	args = parser.parse_args()
+
+	settings = dict(scales[args.scale or 'small'])
+	settings.update({k: v for k, v in vars(args).items() if (k in settings and v is not None)})
+	sheets = synthetic_report(seed = args.seed, **settings)
+	if (args.output.endswith('.xlsx')):
+		write_report(sheets, args.output)
+	else:
+		write_exports(sheets, args.output)
+	print("Wrote a synthetic report with "+', '.join(str(len(sheets[s]))+" '"+s+"' rows" for s in sheets)+" to "+args.output)
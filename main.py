@@ -2,13 +2,26 @@
 
 import codecs
 import ast
+import os
+import json
 import argparse
 import sys
 import re
+import types
+import functools
 import pandas as pd
 import numpy as np
 import VariantAnalysis as va
 import VariantPlots as vp
+import VariantData as vd
+import VariantEncoding as ve
+import VariantCube as vc
+import VariantState as vs
+import VariantProfile as vpr
+import VariantSimilarity as vsi
+import VariantLineage as vl
+import VariantHistory as vh
+import VariantParallel as vpl
 
 
 # Report the graph usage to the commandline
@@ -38,6 +51,8 @@ def graph_args_usage():
 	print('---')
 	print("(11) python [Everything in (9) or (10)] --country [Country]")
 	print('---')
+	print("(12) python [Everything in (1) to (11)] --graph_type [prevalence/growth/proportion] --graph_format [png/svg/pdf]")
+	print('---')
 	print("NOTE: Options 1-6 are for graphing PANGO Lineage trends, 7-9 is for graphing covariant trends, and 10-11 is for point mutation trends")
 	print('\n')
 	print("See ReadMe.md for details on graph analysis.")
@@ -86,7 +101,70 @@ def program_usage():
 	print('---')
 	print("(6) graph: Graph trends of PANGO Lineages, trends of covariants within a PANGO Lineage, WHO Label, or inputed file, or trends of single point mutations")
 	print('---')
-	print("(7) help: Print out the GENERAL USAGE and GRAPH USAGE")
+	print("(7) similar: Find the covariants of the Emerging Variants Report that share the most Spike substitutions with each covariant of an inputted file, saved in the covariants file format")
+	print("(a) python main.py --filename [Emerging Variants Report] --analysis similar --covariants [Covariants TXT File]")
+	print("(b) python [Everything in (a)] --top [Number of Covariants] --metric [jaccard/hamming] --country [Country]")
+	print("(c) python [Everything in (a)] --minhash [Number of Hashes]")
+	print('---')
+	print("(8) cube: Convert the Emerging Variants Report into memory mapped cubes that can be passed to '--filename' in place of the report")
+	print("(a) python main.py --filename [Emerging Variants Report] --analysis cube --cube_dir [Directory]")
+	print('---')
+	print("(9) ingest: Append the Emerging Variants Report to a history store, which can then be passed to '--filename' in place of a report to rank and graph every month of every report ingested")
+	print("(a) python main.py --filename [Emerging Variants Report] --analysis ingest --history_dir [Directory]")
+	print("(b) python [Everything in (a)] --report_date [YYYY-MM-DD]")
+	print('---')
+	print("MONTHS: Any ranking can use a calendar range of months in place of '--interval', with either end left open")
+	print("(a) python [Ranking Commandline] --from [YYYY-MM] --to [YYYY-MM]")
+	print('---')
+	print("BY LOCATION: Add '--by_location' to lineage_ranking, sequence_ranking or mutation_ranking to rank every country (or every USA region with '--country USA') in one pass")
+	print("(a) python main.py --filename [Emerging Variants Report] --analysis [lineage_ranking/sequence_ranking/mutation_ranking] --by_location")
+	print("(b) python [Everything in (a)] --interval [Interval] --country USA")
+	print('---')
+	print("ROLLING: Add '--rolling' to lineage_ranking, sequence_ranking or mutation_ranking to score every window of '--interval' months across the report's history in one pass, as a table of scores by window end month")
+	print("(a) python [Ranking Commandline] --rolling")
+	print("(b) python [Everything in (a)] --interval [Interval] --from [YYYY-MM] --to [YYYY-MM]")
+	print('---')
+	print("ROLLUP: Add '--rollup' to lineage_ranking, to a ranking or graph of a PANGO Lineage, or to a graph of lineages to count every lineage together with all of its sublineages, optionally expanding aliases such as BQ with a PANGO alias table")
+	print("(a) python main.py --filename [Emerging Variants Report] --analysis lineage_ranking --rollup")
+	print("(b) python main.py --filename [Emerging Variants Report] --analysis [sequence_ranking/functional_ranking/composite_ranking/graph] --PANGO [PANGO Lineage] --rollup")
+	print("(c) python main.py --filename [Emerging Variants Report] --analysis graph --[lineage/lineage_file] [PANGO Lineage/Lineages TXT File] --rollup")
+	print("(d) python [Everything in (a), (b) or (c)] --aliases [Alias Table JSON/TXT File]")
+	print('---')
+	print("DERIVED MUTATIONS: Add '--derive_mutations' to mutation_ranking or a graph of point mutations to count the point mutations from the covariants of the variants sheet instead of the AA Mutations sheet, which also ranks the mutations of every USA region. Giving a PANGO Lineage, WHO Label or covariants file to mutation_ranking counts the mutations of those covariants only")
+	print("(a) python [Mutation Ranking or Graph Commandline] --derive_mutations")
+	print("(b) python main.py --filename [Emerging Variants Report] --analysis mutation_ranking --domain [NTD/RBD/Spike/Other] --[PANGO/WHO/covariants] [PANGO Lineage/WHO Label/Covariants TXT File]")
+	print('---')
+	print("SWEEP: Add threshold grids to lineage_ranking, sequence_ranking or mutation_ranking to score every combination of growth rate, prevalence and minimum Variant Count thresholds in one pass, as a tidy table")
+	print("(a) python [Ranking Commandline] --growth_grid [Thresholds] --prevalence_grid [Thresholds] --count_grid [Thresholds], each comma separated, e.g. --growth_grid 1,2,5,10")
+	print('---')
+	print("INCREMENTAL: Add '--incremental' to a ranking of a whole region to only recompute what changed since the previous run of the same ranking")
+	print("(a) python [Ranking Commandline] --incremental")
+	print('---')
+	print("SCORE STORE: Add '--score_store' to a functional_ranking or composite_ranking to keep functional impact scores in the cache directory and look them up in later runs")
+	print("(a) python [Ranking Commandline] --score_store")
+	print('---')
+	print("HEADLESS GRAPHS: Add '--graph_type' to any ranking or graph to skip every prompt and save the graphs to files instead of showing them")
+	print("(a) python [Ranking or Graph Commandline] --graph_type [prevalence/growth/proportion, comma separated for several, or none for no graph]")
+	print("(b) python [Everything in (a)] --graph_format [png/svg/pdf]")
+	print('---')
+	print("COMPACT: Add '--compact' to any analysis or batch to hold the report in compact dtypes (categorical labels, float32 and small integer metrics) and print the memory saved")
+	print("(a) python [Any Commandline] --compact")
+	print('---')
+	print("EXPORTS: A TSV (.txt/.tsv) or CSV (.csv) export of one sheet of the report can be given to '--filename' in place of the report, for the analyses that only need that sheet")
+	print("(a) python main.py --filename [Sheet TSV/CSV Export] --analysis [Analysis Option] --graph_type none")
+	print('---')
+	print("RESULT CACHE: Add '--result_cache' to any ranking or graph to keep its rankings in the cache directory, so running the same query on the same report again returns at once")
+	print("(a) python [Ranking or Graph Commandline] --result_cache")
+	print('---')
+	print("PROFILE: Add '--profile' to any analysis or batch to time every stage (wall and CPU time, peak memory, rows in and out), save a JSON trace and print a summary at exit")
+	print("(a) python [Any Commandline] --profile")
+	print("(b) python [Any Commandline] --profile [Trace JSON File]")
+	print('---')
+	print("BATCH: Run a list of ranking jobs against a single load of the report, saving every ranking under its usual TSV name")
+	print("(a) python main.py --filename [Emerging Variants Report] --manifest [Jobs JSON/YAML File]")
+	print("(b) python main.py --filename [Emerging Variants Report] --manifest [Jobs JSON/YAML File] --workers [Number of Processes]")
+	print('---')
+	print("(10) help: Print out the GENERAL USAGE and GRAPH USAGE")
 	print('\n')
 	print("See ReadMe.md for more specific details regarding usage.")
 	print('\n')
@@ -101,13 +179,15 @@ def open_covariants_file(file):
 			if ('Name' in covariants_file.columns):
 				covariants_file['Name'] = covariants_file['Name'].str.encode('ascii', 'ignore').str.decode('ascii')
 				covariants_file['Name'] = covariants_file['Name'].str.replace('Ê', '')
-			covariants_file['Variant'] = covariants_file['Variant'].str.replace(' ', '')
-			covariants_file['Variant'] = covariants_file['Variant'].str.replace('Ê', '')
-			return(covariants_file)
 		else:
 			sys.exit("Invalid covariants file format. Inputted covariants file must be tabular with one column labeled 'Variant'.  Optional 'Name' or 'Identifier' columns permitted. See ReadMe.md for more details.")
 	except:
 		raise Exception("Could not open covariants file")
+	try:
+		covariants_file['Variant'] = ve.covariant_store.canonical(covariants_file['Variant'])
+	except ValueError as e:
+		sys.exit("Invalid covariant in the covariants file. "+str(e)+".")
+	return(covariants_file)
 
 # Used for opening the file with list of countries, lineages, and single point mutations
 def open_optional_file(file):
@@ -117,22 +197,725 @@ def open_optional_file(file):
 	except:
 		raise Exception("Could not open optional TXT file")
 
-# Opens the Emerging Variants Report and returns the data from the spreadsheet
-def open_emerging_variants(file):
+# Opens the Emerging Variants Report and returns a handle for reading its sheets.  Parsed sheets are cached in
+# cache_dir, so only the first run against a given report pays for parsing the spreadsheet.  A directory of cubes
+# built with the 'cube' analysis option can be opened in place of the report, as can a history store built with the
+# 'ingest' analysis option, and so can a flat TSV (.txt/.tsv) or CSV (.csv) export of one of its sheets, which is
+# streamed with the row filters from export_filters().
+@vpr.profiled
+def open_emerging_variants(file, cache_dir = vd.default_cache_dir, filters = {}):
+	if (os.path.isdir(file) and vh.is_history(file)):
+		print("Opening the Emerging Variants Report history ...")
+		return(vh.ReportHistory(file))
+	if (os.path.isdir(file)):
+		print("Opening the Emerging Variants Report cubes ...")
+		return(vc.ReportCubes(file))
+	if (os.path.splitext(file)[1].lower() in vd.delimited_extensions):
+		try:
+			print("Opening the Emerging Variants Report export ...")
+			return(vd.DelimitedReport(file, cache_dir = cache_dir, **filters))
+		except:
+			raise Exception("Could not open file for Emerging Variants Report export")
 	try:
 		print("Opening the Emerging Variants Report ...")
-		variants_xlsx = pd.ExcelFile(file)
-		return(variants_xlsx)
+		variants_report = vd.EmergingVariantsReport(file, cache_dir)
+		variants_report.hash()
+		return(variants_report)
 	except:
 		raise Exception("Could not open file for Emerging Variants Report")
 
 
+# Columns read from each kind of sheet in the Emerging Variants Report.  Metric names such as 'Prevalence' select every
+# monthly column of that metric.  The variants and lineages sheets for the USA use 'Region' in place of 'Country'.
+variant_columns = ['Country', 'Region', 'WHO Label', 'PANGO Lineage', 'Variant', 'Variant Count', 'Isolates Count', 'Prevalence', 'Growth Rate']
+lineage_columns = ['Country', 'Region', 'WHO Label', 'PANGO Lineage', 'Variant Count', 'Isolates Count', 'Prevalence', 'Growth Rate']
+mutation_columns = ['Country', 'Variant', 'Position', 'Variant Count', 'Isolates Count', 'Prevalence', 'Growth Rate']
+
+# Work out which sheets of the Emerging Variants Report, and which columns of them, the requested analysis needs.
+# Returns a dictionary of sheet name to columns that can be passed straight to EmergingVariantsReport.sheets().
+def required_sheets(args):
+	if (args.country == 'USA'):
+		variants_sheet = 'USA - Variants'
+		lineages_sheet = 'USA - Lineages'
+	else:
+		variants_sheet = 'World - Variants'
+		lineages_sheet = 'World - Lineages'
+	graph_covariants = (args.analysis == 'graph' and (args.covariant or args.pango or args.who))
+	graph_mutations = (args.analysis == 'graph' and (args.mutation or args.domain))
+	graph_lineages = (args.analysis == 'graph' and not (graph_covariants or graph_mutations))
+	graph_all_lineages = (graph_lineages and not (args.lineage or args.lineage_file or args.country_file))
+	requests = {}
+	if (args.analysis in ['lineage_ranking', 'sequence_ranking', 'functional_ranking', 'composite_ranking', 'similar'] or graph_covariants or graph_all_lineages):
+		requests[variants_sheet] = variant_columns
+	if ((args.analysis == 'lineage_ranking' and getattr(args, 'graph_types', None) != []) or graph_lineages):
+		requests[lineages_sheet] = lineage_columns
+	if (args.country_file or (graph_lineages and (args.lineage or (args.lineage_file and not args.country)))):
+		requests['World - Lineages'] = lineage_columns
+	if ((args.analysis == 'mutation_ranking' or graph_mutations) and derives_mutations(args)):
+		requests[variants_sheet] = variant_columns
+	elif (args.analysis == 'mutation_ranking' or graph_mutations):
+		requests['AA Mutations'] = mutation_columns
+	if (args.analysis in ['functional_ranking', 'composite_ranking']):
+		requests['SFoCs'] = None
+	return(requests)
+
+
+# Whether the point mutations of a mutation ranking or graph are derived from the covariant rows of the variants sheet
+# rather than read from the 'AA Mutations' sheet: when asked to, and always for the covariants of a single PANGO
+# Lineage, WHO Label or covariants file, which the 'AA Mutations' sheet cannot break down by
+def derives_mutations(args):
+	mutations = (args.analysis == 'mutation_ranking' or (args.analysis == 'graph' and (args.mutation or args.domain)))
+	return(bool(mutations and (getattr(args, 'derive_mutations', False) or args.pango or args.who or args.covariant)))
+
+
+# Row filters that can be applied while streaming a flat export of the report for the requested analysis, as keyword
+# arguments of VariantData.DelimitedReport.  Rows the analysis would drop anyway are never kept in memory: other WHO
+# Labels or PANGO Lineages than the one asked for, countries other than the one asked for, the 'Unknown' country, and,
+# for rankings over the most recent months drawing no graph, the 'All' rows and rows with no more than 10 Variant
+# Counts in the most recent month (though not when point mutations are derived from the covariant rows, where every
+# row adds to the counts of its mutations).
+def export_filters(args):
+	rankings = (args.analysis in ranking_options)
+	no_graph = (rankings and (getattr(args, 'graph_types', None) == [] or args.by_location))
+	keep = {}
+	drop = {}
+	if (args.who and (rankings or args.analysis == 'graph')):
+		keep['WHO Label'] = [args.who]
+	if (args.pango and (rankings or args.analysis == 'graph') and not getattr(args, 'rollup', False)):
+		keep['PANGO Lineage'] = [args.pango]
+	if (args.country and args.country != 'USA' and not (args.country_file or args.lineage)):
+		keep['Country'] = [args.country]
+	elif (not args.country and (rankings or args.analysis == 'graph')):
+		drop['Country'] = ['All', 'Unknown'] if (no_graph) else ['Unknown']
+	first_count_cut = (args.analysis in ['lineage_ranking', 'sequence_ranking', 'mutation_ranking', 'composite_ranking'] or (args.analysis == 'functional_ranking' and not (args.pango or args.who or args.covariant)))
+	whole_window = (args.start or args.end or getattr(args, 'rolling', False) or getattr(args, 'rollup', False) or threshold_grids(args) or derives_mutations(args))
+	return({'keep': keep, 'drop': drop, 'min_count': 10 if (no_graph and first_count_cut and not whole_window) else None})
+
+
+# Read the requested sheets and intern their covariants.  Exits when the report, such as a flat export of a single
+# sheet, does not hold every sheet the analysis needs.  With compact, the data sheets are converted to compact dtypes
+# (see VariantData.compact_frame()) and the memory they use before and after is printed.
+@vpr.profiled
+def read_sheets(variants_report, requests, compact = False):
+	with vpr.span('load sheets') as span:
+		report_sheets = variants_report.sheets(requests)
+		span['rows_out'] = vpr.row_count(report_sheets)
+	missing = [sheet for sheet in requests if (sheet not in report_sheets)]
+	if (missing):
+		sys.exit("The report given does not hold the sheets this analysis needs: "+', '.join(missing)+". Please try again with the full Emerging Variants Report.")
+	undated = [sheet for sheet in report_sheets if (sheet != 'SFoCs' and (requests.get(sheet) is None or set(requests[sheet]) & set(vd.metrics)) and not len(vd.report_schema(report_sheets[sheet].columns).months))]
+	if (undated):
+		sys.exit("No monthly columns could be read in: "+', '.join(undated)+". Monthly columns must be headed 'Metric - YYYY-MM' or 'Metric - YYYYMM', e.g. 'Prevalence - 2023-01'.")
+	if (compact):
+		for sheet in report_sheets:
+			if (sheet != 'SFoCs'):
+				before = vd.frame_memory(report_sheets[sheet])
+				with vpr.span('compact', len(report_sheets[sheet])) as span:
+					report_sheets[sheet] = vd.compact_frame(report_sheets[sheet])
+					span['rows_out'] = len(report_sheets[sheet])
+				after = vd.frame_memory(report_sheets[sheet])
+				print("Compacted '"+sheet+"' from "+str(round(before / 2**20, 1))+" MB to "+str(round(after / 2**20, 1))+" MB")
+	return(encode_variants(report_sheets))
+
+
+# Filter the report data down to the requested country, the USA regions, or the whole world.  Returns a dictionary
+# with the variants and point mutations used for the analysis, the variants and point mutations used for graphs, the
+# lineages used for graphs and the name of the region used in output file names.  Data for sheets that were not read
+# is left as None.
+@vpr.profiled
+def region_data(report_sheets, country = None, country_file = None):
+	data = {'analysis_variants': None, 'graph_variants': None, 'lineages': None, 'analysis_subs': None, 'graph_subs': None, 'sfocs': report_sheets.get('SFoCs')}
+	if (not country):
+		variants = report_sheets.get('World - Variants')
+		lineages = report_sheets.get('World - Lineages')
+		mutations = report_sheets.get('AA Mutations')
+		if (variants is not None):
+			data['analysis_variants'] = variants[(variants['Country'] != 'All') & (variants['Country'] != 'Unknown')]
+			data['graph_variants'] = variants[(variants['Country'] == 'All')]
+		if (lineages is not None):
+			data['lineages'] = lineages[(lineages['Country'] == 'All')]
+		if (mutations is not None):
+			data['analysis_subs'] = mutations[(mutations['Country'] != 'All') & (mutations['Country'] != 'Unknown')]
+			data['graph_subs'] = mutations[(mutations['Country'] == 'All')]
+		data['region'] = "World"
+	elif (country == "USA"):
+		variants = report_sheets.get('USA - Variants')
+		lineages = report_sheets.get('USA - Lineages')
+		mutations = report_sheets.get('AA Mutations')
+		if (variants is not None):
+			data['analysis_variants'] = variants
+			data['graph_variants'] = variants[(variants['Region'] == 'All')]
+		if (lineages is not None):
+			data['lineages'] = lineages[(lineages['Region'] == 'All')]
+		if (mutations is not None):
+			data['graph_subs'] = mutations[(mutations['Country'] == 'USA')]
+		data['region'] = "USA"
+	else:
+		variants = report_sheets.get('World - Variants')
+		lineages = report_sheets.get('World - Lineages')
+		mutations = report_sheets.get('AA Mutations')
+		if (variants is not None):
+			data['analysis_variants'] = variants[(variants['Country'] == country)]
+			data['graph_variants'] = data['analysis_variants']
+		if (lineages is not None):
+			data['lineages'] = lineages[(lineages['Country'] == country)]
+		if (mutations is not None):
+			data['analysis_subs'] = mutations[(mutations['Country'] == country)]
+			data['graph_subs'] = data['analysis_subs']
+		data['region'] = country
+
+	if (country_file):
+		countries = open_optional_file(country_file)
+		lineages = report_sheets['World - Lineages']
+		data['lineages'] = lineages[(lineages['Country'].isin(countries))]
+	return(data)
+
+
+# Run one of the ranking analysis options on the data of a region from region_data() and return the ranking together
+# with the name of the TSV file it is saved as.  The covariants file is a DataFrame from open_covariants_file() and the
+# mutations a list from open_optional_file().  Exits with the usual message if the PANGO Lineage or WHO Label to rank
+# is not in the data.  With a state_dir, rankings of whole regions reuse the state kept from the previous run (see
+# incremental_ranking()), and functional impact scores are looked up in the memo, a VariantState.ScoreStore, if given.
+# The ranking functions are taken from rankings, VariantAnalysis itself or the cached ones of report_rankings().
+def run_ranking(analysis, data, interval, pango = None, who = None, covariants_file = None, domain = None, mutations = None, state_dir = None, memo = None, rankings = va):
+	analysis_variants = data['analysis_variants']
+	region = data['region']
+	if (analysis == 'lineage_ranking'):
+		output = 'lineage_ranking_'+region+'.tsv'
+		return(incremental_ranking(state_dir, output, lambda state: rankings.lineage_ranking(analysis_variants, interval, state = state), 'PANGO Lineage', 'Emergence Score'), output)
+	if (analysis == 'mutation_ranking'):
+		if (data['analysis_subs'] is None):
+			sys.exit(usa_mutations_message)
+		output = mutation_stem(domain, mutations, pango, who, covariants_file)+'_'+region+'.tsv'
+		return(incremental_ranking(state_dir, output, lambda state: rankings.mutation_ranking(data['analysis_subs'], interval, domain, mutations or [], state = state), 'Variant', 'Mutation Prevalence Score'), output)
+
+	if (analysis == 'sequence_ranking'):
+		rank = lambda state = None, **filters: rankings.sequence_ranking(analysis_variants, interval, state = state, **filters)
+		score = 'Sequence Prevalence Score'
+	elif (analysis == 'functional_ranking'):
+		rank = lambda state = None, **filters: rankings.functional_ranking(analysis_variants, data['sfocs'], memo = state or memo, **filters)
+		score = 'Functional Impact Score'
+	else:
+		rank = lambda state = None, **filters: rankings.composite_ranking(analysis_variants, data['sfocs'], interval, state = state, memo = memo, **filters)
+		score = 'Composite Score'
+	if (covariants_file is not None):
+		covariant_score = rank(covariants = list(covariants_file['Variant']))
+		covariant_score = pd.merge(covariants_file, covariant_score, on = "Variant")
+		if (analysis != 'sequence_ranking'):
+			covariant_score = covariant_score.drop_duplicates(subset = ['Variant'])
+		covariant_score = covariant_score.sort_values(by = score, ascending = False).reset_index(drop = True)
+		return(covariant_score, 'inputted_covariants_'+analysis+'_'+region+'.tsv')
+	if (pango):
+		if (not analysis_variants['PANGO Lineage'].isin([pango]).any()):
+			sys.exit("PANGO Lineage is invalid and not found. Please try again an input a valid PANGO Lineage.")
+		return(rank(lineage = [pango]), pango+'_'+analysis+'_'+region+'.tsv')
+	if (who):
+		if (not analysis_variants['WHO Label'].isin([who]).any()):
+			sys.exit("WHO Label is invalid and not found. Please try again and input a valid WHO Label.")
+		return(rank(who = [who]), who+'_'+analysis+'_'+region+'.tsv')
+	if (analysis == 'functional_ranking'):
+		analysis_variants = analysis_variants[va.latest_counts(analysis_variants, interval) > 10]
+	output = 'emerging_covariants_'+analysis+'_'+region+'.tsv'
+	return(incremental_ranking(state_dir, output, rank, 'Variant', score, memo), output)
+
+
+# Run a ranking, given as a function of the state to use, with the state kept in state_dir from the previous run that
+# produced the same output file.  Only months whose data changed since that run are tested for significance and only
+# covariants not seen before are scored, then the state is saved for the next run.  Without a state_dir the ranking
+# is computed from scratch.  Functional impact scores are kept in the memo instead of the state when one is given.
+def incremental_ranking(state_dir, output, rank, entity_column, score_column, memo = None):
+	if (not state_dir):
+		return(rank(None))
+	state = vs.RankingState(os.path.join(state_dir, output[:-len('.tsv')]+'.pkl'), memo)
+	ranking = rank(state)
+	changes = state.record(ranking, entity_column, score_column)
+	state.save()
+	print('Incremental update: '+str(state.computed)+' of '+str(state.reused + state.computed)+' months recomputed, '+str(state.scored)+' covariants newly scored, '+str(changes['new'])+' new, '+str(changes['changed'])+' changed and '+str(changes['dropped'])+' dropped entities')
+	return(ranking)
+
+
+# Run the lineage, sequence or mutation ranking for every country of the world, or every region of the USA, in a single
+# pass and return one long table keyed by country/region together with the name of the TSV file it is saved as
+def run_location_ranking(analysis, data, interval, domain = None, mutations = None, rankings = va):
+	region = data['region']
+	location_column = 'Region' if (region == 'USA') else 'Country'
+	output = '_by_'+location_column.lower()+'_'+region+'.tsv'
+	if (analysis == 'mutation_ranking'):
+		if (data['analysis_subs'] is None):
+			sys.exit(usa_mutations_message)
+		subs = data['analysis_subs']
+		subs = subs[(subs[location_column] != 'All') & (subs[location_column] != 'Unknown')]
+		if (mutations):
+			return(rankings.mutation_ranking_by_location(subs, interval, domain, mutations, location_column), 'inputted_mutations_ranking'+output)
+		return(rankings.mutation_ranking_by_location(subs, interval, domain, location_column = location_column), domain+'_mutations_ranking'+output)
+	analysis_variants = data['analysis_variants']
+	analysis_variants = analysis_variants[(analysis_variants[location_column] != 'All') & (analysis_variants[location_column] != 'Unknown')]
+	if (analysis == 'lineage_ranking'):
+		return(rankings.lineage_ranking_by_location(analysis_variants, interval, location_column), 'lineage_ranking'+output)
+	return(rankings.sequence_ranking_by_location(analysis_variants, interval, location_column), 'emerging_covariants_sequence_ranking'+output)
+
+
+# Lineage tree of every PANGO Lineage in the sheets read, expanded through the alias table in aliases_file when one is
+# given (see VariantLineage.LineageTree())
+def lineage_tree(report_sheets, aliases_file = None):
+	try:
+		aliases = vl.read_aliases(aliases_file) if (aliases_file) else {}
+	except Exception:
+		raise Exception("Could not open lineage alias table")
+	lineages = [pd.unique(sheet['PANGO Lineage'].astype(object)) for sheet in report_sheets.values() if ('PANGO Lineage' in sheet.columns)]
+	return(vl.LineageTree(np.concatenate(lineages) if (lineages) else [], aliases))
+
+# Data of a region from region_data() with its lineages rolled up the lineage tree.  For a PANGO Lineage, the rows of
+# its sublineages are relabelled as the lineage itself, so the covariants of its whole subtree are ranked and graphed
+# under it.  Otherwise the variants and lineages behind lineage rankings and graphs are replaced by one row for every
+# lineage and every ancestor of one, holding the totals of its subtree (see VariantLineage.rollup_frame()).
+def rollup_data(data, tree, pango = None):
+	rolled = dict(data)
+	location_column = 'Region' if (data['region'] == 'USA') else 'Country'
+	for key in (['analysis_variants', 'graph_variants'] if (pango) else ['analysis_variants', 'lineages']):
+		frame = data[key]
+		if (frame is None):
+			continue
+		if (pango):
+			lineages = frame['PANGO Lineage'].astype(object)
+			rolled[key] = frame.assign(**{'PANGO Lineage': lineages.where(~lineages.isin(tree.subtree(pango, lineages)), pango)})
+		else:
+			rolled[key] = vl.rollup_frame(frame, tree, location_column)
+	return(rolled)
+
+
+# Data of a region from region_data() with its point mutations derived from its covariant rows (see
+# VariantAnalysis.covariant_mutations()), from the rows of a single PANGO Lineage, WHO Label or covariants file when
+# one is given.  Exits with the usual message if none of the rows match.
+def derived_mutation_data(data, pango = None, who = None, covariants_file = None):
+	derived = dict(data)
+	location_column = 'Region' if (data['region'] == 'USA') else 'Country'
+	analysis_variants = data['analysis_variants']
+	if (pango and not analysis_variants['PANGO Lineage'].isin([pango]).any()):
+		sys.exit("PANGO Lineage is invalid and not found. Please try again an input a valid PANGO Lineage.")
+	if (who and not analysis_variants['WHO Label'].isin([who]).any()):
+		sys.exit("WHO Label is invalid and not found. Please try again and input a valid WHO Label.")
+	if (covariants_file is not None and not analysis_variants['Variant'].isin(covariants_file['Variant']).any()):
+		sys.exit("All covariants are invalid and not found. Please try again and input valid covariants.")
+	for source, target in [('analysis_variants', 'analysis_subs'), ('graph_variants', 'graph_subs')]:
+		rows = data[source]
+		if (pango):
+			rows = rows[rows['PANGO Lineage'] == pango]
+		if (who):
+			rows = rows[rows['WHO Label'] == who]
+		if (covariants_file is not None):
+			rows = rows[rows['Variant'].isin(covariants_file['Variant'])]
+		derived[target] = va.covariant_mutations(rows, location_column)
+	return(derived)
+
+# Stem of the file name of a mutation ranking, led by the covariants its mutations were derived from when only some were
+def mutation_stem(domain, mutations = None, pango = None, who = None, covariants_file = None):
+	stem = 'inputted_mutations_ranking' if (mutations) else domain+'_mutations_ranking'
+	subset = pango or who or ('inputted_covariants' if (covariants_file is not None) else None)
+	return(subset+'_'+stem if (subset) else stem)
+
+# How the point mutations of a ranking job are derived from the report, as a key part for report_rankings() telling its
+# results apart from those of other subsets, or None when they are read from the 'AA Mutations' sheet
+def mutation_key(args, covariants_file = None):
+	if (not derives_mutations(args)):
+		return(None)
+	return(['mutations', args.pango, args.who, list(covariants_file['Variant']) if (covariants_file is not None) else None])
+
+usa_mutations_message = "The AA Mutations sheet only has countries, so mutation rankings cannot be computed for the USA regions. Please try again with --derive_mutations."
+
+
+# Run the lineage, sequence or mutation ranking over every window of interval months across the report's history and
+# return the entity x window end matrix of scores (see VariantAnalysis.sequence_ranking_rolling()) together with the
+# name of the TSV file it is saved as.  With ends, a (first month, last month) pair, only the windows ending in that
+# range are kept.  Exits with the usual message if the PANGO Lineage or WHO Label to rank is not in the data.
+def run_rolling_ranking(analysis, data, interval, ends = None, pango = None, who = None, domain = None, mutations = None, rankings = va):
+	analysis_variants = data['analysis_variants']
+	region = data['region']
+	if (analysis == 'lineage_ranking'):
+		return(rankings.lineage_ranking_rolling(analysis_variants, interval, ends), 'lineage_ranking_rolling_'+region+'.tsv')
+	if (analysis == 'mutation_ranking'):
+		if (data['analysis_subs'] is None):
+			sys.exit(usa_mutations_message)
+		return(rankings.mutation_ranking_rolling(data['analysis_subs'], interval, domain, mutations or [], ends), mutation_stem(domain, mutations, pango, who)+'_rolling_'+region+'.tsv')
+	if (pango):
+		if (not analysis_variants['PANGO Lineage'].isin([pango]).any()):
+			sys.exit("PANGO Lineage is invalid and not found. Please try again an input a valid PANGO Lineage.")
+		return(rankings.sequence_ranking_rolling(analysis_variants, interval, lineage = [pango], ends = ends), pango+'_sequence_ranking_rolling_'+region+'.tsv')
+	if (who):
+		if (not analysis_variants['WHO Label'].isin([who]).any()):
+			sys.exit("WHO Label is invalid and not found. Please try again and input a valid WHO Label.")
+		return(rankings.sequence_ranking_rolling(analysis_variants, interval, who = [who], ends = ends), who+'_sequence_ranking_rolling_'+region+'.tsv')
+	return(rankings.sequence_ranking_rolling(analysis_variants, interval, ends = ends), 'emerging_covariants_sequence_ranking_rolling_'+region+'.tsv')
+
+# Run the lineage, sequence or mutation ranking under every combination of the threshold grids, given as keyword
+# arguments of the VariantAnalysis sweep functions (see threshold_grids()), and return the tidy table of scores (see
+# VariantAnalysis.sequence_ranking_sweep()) together with the name of the TSV file it is saved as.  Exits with the
+# usual message if the PANGO Lineage or WHO Label to rank is not in the data.
+def run_sweep_ranking(analysis, data, interval, grids, pango = None, who = None, domain = None, mutations = None, rankings = va):
+	analysis_variants = data['analysis_variants']
+	region = data['region']
+	if (analysis == 'lineage_ranking'):
+		return(rankings.lineage_ranking_sweep(analysis_variants, interval, **grids), 'lineage_ranking_sweep_'+region+'.tsv')
+	if (analysis == 'mutation_ranking'):
+		if (data['analysis_subs'] is None):
+			sys.exit(usa_mutations_message)
+		return(rankings.mutation_ranking_sweep(data['analysis_subs'], interval, domain, mutations or [], **grids), mutation_stem(domain, mutations, pango, who)+'_sweep_'+region+'.tsv')
+	if (pango):
+		if (not analysis_variants['PANGO Lineage'].isin([pango]).any()):
+			sys.exit("PANGO Lineage is invalid and not found. Please try again an input a valid PANGO Lineage.")
+		return(rankings.sequence_ranking_sweep(analysis_variants, interval, lineage = [pango], **grids), pango+'_sequence_ranking_sweep_'+region+'.tsv')
+	if (who):
+		if (not analysis_variants['WHO Label'].isin([who]).any()):
+			sys.exit("WHO Label is invalid and not found. Please try again and input a valid WHO Label.")
+		return(rankings.sequence_ranking_sweep(analysis_variants, interval, who = [who], **grids), who+'_sequence_ranking_sweep_'+region+'.tsv')
+	return(rankings.sequence_ranking_sweep(analysis_variants, interval, **grids), 'emerging_covariants_sequence_ranking_sweep_'+region+'.tsv')
+
+# Threshold grids of a sweep given by '--growth_grid', '--prevalence_grid' and '--count_grid' (comma separated, or
+# lists in a manifest), as keyword arguments of the VariantAnalysis sweep functions.  A grid left out keeps the
+# ranking's own threshold, and 'none' in the prevalence grid leaves prevalence untested.  Returns {} when no grid is
+# given, so there is no sweep, and None when a grid holds anything but numbers (whole numbers for the count grid).
+def threshold_grids(args):
+	grids = {}
+	for option, keyword, number in [('growth_grid', 'growth_thresholds', float), ('prevalence_grid', 'prevalence_thresholds', float), ('count_grid', 'count_thresholds', int)]:
+		value = getattr(args, option, None)
+		if (value is None):
+			continue
+		values = [str(v).strip() for v in (value.split(',') if (isinstance(value, str)) else value if (isinstance(value, list)) else [value])]
+		try:
+			grids[keyword] = [None if (keyword == 'prevalence_thresholds' and v.lower() == 'none') else number(v) for v in values if (v)]
+		except ValueError:
+			return(None)
+		if (not grids[keyword] or not all(t is None or np.isfinite(t) for t in grids[keyword])):
+			return(None)
+	return(grids)
+
+# Length and range of ends of the windows of a rolling ranking: '--interval' months (4 by default) ending at every month
+# of the report, or only those between '--from' and '--to' when given
+def rolling_window(args):
+	return(args.interval or 4, (args.start, args.end) if (args.start or args.end) else None)
+
+
+# Figure of the top results of a ranking produced by run_ranking(), together with the question asked before showing it
+# interactively.  Figures are given as the name of a plot function in VariantPlots with its positional and keyword
+# arguments (see draw_figure()).  With a window of months (see figure_window()) the figure is drawn over it.
+def ranking_figure(analysis, data, ranking, pango = None, who = None, covariants_file = None, domain = None, window = None):
+	region = data['region']
+	drawn = {'window': window} if (window is not None) else {}
+	if (analysis == 'lineage_ranking'):
+		prompt = 'Display a graph of trends over time for top emerging lineages in '+region+'? [y/n]: '
+		return(prompt, ('plot_lineages', (data['lineages'], ranking['PANGO Lineage'], region), drawn))
+	if (analysis == 'mutation_ranking'):
+		domain = domain or 'User Inputted'
+		prompt = 'Display a graph of trends over time for the top point mutations ranked within '+domain+' in '+region+'? [y/n]: '
+		return(prompt, ('plot_mutations', (data['graph_subs'], region, domain, ranking['Variant'].tolist()), drawn))
+
+	method = {'sequence_ranking': 'sequence ranking', 'functional_ranking': 'functional_ranking', 'composite_ranking': 'composite_ranking'}[analysis]
+	if (covariants_file is not None):
+		inputted = 'user inputted' if (analysis == 'sequence_ranking') else 'inputted'
+		prompt = 'Display a graph of trends over time for the top '+inputted+' covariants from the '+method+' in '+region+'? [y/n]: '
+		covariants = list(covariants_file['Variant'])
+		kwargs = dict(drawn, inputted = (analysis == 'composite_ranking'))
+		if ('Name' in covariants_file.columns):
+			kwargs['name'] = dict(zip(covariants, list(covariants_file['Name'])))
+		return(prompt, ('plot_covariants', (data['graph_variants'], covariants, region), kwargs))
+	if (pango or who):
+		if (who and analysis == 'sequence_ranking'):
+			method = 'substitution ranking'
+		prompt = 'Display a graph of trends over time for the top covariants from the '+method+' for '+(pango or who)+' in '+region+'? [y/n]: '
+		kwargs = dict(drawn, **({'pango': pango} if (pango) else {'who': who}))
+		return(prompt, ('plot_covariants', (data['graph_variants'], ranking['Variant'].tolist(), region), kwargs))
+	prompt = 'Display a graph of trends over time for the top covariants from the '+method.replace('_', ' ')+' in '+region+'? [y/n]: '
+	return(prompt, ('plot_covariants', (data['graph_variants'], ranking['Variant'].tolist(), region), dict(drawn, inputted = True)))
+
+
+# Plot function that draws the figure of an analysis, given like the parsed commandline, and whether it plots inputted
+# covariants, as ranking_figure() and the graph analysis option pick them
+def figure_plot(args):
+	if (args.analysis == 'graph'):
+		if (getattr(args, 'lineage', None) or getattr(args, 'lineage_file', None)):
+			return(('plot_single_lineage' if (args.lineage) else 'plot_lineages', False))
+		if (args.covariant or args.pango or args.who):
+			return(('plot_covariants', bool(args.covariant)))
+		if (args.mutation or args.domain):
+			return(('plot_mutations', False))
+		return(('plot_lineages', False))
+	if (args.analysis == 'lineage_ranking'):
+		return(('plot_lineages', False))
+	if (args.analysis == 'mutation_ranking'):
+		return(('plot_mutations', False))
+	if (args.covariant):
+		return(('plot_covariants', args.analysis == 'composite_ranking'))
+	return(('plot_covariants', not (args.pango or args.who)))
+
+# Graph types given for an analysis (given like the parsed commandline) that its figure cannot be drawn as, such as the
+# proportion of covariants that were inputted rather than ranked from the report
+def unsupported_graph_types(args):
+	if (args.graph_type is None):
+		return([])
+	graph_types = [str(t).strip() for t in (args.graph_type if (isinstance(args.graph_type, list)) else args.graph_type.split(','))]
+	supported = vp.figure_graph_types(*figure_plot(args))
+	return([t for t in graph_types if (t in graph_types_allowed and t not in supported)])
+
+
+# Files to render for a figure, one for each graph type, named after the stem and the graph type, e.g.
+# lineage_ranking_World_prevalence.png
+def figure_files(figure, stem, graph_types, graph_format = 'png'):
+	function, args, kwargs = figure
+	return([(function, args, dict(kwargs, graph_type = graph_type, output = stem+'_'+graph_type+'.'+graph_format)) for graph_type in graph_types])
+
+
+# Draw a figure.  Without graph types the plot function asks for the graph type and shows the figure in a window.
+# Otherwise a file is rendered for every graph type without any prompt, in parallel when there are several.
+def draw_figure(figure, stem, graph_types = None, graph_format = 'png'):
+	if (graph_types is None):
+		function, args, kwargs = figure
+		getattr(vp, function)(*args, **kwargs)
+		return
+	for output in render_figures(figure_files(figure, stem, graph_types, graph_format)):
+		print('Figure saved to '+output)
+
+# Render figures to files, see VariantPlots.render_figures()
+def render_figures(figures):
+	if (not figures):
+		return([])
+	with vpr.span('render figures', len(figures)) as span:
+		outputs = vp.render_figures(figures)
+		span['rows_out'] = len(outputs)
+	return(outputs)
+
+# Save a ranking as a TSV
+def write_ranking(ranking, output):
+	with vpr.span('write TSV', len(ranking)) as span:
+		ranking.to_csv(output, sep = '\t', index = False)
+		span['rows_out'] = len(ranking)
+
+
+# Parse the graph types given on the commandline or in a manifest job, e.g. 'prevalence,growth'.  Returns None when
+# no graph type was given, so the graph type is asked for interactively, and an empty list for 'none'.
+def parse_graph_types(graph_type):
+	if (graph_type is None):
+		return(None)
+	graph_types = graph_type if (isinstance(graph_type, list)) else graph_type.split(',')
+	graph_types = [t.strip() for t in graph_types if (t.strip() and t.strip() != 'none')]
+	if (any(t not in graph_types_allowed for t in graph_types)):
+		sys.exit("Invalid graph type. Please try again and give graph types from: "+', '.join(graph_types_allowed)+" (or none)")
+	return(graph_types)
+
+
+# Window of months to rank over: the calendar range given by '--from' and '--to' (either may be left open), or else
+# the most recent '--interval' months, 4 by default.  See VariantData.ReportSchema.window().
+def analysis_window(args):
+	if (args.start or args.end):
+		return((args.start, args.end))
+	return(args.interval or 4)
+
+# Window of months to draw figures over: the window ranked over when '--interval' or '--from' and '--to' were given, so
+# the graphs cover the months their ranking scored, or else None for the plot functions' own default (see
+# VariantPlots.default_window)
+def figure_window(args):
+	if (args.start or args.end or args.interval):
+		return(analysis_window(args))
+	return(None)
+
+
+# What is wrong with the options of a ranking job, given like the parsed commandline, or None when they can be run
+# together.  Used for the jobs of a manifest and the requests to the ranking service (see VariantService.py).
+def job_problem(args):
+	if (args.analysis not in ranking_options):
+		return("must have one of the ranking analysis options: "+', '.join(ranking_options))
+	if (sum(bool(f) for f in [args.pango, args.who, args.covariant]) > 1 or (args.analysis == 'lineage_ranking' and (args.pango or args.who or args.covariant))):
+		return("combines PANGO, WHO and covariants filters that cannot be used together")
+	if ((args.analysis == 'mutation_ranking') != bool(args.domain or args.mutation) or (args.analysis == 'mutation_ranking' and not args.mutation and args.domain not in domains)):
+		return("needs a domain (NTD/RBD/Spike/Other) or mutations for mutation_ranking, and only then")
+	if (getattr(args, 'derive_mutations', False) and args.analysis != 'mutation_ranking'):
+		return("can only derive mutations from the covariant rows for mutation_ranking")
+	if (args.by_location and (args.analysis not in location_ranking_options or args.pango or args.who or args.covariant or args.country not in [None, 'USA'])):
+		return("can only rank by location with lineage_ranking, sequence_ranking or mutation_ranking, for the World or the USA and without PANGO, WHO or covariants filters")
+	if (args.rolling and (args.analysis not in location_ranking_options or args.covariant or args.by_location or args.incremental)):
+		return("can only give a rolling ranking for lineage_ranking, sequence_ranking or mutation_ranking, without covariants, by_location or incremental")
+	if (args.interval and (args.start or args.end) and not args.rolling):
+		return("gives both an interval and a from/to range of months")
+	grids = threshold_grids(args)
+	if (grids is None):
+		return("has threshold grids that are not comma separated numbers (whole numbers for the count grid)")
+	if (grids and (args.analysis not in location_ranking_options or args.covariant or args.by_location or args.rolling or args.incremental)):
+		return("can only sweep thresholds for lineage_ranking, sequence_ranking or mutation_ranking, without covariants, by_location, rolling or incremental")
+	if (args.graph_type is not None and (args.by_location or args.rolling or grids)):
+		return("cannot graph a ranking by location, a rolling ranking or a threshold sweep")
+	if ((args.graph_format or 'png') not in vp.graph_formats):
+		return("has a graph format other than "+'/'.join(vp.graph_formats))
+	if (unsupported_graph_types(args)):
+		return("asks for graph types its figure cannot be drawn as: "+', '.join(unsupported_graph_types(args)))
+	return(None)
+
+
+# Read a batch job manifest.  The manifest is a JSON (or, with PyYAML installed, YAML) list of jobs, or an object with
+# a 'jobs' list, where every job is an object using the names of the commandline options, e.g.
+# {"analysis": "sequence_ranking", "WHO": "Omicron", "country": "India", "interval": 6}.  Only the ranking analysis
+# options can be run from a manifest.  A job may also list the graph types (e.g. "graph_type": ["prevalence", "growth"])
+# to render the ranking's figure as, in the graph format given by "graph_format" (png, svg or pdf).
+def open_manifest(file):
+	try:
+		with open(file) as f:
+			if (file.endswith('.yaml') or file.endswith('.yml')):
+				import yaml
+				manifest = yaml.safe_load(f)
+			else:
+				manifest = json.load(f)
+	except Exception:
+		raise Exception("Could not open job manifest")
+	jobs = manifest['jobs'] if (isinstance(manifest, dict)) else manifest
+	options = {'analysis': 'analysis', 'PANGO': 'pango', 'WHO': 'who', 'covariants': 'covariant', 'interval': 'interval', 'country': 'country', 'domain': 'domain', 'mutations': 'mutation', 'by_location': 'by_location', 'graph_type': 'graph_type', 'graph_format': 'graph_format', 'incremental': 'incremental', 'score_store': 'score_store', 'from': 'start', 'to': 'end', 'rolling': 'rolling', 'growth_grid': 'growth_grid', 'prevalence_grid': 'prevalence_grid', 'count_grid': 'count_grid', 'derive_mutations': 'derive_mutations'}
+	job_args = []
+	for i, job in enumerate(jobs):
+		unknown = set(job) - set(options)
+		if (unknown):
+			sys.exit("Job "+str(i + 1)+" in the manifest has unknown options: "+', '.join(sorted(unknown)))
+		args = argparse.Namespace(lineage = None, lineage_file = None, country_file = None, **{dest: job.get(option) for option, dest in options.items()})
+		problem = job_problem(args)
+		if (problem):
+			sys.exit("Job "+str(i + 1)+" in the manifest "+problem)
+		args.graph_types = parse_graph_types(args.graph_type) or []
+		job_args.append(args)
+	return(job_args)
+
+
+# Everything the jobs of a manifest share: the sheets read for them, the data of every region (and the point mutations
+# derived for it) and every covariants file as the jobs first need them, the result cache and the store of functional
+# impact scores.  The source identifies the report the sheets were read from in the result cache (see
+# report_rankings()).  Every worker of a parallel manifest run builds its own from the shared sheets.
+def manifest_context(report_sheets, source, cache_dir = vd.default_cache_dir, persistent_results = False, score_jobs = False):
+	return(types.SimpleNamespace(sheets = report_sheets, regions = {}, covariant_files = {}, source = source, cache_dir = cache_dir, cache = result_cache(cache_dir, persistent_results), memo = score_store('functional_ranking' if (score_jobs) else None, cache_dir)))
+
+# Data of a manifest job from its context: the data of its region from region_data() (with point mutations derived
+# from the covariant rows if the job asks for them, once for every country and subset), its covariants file and
+# mutations, and the ranking functions to rank them with
+def job_data(job, context):
+	if (job.country not in context.regions):
+		context.regions[job.country] = region_data(context.sheets, job.country)
+	covariants_file = None
+	if (job.covariant):
+		if (job.covariant not in context.covariant_files):
+			context.covariant_files[job.covariant] = open_covariants_file(job.covariant)
+		covariants_file = context.covariant_files[job.covariant]
+	data = context.regions[job.country]
+	derived = mutation_key(job, covariants_file)
+	if (derived):
+		key = json.dumps([job.country, derived])
+		if (key not in context.regions):
+			context.regions[key] = derived_mutation_data(data, job.pango, job.who, covariants_file)
+		data = context.regions[key]
+	rankings = context.cache.functions(context.source + ([derived] if (derived) else []))
+	mutations = open_optional_file(job.mutation) if (job.mutation) else None
+	return(data, covariants_file, mutations, rankings)
+
+# Run a manifest job and return its ranking together with the name of the TSV file it is saved as
+def run_job(job, context):
+	data, covariants_file, mutations, rankings = job_data(job, context)
+	grids = threshold_grids(job)
+	if (grids):
+		return(run_sweep_ranking(job.analysis, data, analysis_window(job), grids, job.pango, job.who, job.domain, mutations, rankings))
+	if (job.rolling):
+		return(run_rolling_ranking(job.analysis, data, *rolling_window(job), job.pango, job.who, job.domain, mutations, rankings))
+	if (job.by_location):
+		return(run_location_ranking(job.analysis, data, analysis_window(job), job.domain, mutations, rankings))
+	state_dir = os.path.join(context.cache_dir, 'state') if (job.incremental and context.cache_dir) else None
+	return(run_ranking(job.analysis, data, analysis_window(job), job.pango, job.who, covariants_file, job.domain, mutations, state_dir, context.memo if (job.score_store) else None, rankings))
+
+# Run a manifest job in a worker of a parallel manifest run.  Also returns how the worker's result cache answered it,
+# so the hits and misses of all workers can be summed up.
+def run_worker_job(job, context):
+	before = context.cache.stats()
+	ranking, output = run_job(job, context)
+	after = context.cache.stats()
+	return(ranking, output, {count: after[count] - before[count] for count in ['hits', 'disk_hits', 'misses']})
+
+
+# Run every job of a manifest against one load of the report.  The sheets needed by all jobs are read once up front,
+# jobs for the same country share the same filtered data, and each ranking is saved as a TSV under the same name the
+# single analysis commandline would give it.  Point mutations derived from the covariant rows are derived once for
+# every country and subset the jobs ask for.  With more than one worker, the jobs are ranked in a pool of that many
+# processes that share the sheets through shared memory (see VariantParallel.map_shared()), each keeping its own
+# region data and result cache, and the rankings are saved in the order of the jobs once all are ranked.  The figures
+# requested by the jobs are rendered at the end, all in one process pool.
+def run_manifest(variants_report, jobs, cache_dir = vd.default_cache_dir, compact = False, persistent_results = False, workers = None):
+	requests = {}
+	for job in jobs:
+		for sheet, columns in required_sheets(job).items():
+			if (columns is None or (sheet in requests and requests[sheet] is None)):
+				requests[sheet] = None
+			else:
+				requests[sheet] = sorted(set(requests.get(sheet, [])) | set(columns))
+	report_sheets = read_sheets(variants_report, requests, compact)
+	setup = functools.partial(manifest_context, source = [variants_report.hash(), {}, compact], cache_dir = cache_dir, persistent_results = persistent_results, score_jobs = any(job.score_store for job in jobs))
+	context = setup(report_sheets)
+	if (workers and workers > 1 and len(jobs) > 1):
+		results = vpl.map_shared(run_worker_job, jobs, report_sheets, min(workers, len(jobs)), setup)
+		for ranking, output, counts in results:
+			context.cache.count(counts)
+	else:
+		results = (run_job(job, context) for job in jobs)
+	figures = []
+	for i, (job, result) in enumerate(zip(jobs, results)):
+		ranking, output = result[:2]
+		write_ranking(ranking, output)
+		print('Job '+str(i + 1)+' of '+str(len(jobs))+': '+job.analysis+' saved to '+output)
+		if (job.graph_types):
+			data, covariants_file, mutations, rankings = job_data(job, context)
+			prompt, figure = ranking_figure(job.analysis, data, ranking, job.pango, job.who, covariants_file, job.domain, figure_window(job))
+			figures += figure_files(figure, output[:-len('.tsv')], job.graph_types, job.graph_format or 'png')
+	for output in render_figures(figures):
+		print('Figure saved to '+output)
+	print(context.cache.summary())
+
+
+# Store of functional impact scores in the cache directory, so covariants scored in earlier runs are looked up rather
+# than scored again.  Only opened for the analysis options that score covariants, and not at all without a cache
+# directory.
+def score_store(analysis, cache_dir):
+	if (analysis not in ['functional_ranking', 'composite_ranking'] or not cache_dir):
+		return(None)
+	return(vs.ScoreStore(os.path.join(cache_dir, 'functional_scores.sqlite')))
+
+
+# Cache of ranking results, kept in the cache directory between runs when persistent is set and otherwise only held in
+# memory for the run
+def result_cache(cache_dir, persistent = False):
+	return(vs.ResultCache(os.path.join(cache_dir, 'results') if (persistent and cache_dir) else None))
+
+# Ranking functions answered through a VariantState.ResultCache for the report given (see run_ranking()).  Results are
+# keyed by the report's hash together with the export filters and dtypes its sheets were read with, and how the data
+# were derived from the report, such as the key of the lineage tree when lineages are rolled up.  Without a cache the
+# VariantAnalysis module itself is returned.
+def report_rankings(variants_report, cache, filters = {}, compact = False, derived = []):
+	if (cache is None):
+		return(va)
+	return(cache.functions([variants_report.hash(), filters, compact] + list(derived)))
+
+
+# Intern the covariant strings of the variants sheets once, so every function works on the same covariant IDs.  Exits
+# when a covariant of the report cannot be read.
+@vpr.profiled
+def encode_variants(report_sheets):
+	for sheet in ['World - Variants', 'USA - Variants']:
+		if (sheet in report_sheets):
+			try:
+				report_sheets[sheet] = report_sheets[sheet].assign(Variant = ve.covariant_store.categorical(report_sheets[sheet]['Variant']))
+			except ValueError as e:
+				sys.exit("Invalid covariant in the '"+sheet+"' sheet of the report. "+str(e)+".")
+	return(report_sheets)
+
+
+ranking_options = ['lineage_ranking', 'sequence_ranking', 'functional_ranking', 'composite_ranking', 'mutation_ranking']
+location_ranking_options = ['lineage_ranking', 'sequence_ranking', 'mutation_ranking']
+graph_types_allowed = ['prevalence', 'growth', 'proportion']
+domains = ['NTD', 'RBD', 'Spike', 'Other']
+
 
 if __name__ == '__main__':
-	analysis_options = ['lineage_ranking', 'sequence_ranking', 'functional_ranking', 'composite_ranking', 'mutation_ranking', 'graph', 'help']
-	domains = ['NTD', 'RBD', 'Spike', 'Other']
+	analysis_options = ranking_options + ['graph', 'similar', 'cube', 'ingest', 'help']
 	
-	if (len(sys.argv) < 4 or len(sys.argv) > 10):
+	if (len(sys.argv) < 4):
 		sys.exit(program_usage())
 	
 	parser = argparse.ArgumentParser()
@@ -142,19 +925,59 @@ if __name__ == '__main__':
 	parser.add_argument('--WHO', dest = 'who', type = str)
 	parser.add_argument('--covariants', dest = 'covariant', type = str)
 	parser.add_argument('--interval', dest = 'interval', type = int)
+	parser.add_argument('--from', dest = 'start', type = str)
+	parser.add_argument('--to', dest = 'end', type = str)
 	parser.add_argument('--lineage_file', dest = 'lineage_file', type = str)
 	parser.add_argument('--lineage', dest = 'lineage', type = str)
 	parser.add_argument('--country_file', dest = 'country_file', type = str)
 	parser.add_argument('--country', dest = 'country', type = str)
 	parser.add_argument('--domain', dest = 'domain', type = str)
 	parser.add_argument('--mutations', dest = 'mutation', type = str)
+	parser.add_argument('--cache_dir', '--cache-dir', dest = 'cache_dir', type = str, default = vd.default_cache_dir)
+	parser.add_argument('--cube_dir', dest = 'cube_dir', type = str)
+	parser.add_argument('--history_dir', dest = 'history_dir', type = str)
+	parser.add_argument('--report_date', dest = 'report_date', type = str)
+	parser.add_argument('--manifest', dest = 'manifest', type = str)
+	parser.add_argument('--by_location', dest = 'by_location', action = 'store_true')
+	parser.add_argument('--rolling', dest = 'rolling', action = 'store_true')
+	parser.add_argument('--growth_grid', dest = 'growth_grid', type = str)
+	parser.add_argument('--prevalence_grid', dest = 'prevalence_grid', type = str)
+	parser.add_argument('--count_grid', dest = 'count_grid', type = str)
+	parser.add_argument('--rollup', dest = 'rollup', action = 'store_true')
+	parser.add_argument('--aliases', dest = 'aliases', type = str)
+	parser.add_argument('--derive_mutations', dest = 'derive_mutations', action = 'store_true')
+	parser.add_argument('--top', dest = 'top', type = int)
+	parser.add_argument('--metric', dest = 'metric', type = str)
+	parser.add_argument('--minhash', dest = 'minhash', type = int)
+	parser.add_argument('--graph_type', dest = 'graph_type', type = str)
+	parser.add_argument('--graph_format', dest = 'graph_format', type = str, default = 'png')
+	parser.add_argument('--incremental', dest = 'incremental', action = 'store_true')
+	parser.add_argument('--score_store', dest = 'score_store', action = 'store_true')
+	parser.add_argument('--compact', dest = 'compact', action = 'store_true')
+	parser.add_argument('--result_cache', dest = 'result_cache', action = 'store_true')
+	parser.add_argument('--workers', dest = 'workers', type = int)
+	parser.add_argument('--profile', dest = 'profile', type = str, nargs = '?', const = vpr.default_trace_file)
 	args = parser.parse_args()
+	if (args.profile):
+		vpr.profiler.enable(args.profile)
+
+	# Run a batch of ranking jobs against one load of the report
+	if (args.manifest and args.analysis):
+		sys.exit(program_usage())
+	if (args.manifest and args.filename):
+		if (args.workers is not None and args.workers < 1):
+			sys.exit(program_usage())
+		jobs = open_manifest(args.manifest)
+		run_manifest(open_emerging_variants(args.filename, args.cache_dir), jobs, args.cache_dir, args.compact, args.result_cache, args.workers)
+		sys.exit()
 	
 	# Ensure proper arguments to the commandline
 	if (not args.filename):
 		sys.exit(program_usage())
 	if (args.analysis not in analysis_options):
 		sys.exit(program_usage())
+	if (args.workers is not None):
+		sys.exit(program_usage())
 	if (args.analysis == 'lineage_ranking' and (args.pango or args.who or args.covariant)):
 		sys.exit(program_usage())
 	if (args.pango and args.who and args.covariant):
@@ -167,6 +990,8 @@ if __name__ == '__main__':
 		sys.exit(program_usage())
 	if ((args.analysis != 'mutation_ranking' and args.analysis != 'graph') and (args.domain or args.mutation)):
 		sys.exit(program_usage())
+	if (args.derive_mutations and not (args.analysis == 'mutation_ranking' or (args.analysis == 'graph' and (args.domain or args.mutation)))):
+		sys.exit(program_usage())
 	if (args.analysis == 'mutation_ranking' and (not args.domain and not args.mutation)):
 		sys.exit(program_usage())
 	if (args.analysis == 'mutation_ranking' and (not args.mutation) and (args.domain not in domains)):
@@ -175,6 +1000,26 @@ if __name__ == '__main__':
 		program_usage()
 		graph_args_usage()
 		sys.exit()
+	if ((args.analysis == 'cube') != bool(args.cube_dir)):
+		sys.exit(program_usage())
+	if ((args.analysis == 'ingest') != bool(args.history_dir) or (args.report_date and args.analysis != 'ingest')):
+		sys.exit(program_usage())
+	if (args.report_date and not re.fullmatch(r'[0-9]{4}-[0-9]{2}-[0-9]{2}', args.report_date)):
+		sys.exit("Invalid report date. Please try again and give '--report_date' as YYYY-MM-DD, e.g. --report_date 2023-09-30")
+	if (args.aliases and not args.rollup):
+		sys.exit(program_usage())
+	if (args.rollup and not (args.analysis == 'lineage_ranking' or (args.analysis in ['sequence_ranking', 'functional_ranking', 'composite_ranking'] and args.pango) or (args.analysis == 'graph' and (args.lineage or args.lineage_file or args.pango)))):
+		sys.exit(program_usage())
+	if (args.rollup and args.incremental):
+		sys.exit(program_usage())
+	if (args.analysis == 'similar' and (not args.covariant or args.graph_type is not None)):
+		sys.exit(program_usage())
+	if ((args.analysis != 'similar') and (args.top is not None or args.metric or args.minhash is not None)):
+		sys.exit(program_usage())
+	if ((args.top is not None and args.top < 1) or (args.metric and args.metric not in vsi.metrics) or (args.minhash is not None and args.minhash < 1)):
+		sys.exit(program_usage())
+	if (args.by_location and (args.analysis not in location_ranking_options or args.pango or args.who or args.covariant or args.country not in [None, 'USA'])):
+		sys.exit(program_usage())
 	if (args.analysis != 'graph' and (args.lineage_file or args.lineage or args.country_file)):
 		sys.exit(program_usage())
 	if (args.analysis == 'graph' and (args.lineage_file and args.country_file)):
@@ -193,251 +1038,136 @@ if __name__ == '__main__':
 		sys.exit(graph_args_usage())
 	if (args.analysis == 'graph' and args.domain and (args.domain not in domains)):
 		sys.exit(graph_args_usage())
-	if (args.interval):
-		interval = args.interval
-	else:
-		interval = 4
+	if (args.graph_format not in vp.graph_formats):
+		sys.exit(program_usage())
+	if (args.incremental and (args.analysis not in ranking_options or args.by_location or not args.cache_dir)):
+		sys.exit(program_usage())
+	if (args.rolling and (args.analysis not in location_ranking_options or args.covariant or args.by_location or args.incremental)):
+		sys.exit(program_usage())
+	grids = threshold_grids(args)
+	if (grids is None):
+		sys.exit("Invalid threshold grid. Please try again and give the grids as comma separated numbers, e.g. --growth_grid 1,2,5,10 --prevalence_grid 0.01,0.05 --count_grid 0,10,50")
+	if (grids and (args.analysis not in location_ranking_options or args.covariant or args.by_location or args.rolling or args.incremental)):
+		sys.exit(program_usage())
+	if ((args.rolling or grids) and args.graph_type is not None):
+		sys.exit(program_usage())
+	if (args.score_store and (args.analysis not in ['functional_ranking', 'composite_ranking'] or not args.cache_dir)):
+		sys.exit(program_usage())
+	if (args.result_cache and (args.analysis not in ranking_options + ['graph'] or not args.cache_dir)):
+		sys.exit(program_usage())
+	graph_types = parse_graph_types(args.graph_type)
+	if (args.analysis == 'graph' and graph_types == []):
+		sys.exit(graph_args_usage())
+	if (graph_types and args.analysis in ranking_options + ['graph'] and unsupported_graph_types(args)):
+		sys.exit("Invalid graph type. The figure of this analysis cannot be drawn as: "+', '.join(unsupported_graph_types(args))+". Please try again with "+' or '.join(vp.figure_graph_types(*figure_plot(args))))
+	if (args.interval and (args.start or args.end) and not args.rolling):
+		sys.exit(program_usage())
+	if (any(month and not re.fullmatch(r'[0-9]{4}-[0-9]{2}', month) for month in [args.start, args.end])):
+		sys.exit("Invalid month. Please try again and give '--from' and '--to' as YYYY-MM, e.g. --from 2023-01 --to 2023-06")
+	interval = analysis_window(args)
 
 	
-	# Filter the data by country or countries if needed
-	variants_xlsx = open_emerging_variants(args.filename)
-	if (not args.country):
-		variants = pd.read_excel(variants_xlsx, 'World - Variants')
-		lineages = pd.read_excel(variants_xlsx, 'World - Lineages')
-		mutations = pd.read_excel(variants_xlsx, 'AA Mutations')
-		analysis_variants = variants[(variants['Country'] != 'All') & (variants['Country'] != 'Unknown')]
-		graph_variants = variants[(variants['Country'] == 'All')]
-		lineages = lineages[(lineages['Country'] == 'All')]
-		analysis_subs = mutations[(mutations['Country'] != 'All') & (mutations['Country'] != 'Unknown')]
-		graph_subs = mutations[(mutations['Country'] == 'All')]
-		region = "World"
-	elif (args.country == "USA"):
-		analysis_variants = pd.read_excel(variants_xlsx, 'USA - Variants')
-		lineages = pd.read_excel(variants_xlsx, 'USA - Lineages')
-		mutations = pd.read_excel(variants_xlsx, 'AA Mutations')
-		graph_variants = analysis_variants[(analysis_variants['Region'] == 'All')]
-		lineages = lineages[(lineages['Region'] == 'All')]
-		graph_subs = mutations[(mutations['Country'] == 'USA')]
-		region = "USA"
-	else:
-		variants = pd.read_excel(variants_xlsx, 'World - Variants')
-		lineages = pd.read_excel(variants_xlsx, 'World - Lineages')
-		mutations = pd.read_excel(variants_xlsx, 'AA Mutations')
-		analysis_variants = variants[(variants['Country'] == args.country)]
-		graph_variants = analysis_variants
-		lineages = lineages[(lineages['Country'] == args.country)]
-		analysis_subs = mutations[(mutations['Country'] == args.country)]
-		graph_subs = analysis_subs
-		region = args.country
-
-	if (args.country_file):
-		countries = open_optional_file(args.country_file)
-		lineages = pd.read_excel(variants_xlsx, 'World - Lineages')
-		lineages = lineages[(lineages['Country'].isin(countries))]
+	# Read only the sheets and columns the requested analysis needs, then filter the data by country or countries if needed
+	args.graph_types = graph_types
+	filters = export_filters(args)
+	variants_report = open_emerging_variants(args.filename, args.cache_dir, filters)
+	if (args.analysis == 'cube'):
+		vc.build_report_cubes(variants_report, args.cube_dir)
+		sys.exit()
+	if (args.analysis == 'ingest'):
+		history = vh.ReportHistory(args.history_dir)
+		date = vh.report_date(args.filename, args.report_date)
+		try:
+			added = history.ingest(variants_report, date, args.filename)
+		except ValueError as e:
+			sys.exit(str(e))
+		print(("Added the report dated " if (added) else "The history store already holds the report dated ")+date+", "+str(len(history))+" reports in the history store")
+		sys.exit()
+	report_sheets = read_sheets(variants_report, required_sheets(args), args.compact)
+	data = region_data(report_sheets, args.country, args.country_file)
+	tree = lineage_tree(report_sheets, args.aliases) if (args.rollup) else None
+	if (tree):
+		data = rollup_data(data, tree, args.pango)
+	derived = [tree.key()] if (tree) else []
+	if (derives_mutations(args)):
+		covariants_file = open_covariants_file(args.covariant) if (args.covariant) else None
+		data = derived_mutation_data(data, args.pango, args.who, covariants_file)
+		derived.append(mutation_key(args, covariants_file))
+	if (not isinstance(interval, int) and not any(vd.report_schema(sheet.columns).month_labels(interval) for name, sheet in report_sheets.items() if (name != 'SFoCs'))):
+		sys.exit("No months of the report fall between '--from' and '--to'. Please try again with a range of months the report covers.")
+	analysis_variants = data['analysis_variants']
+	graph_variants = data['graph_variants']
+	lineages = data['lineages']
+	graph_subs = data['graph_subs']
+	region = data['region']
+	cache = result_cache(args.cache_dir, True) if (args.result_cache) else None
+	rankings = report_rankings(variants_report, cache, filters, args.compact, derived)
 
 
 	# The following code conducts the range of analysis options
-	if (args.analysis == 'lineage_ranking'):
-		emergence_ranking = va.lineage_ranking(analysis_variants, interval)
-		emergence_ranking.to_csv('lineage_ranking_'+region+'.tsv', sep = '\t', index = False)
-		print(emergence_ranking)
-		print('\n')
-		graph = input('Display a graph of trends over time for top emerging lineages in '+region+'? [y/n]: ')
-		if (graph == 'y'):
-			vp.plot_lineages(lineages, emergence_ranking['PANGO Lineage'], region)
-	
-	elif (args.analysis == 'sequence_ranking'):
-		if (args.covariant):
-			covariants_file = open_covariants_file(args.covariant)
-			covariants = list(covariants_file['Variant'])
-			covariant_score = va.sequence_ranking(analysis_variants, interval, covariants = covariants)
-			covariant_score = pd.merge(covariants_file, covariant_score, on = "Variant")
-			covariant_score = covariant_score.sort_values(by = 'Sequence Prevalence Score', ascending = False).reset_index(drop = True)
-			covariant_score.to_csv('inputted_covariants_sequence_ranking_'+region+'.tsv', sep = '\t', index = False)
-			print(covariant_score)
-			print('\n')
-			graph = input('Display a graph of trends over time for the top user inputted covariants from the sequence ranking in '+region+'? [y/n]: ')
-			if (graph == 'y'):
-				if ('Name' in covariants_file.columns):
-					names = list(covariants_file['Name'])
-					name_dict = dict(zip(covariants, names))
-					vp.plot_covariants(graph_variants, covariants, region, name = name_dict)
-				else:
-					vp.plot_covariants(graph_variants, covariants, region)
-		elif (args.pango):
-			pango_lineage = args.pango
-			if (analysis_variants['PANGO Lineage'].isin([pango_lineage]).any()):
-				covariant_score = va.sequence_ranking(analysis_variants, interval, lineage = [pango_lineage])
-				covariant_score.to_csv(pango_lineage+'_sequence_ranking_'+region+'.tsv', sep = '\t', index = False)
-				print(covariant_score)
-				print('\n')
-				graph = input('Display a graph of trends over time for the top covariants from the sequence ranking for '+pango_lineage+' in '+region+'? [y/n]: ')
-				if (graph == 'y'):
-					vp.plot_covariants(graph_variants, covariant_score['Variant'].tolist(), region, pango = pango_lineage)
-			else:
-				sys.exit("PANGO Lineage is invalid and not found. Please try again an input a valid PANGO Lineage.")
-		elif (args.who):
-			who_label = args.who
-			if (analysis_variants['WHO Label'].isin([who_label]).any()):
-				covariant_score = va.sequence_ranking(analysis_variants, interval, who = [who_label])
-				covariant_score.to_csv(who_label+'_sequence_ranking_'+region+'.tsv', sep = '\t', index = False)
-				print(covariant_score)
-				print('\n')
-				graph = input('Display a graph of trends over time for the top covariants from the substitution ranking for '+who_label+' in '+region+'? [y/n]: ')
-				if (graph == 'y'):
-					vp.plot_covariants(graph_variants, covariant_score['Variant'].tolist(), region, who = who_label)
-			else:
-				sys.exit("WHO Label is invalid and not found. Please try again and input a valid WHO Label.")
-		else:
-			covariants_score = va.sequence_ranking(analysis_variants, interval)
-			covariants_score.to_csv('emerging_covariants_sequence_ranking_'+region+'.tsv', sep = '\t', index = False)
-			print(covariants_score)
-			print('\n')
-			graph = input('Display a graph of trends over time for the top covariants from the sequence ranking in '+region+'? [y/n]: ')
-			if (graph == 'y'):
-				vp.plot_covariants(graph_variants, covariants_score['Variant'].tolist(), region, inputted = True)
-	
-	elif (args.analysis == 'functional_ranking'):
-		sfocs = pd.read_excel(variants_xlsx, 'SFoCs')
-		sfocs = sfocs[(sfocs['Protein'] == 'Spike')]
-		if (args.covariant):
-			covariants_file = open_covariants_file(args.covariant)
-			covariants = list(covariants_file['Variant'])
-			covariant_score = va.functional_ranking(analysis_variants, sfocs, covariants = covariants)
-			covariant_score = pd.merge(covariants_file, covariant_score, on = "Variant")
-			covariant_score = covariant_score.drop_duplicates(subset = ['Variant']).sort_values(by = 'Functional Impact Score', ascending = False).reset_index(drop = True)
-			covariant_score.to_csv('inputted_covariants_functional_ranking_'+region+'.tsv', sep = '\t', index = False)
-			print(covariant_score)
-			print('\n')
-			graph = input('Display a graph of trends over time for the top inputted covariants from the functional_ranking in '+region+'? [y/n]: ')
-			if (graph == 'y'):
-				if ('Name' in covariants_file.columns):
-					names = list(covariants_file['Name'])
-					name_dict = dict(zip(covariants, names))
-					vp.plot_covariants(graph_variants, covariants, region, name = name_dict)
-				else:
-					vp.plot_covariants(graph_variants, covariants, region)
-		elif (args.pango):
-			pango_lineage = args.pango
-			if (analysis_variants['PANGO Lineage'].isin([pango_lineage]).any()):
-				covariant_score = va.functional_ranking(analysis_variants, sfocs, lineage = [pango_lineage])
-				covariant_score.to_csv(pango_lineage+'_functional_ranking_'+region+'.tsv', sep = '\t', index = False)
-				print(covariant_score)
-				print('\n')
-				graph = input('Display a graph of trends over time for the top covariants from the functional_ranking for '+pango_lineage+' in '+region+'? [y/n]: ')
-				if (graph == 'y'):
-					vp.plot_covariants(graph_variants, covariant_score['Variant'].tolist(), region, pango = pango_lineage)
-			else:
-				sys.exit("PANGO Lineage is invalid and not found. Please try again an input a valid PANGO Lineage.")
-		elif (args.who):
-			who_label = args.who
-			if (analysis_variants['WHO Label'].isin([who_label]).any()):
-				covariant_score = va.functional_ranking(analysis_variants, sfocs, who = [who_label])
-				covariant_score.to_csv(who_label+'_functional_ranking_'+region+'.tsv', sep = '\t', index = False)
-				print(covariant_score)
-				print('\n')
-				graph = input('Display a graph of trends over time for the top covariants from the functional_ranking for '+who_label+' in '+region+'? [y/n]: ')
-				if (graph == 'y'):
-					vp.plot_covariants(graph_variants, covariant_score['Variant'].tolist(), region, who = who_label)
-			else:
-				sys.exit("WHO Label is invalid and not found. Please try again and input a valid WHO Label.")
-		else:
-			print('WARNING! This computation may take some time! Reconsider if necessary. Control + C to abort.')
-			analysis_variants = analysis_variants[analysis_variants[analysis_variants[analysis_variants.columns[pd.Series(analysis_variants.columns).str.startswith('Variant Count')]].iloc[:,0].name] > 10]
-			covariants_score = va.functional_ranking(analysis_variants, sfocs)
-			covariants_score.to_csv('emerging_covariants_functional_ranking_'+region+'.tsv', sep = '\t', index = False)
-			print(covariants_score)
-			print('\n')
-			graph = input('Display a graph of trends over time for the top covariants from the functional ranking in '+region+'? [y/n]: ')
-			if (graph == 'y'):
-				vp.plot_covariants(graph_variants, covariants_score['Variant'].tolist(), region, inputted = True)
-	
-	elif (args.analysis == 'composite_ranking'):
-		sfocs = pd.read_excel(variants_xlsx, 'SFoCs')
-		sfocs = sfocs[(sfocs['Protein'] == 'Spike')]
-		if (args.covariant):
-			covariants_file = open_covariants_file(args.covariant)
-			covariants = list(covariants_file['Variant'])
-			covariant_score = va.composite_ranking(analysis_variants, sfocs, interval, covariants = covariants)
-			covariant_score = pd.merge(covariants_file, covariant_score, on = "Variant")
-			covariant_score = covariant_score.drop_duplicates(subset = ['Variant']).sort_values(by = 'Composite Score', ascending = False).reset_index(drop = True)
-			covariant_score.to_csv('inputted_covariants_composite_ranking_'+region+'.tsv', sep = '\t', index = False)
-			print(covariant_score)
-			print('\n')
-			graph = input('Display a graph of trends over time for the top inputted covariants from the composite_ranking in '+region+'? [y/n]: ')
-			if (graph == 'y'):
-				if ('Name' in covariants_file.columns):
-					names = list(covariants_file['Name'])
-					name_dict = dict(zip(covariants, names))
-					vp.plot_covariants(graph_variants, covariants, region, name = name_dict, inputted = True)
-				else:
-					vp.plot_covariants(graph_variants, covariants, region, inputted = True)
-		elif (args.pango):
-			pango_lineage = args.pango
-			if (analysis_variants['PANGO Lineage'].isin([pango_lineage]).any()):
-				covariant_score = va.composite_ranking(analysis_variants, sfocs, interval, lineage = [pango_lineage])
-				covariant_score.to_csv(pango_lineage+'_composite_ranking_'+region+'.tsv', sep = '\t', index = False)
-				print(covariant_score)
-				print('\n')
-				graph = input('Display a graph of trends over time for the top covariants from the composite_ranking for '+pango_lineage+' in '+region+'? [y/n]: ')
-				if (graph == 'y'):
-					vp.plot_covariants(graph_variants, covariant_score['Variant'].tolist(), region, pango = pango_lineage)
-			else:
-				sys.exit("PANGO Lineage is invalid and not found. Please try again an input a valid PANGO Lineage.")
-		elif (args.who):
-			who_label = args.who
-			if (analysis_variants['WHO Label'].isin([who_label]).any()):
-				covariant_score = va.composite_ranking(analysis_variants, sfocs, interval, who = [who_label])
-				covariant_score.to_csv(who_label+'_composite_ranking_'+region+'.tsv', sep = '\t', index = False)
-				print(covariant_score)
-				print('\n')
-				graph = input('Display a graph of trends over time for the top covariants from the composite_ranking for '+who_label+' in '+region+'? [y/n]: ')
-				if (graph == 'y'):
-					vp.plot_covariants(graph_variants, covariant_score['Variant'].tolist(), region, who = who_label)
-			else:
-				sys.exit("WHO Label is invalid and not found. Please try again and input a valid WHO Label.")
-		else:
-			covariants_score = va.composite_ranking(analysis_variants, sfocs, interval)
-			covariants_score.to_csv('emerging_covariants_composite_ranking_'+region+'.tsv', sep = '\t', index = False)
-			print(covariants_score)
+	if (grids):
+		mutation_file = open_optional_file(args.mutation) if (args.mutation) else None
+		ranking, output = run_sweep_ranking(args.analysis, data, interval, grids, args.pango, args.who, args.domain, mutation_file, rankings)
+		write_ranking(ranking, output)
+		print(ranking)
+
+	elif (args.rolling):
+		mutation_file = open_optional_file(args.mutation) if (args.mutation) else None
+		ranking, output = run_rolling_ranking(args.analysis, data, *rolling_window(args), args.pango, args.who, args.domain, mutation_file, rankings)
+		write_ranking(ranking, output)
+		print(ranking)
+
+	elif (args.by_location):
+		mutation_file = open_optional_file(args.mutation) if (args.mutation) else None
+		ranking, output = run_location_ranking(args.analysis, data, interval, args.domain, mutation_file, rankings)
+		write_ranking(ranking, output)
+		print(ranking)
+
+	elif (args.analysis in ranking_options):
+		covariants_file = open_covariants_file(args.covariant) if (args.covariant) else None
+		mutation_file = open_optional_file(args.mutation) if (args.mutation) else None
+		state_dir = os.path.join(args.cache_dir, 'state') if (args.incremental) else None
+		memo = score_store(args.analysis, args.cache_dir) if (args.score_store) else None
+		ranking, output = run_ranking(args.analysis, data, interval, args.pango, args.who, covariants_file, args.domain, mutation_file, state_dir, memo, rankings)
+		write_ranking(ranking, output)
+		print(ranking)
+		if (args.analysis != 'mutation_ranking'):
 			print('\n')
-			graph = input('Display a graph of trends over time for the top covariants from the composite ranking in '+region+'? [y/n]: ')
-			if (graph == 'y'):
-				vp.plot_covariants(graph_variants, covariants_score['Variant'].tolist(), region, inputted = True)
-
-	elif (args.analysis == 'mutation_ranking'):
-		domain = args.domain
-		if (args.mutation):
-			mutation_file = open_optional_file(args.mutation)
-			mutation_ranking = va.mutation_ranking(analysis_subs, interval, domain, mutation_file)
-			mutation_ranking.to_csv('inputted_mutations_ranking_'+region+'.tsv', sep = '\t', index = False)
-			print(mutation_ranking)
-		else:
-			mutation_ranking = va.mutation_ranking(analysis_subs, interval, domain)
-			mutation_ranking.to_csv(domain+'_mutations_ranking_'+region+'.tsv', sep = '\t', index = False)
-			print(mutation_ranking)
-		graph = input('Display a graph of trends over time for the top point mutations ranked within '+domain+' in '+region+'? [y/n]: ')
-		if (graph == 'y'):
-			vp.plot_mutations(graph_subs, region, domain, mutation_ranking['Variant'].tolist())
+		prompt, figure = ranking_figure(args.analysis, data, ranking, args.pango, args.who, covariants_file, args.domain, figure_window(args))
+		if (graph_types is not None or input(prompt) == 'y'):
+			draw_figure(figure, output[:-len('.tsv')], graph_types, args.graph_format)
 
+	elif (args.analysis == 'similar'):
+		covariants_file = open_covariants_file(args.covariant)
+		similar = vsi.similar_covariants(analysis_variants, covariants_file, args.top or vsi.default_top, args.metric or 'jaccard', args.minhash)
+		output = 'similar_covariants_'+region+'.tsv'
+		write_ranking(similar, output)
+		print(similar)
 
 	elif (args.analysis == 'graph'):
 		if (args.lineage_file):
 			pango_lineages = open_optional_file(args.lineage_file)
+			if (tree):
+				pango_lineages = [tree.name(l) for l in pango_lineages]
 			if ((not args.country) and (len(pango_lineages) == 1)):
-				lineages = pd.read_excel(variants_xlsx, 'World - Lineages')
+				lineages = variants_report.sheet('World - Lineages', lineage_columns)
 				lineages = lineages[(lineages['Country'] != 'All') & (lineages['Country'] != 'Unknown')]
-				vp.plot_single_lineage(lineages, pango_lineages[0])
+				if (tree):
+					lineages = vl.rollup_frame(lineages, tree)
+				figure = ('plot_single_lineage', (lineages, pango_lineages[0]), {})
+				stem = 'graph_'+pango_lineages[0]+'_by_country'
 			else:
-				vp.plot_lineages(lineages, pango_lineages, region)
+				figure = ('plot_lineages', (lineages, pango_lineages, region), {})
+				stem = 'graph_lineages_'+region
 		elif (args.lineage):
-			pango_lineage = args.lineage
+			pango_lineage = tree.name(args.lineage) if (tree) else args.lineage
 			if (not args.country_file):
-				lineages = pd.read_excel(variants_xlsx, 'World - Lineages')
+				lineages = variants_report.sheet('World - Lineages', lineage_columns)
 				lineages = lineages[(lineages['Country'] != 'All') & (lineages['Country'] != 'Unknown')]
-				vp.plot_single_lineage(lineages, pango_lineage)
-			else:
-				vp.plot_single_lineage(lineages, pango_lineage)
+				if (tree):
+					lineages = vl.rollup_frame(lineages, tree)
+			figure = ('plot_single_lineage', (lineages, pango_lineage), {})
+			stem = 'graph_'+pango_lineage+'_by_country'
 		elif (args.covariant):
 			covariants_file = open_covariants_file(args.covariant)
 			covariants = list(covariants_file['Variant'])
@@ -445,42 +1175,50 @@ if __name__ == '__main__':
 				if ('Name' in covariants_file.columns):
 					names = list(covariants_file['Name'])
 					name_dict = dict(zip(covariants, names))
-					vp.plot_covariants(graph_variants, covariants, region, name = name_dict, inputted = True)
+					figure = ('plot_covariants', (graph_variants, covariants, region), {'name': name_dict, 'inputted': True})
 				else:
-					vp.plot_covariants(graph_variants, covariants, region, inputted = True)
+					figure = ('plot_covariants', (graph_variants, covariants, region), {'inputted': True})
+				stem = 'graph_inputted_covariants_'+region
 			else:
 				sys.exit("All covariants are invalid and not found. Please try again and input valid covariants.")
 		elif (args.pango):
 			pango_lineage = args.pango
 			if (analysis_variants['PANGO Lineage'].isin([pango_lineage]).any()):
-				covariant_score = va.sequence_ranking(analysis_variants, interval, lineage = [pango_lineage])
-				vp.plot_covariants(graph_variants, covariant_score['Variant'].tolist(), region, pango = pango_lineage, inputted = False)
+				covariant_score = rankings.sequence_ranking(analysis_variants, interval, lineage = [pango_lineage])
+				figure = ('plot_covariants', (graph_variants, covariant_score['Variant'].tolist(), region), {'pango': pango_lineage, 'inputted': False})
+				stem = 'graph_'+pango_lineage+'_covariants_'+region
 			else:
 				sys.exit("PANGO Lineage is invalid and not found. Please try again and input a valid PANGO Lineage.")
 		elif (args.who):
 			who_label = args.who
 			if (analysis_variants['WHO Label'].isin([who_label]).any()):
-				covariant_score = va.sequence_ranking(analysis_variants, interval, who = [who_label])
-				vp.plot_covariants(graph_variants, covariant_score['Variant'].tolist(), region, who = who_label, inputted = False)
+				covariant_score = rankings.sequence_ranking(analysis_variants, interval, who = [who_label])
+				figure = ('plot_covariants', (graph_variants, covariant_score['Variant'].tolist(), region), {'who': who_label, 'inputted': False})
+				stem = 'graph_'+who_label+'_covariants_'+region
 			else:
 				sys.exit("WHO Label is invalid and not found. Please try again and input a valid WHO Label.")
 		elif (args.mutation):
 			mutations = open_optional_file(args.mutation)
 			if (graph_subs['Variant'].isin(mutations).any()):
-				vp.plot_mutations(graph_subs, region, domain = "User Inputted", mutations = mutations)
+				figure = ('plot_mutations', (graph_subs, region), {'domain': "User Inputted", 'mutations': mutations})
+				stem = 'graph_inputted_mutations_'+region
 			else:
 				sys.exit("Point mutations are invalid and not found. Please try again and input a valid list of SARS-CoV-2 Spike mutations.")
 		elif (args.domain):
 			domain = args.domain
-			vp.plot_mutations(graph_subs, region, domain)
+			figure = ('plot_mutations', (graph_subs, region, domain), {})
+			stem = 'graph_'+domain+'_mutations_'+region
 		else:
-			recent_prevalence = analysis_variants[analysis_variants.columns[pd.Series(analysis_variants.columns).str.startswith('Prevalence')]].iloc[:,:6]
+			recent_prevalence = analysis_variants[vd.metric_columns(analysis_variants, 'Prevalence', figure_window(args) or vp.default_window)]
 			recent_prevalence = recent_prevalence.fillna(0)
 			lineage_prevalence_df = pd.concat([pd.DataFrame({'Lineage': analysis_variants['PANGO Lineage']}), recent_prevalence], axis = 1)
 			lineage_prevalence_df = lineage_prevalence_df.reindex(sorted(lineage_prevalence_df.columns), axis = 1).drop_duplicates(subset = ['Lineage'])
 			pango_lineages = lineage_prevalence_df['Lineage']
-			vp.plot_lineages(lineages, pango_lineages, region)
-
-
-
+			figure = ('plot_lineages', (lineages, pango_lineages, region), {})
+			stem = 'graph_lineages_'+region
+		if (figure_window(args) is not None):
+			figure = (figure[0], figure[1], dict(figure[2], window = figure_window(args)))
+		draw_figure(figure, stem, graph_types, args.graph_format)
 
+	if (cache and cache.hits + cache.misses):
+		print(cache.summary())
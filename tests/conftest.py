@@ -0,0 +1,14 @@
+import os
+import sys
+import pytest
+
+# The modules live at the top of the repository rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import VariantSynthetic as vsy
+
+
+# Small synthetic report shared by the tests.  The same seed always gives the same report, so failures reproduce.
+@pytest.fixture(scope = 'session')
+def report():
+	return(vsy.synthetic_report(seed = 0))
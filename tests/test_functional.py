@@ -0,0 +1,60 @@
+import re
+import numpy as np
+import pandas as pd
+import VariantAnalysis as va
+import VariantEncoding as ve
+
+
+# Weight of every residue recomputed row by row: every SFoC on the protein adds its points to each residue of its range
+def plain_weights(sfoc_df, protein = 'Spike'):
+	sfoc_df = sfoc_df[sfoc_df['Protein'] == protein]
+	points = sfoc_df['mAb escape'].fillna('').apply(lambda text: sum(c in text for c in ['class 1', 'class 2', 'class 3', 'class 4']))
+	points += sfoc_df['serum Ab escape'].fillna('').apply(lambda text: sum(s in text for s in ['convalescent serum', 'Moderna vaccine serum']))
+	points += sfoc_df['Increased ACE2 binding'].notna().astype(int) + sfoc_df['Region of interest'].notna().astype(int)
+	residues = pd.DataFrame({'Residue': [list(range(int(s), int(e) + 1)) for s, e in zip(sfoc_df['Start'], sfoc_df['End'])], 'Points': points.to_numpy()})
+	residues = residues.explode('Residue')
+	weights = residues.groupby('Residue')['Points'].sum()
+	covering = residues.groupby('Residue').size()
+	weights = weights.reindex(range(max(va.protein_lengths.get(protein, 0), int(sfoc_df['End'].max())) + 1), fill_value = 0).astype(np.int64)
+	weights[614] += covering.get(614, 0)
+	return(weights.to_numpy())
+
+# Functional Impact Score of a covariant string recomputed mutation by mutation, skipping a deletion that directly
+# follows another deletion
+def plain_score(covariant, weights):
+	score = 0
+	previous = None
+	for mutation in ve.canonical_covariant(covariant).split(','):
+		position = int(re.search(r'[0-9]+', mutation).group(0))
+		deletion = mutation.endswith('-')
+		if (not (deletion and previous == (position - 1, True)) and position < len(weights)):
+			score += weights[position]
+		previous = (position, deletion)
+	return(score)
+
+
+def test_sfoc_weights(report):
+	np.testing.assert_array_equal(va.sfoc_weights(report['SFoCs']), plain_weights(report['SFoCs']))
+
+def test_sfoc_weights_other_protein(report):
+	np.testing.assert_array_equal(va.sfoc_weights(report['SFoCs'], 'N'), plain_weights(report['SFoCs'], 'N'))
+
+def test_functional_scores(report):
+	store = ve.CovariantStore()
+	covariants = list(report['World - Variants']['Variant'].unique()) + ['T19I,L24-,P25-,P26-', 'L24-,A26-,D614G']
+	weights = va.sfoc_weights(report['SFoCs'])
+	scores = va.functional_scores(store.encode(covariants), weights, store)
+	np.testing.assert_array_equal(scores, [plain_score(c, weights) for c in covariants])
+
+def test_store_round_trip(report):
+	store = ve.CovariantStore()
+	covariants = report['World - Variants']['Variant']
+	ids = store.encode(covariants)
+	assert len(store) == covariants.nunique()
+	owner, mutation_ids, positions, residues = store.gather(ids)
+	gathered = pd.DataFrame({'owner': owner, 'mutation': np.array(store.mutations, dtype = object)[mutation_ids], 'position': positions})
+	for row, covariant in enumerate(covariants.head(200)):
+		mutations = gathered[gathered['owner'] == row]
+		assert list(mutations['mutation']) == covariant.split(',')
+		assert list(mutations['position']) == [int(re.search(r'[0-9]+', m).group(0)) for m in covariant.split(',')]
+	assert list(store.canonical(covariants)) == list(covariants)
@@ -0,0 +1,52 @@
+import os
+import numpy as np
+import pandas as pd
+import VariantData as vd
+import VariantHistory as vh
+import VariantSynthetic as vsy
+
+sheet = 'World - Variants'
+
+
+# Three weekly reports whose months overlap and whose values differ in the months they share, each leaving out some of
+# the rows of the others, oldest first
+def weekly_reports():
+	reports = []
+	for week, last_month in enumerate(['2023-07', '2023-08', '2023-09']):
+		sheet_df = vsy.synthetic_report(seed = 0, last_month = last_month)[sheet]
+		reports.append(sheet_df.sample(frac = 0.8, random_state = week).reset_index(drop = True))
+	return(reports)
+
+# The reports merged the plain way: for every month, the rows of every report that holds the month stacked newest
+# report first, keeping the first of every row
+def plain_history(reports):
+	schema = vd.report_schema(reports[0].columns)
+	months = sorted(set(m for sheet_df in reports for m in vd.report_schema(sheet_df.columns).month_labels()), reverse = True)
+	blocks = []
+	for month in months:
+		held = [sheet_df.set_index(schema.labels) for sheet_df in reversed(reports) if (month in vd.report_schema(sheet_df.columns).month_labels())]
+		block = pd.concat([sheet_df[[metric+' - '+month for metric in vd.metrics]] for sheet_df in held])
+		blocks.append(block[~block.index.duplicated(keep = 'first')])
+	return(pd.concat(blocks, axis = 1))
+
+
+def test_history_frame(tmp_path):
+	reports = weekly_reports()
+	for date, sheet_df in zip(['2023-07-28', '2023-08-28', '2023-09-28'], reports):
+		vh.write_sheet(sheet_df, os.path.join(tmp_path, date))
+	stored = [vh.StoredSheet(os.path.join(tmp_path, date)) for date in ['2023-09-28', '2023-08-28', '2023-07-28']]
+	merged = vh.history_frame(stored).set_index(vd.report_schema(reports[0].columns).labels)
+	expected = plain_history(reports)
+	assert len(merged) == len(expected) and not merged.index.duplicated().any()
+	pd.testing.assert_frame_equal(merged.sort_index(), expected.reindex(columns = merged.columns).sort_index(), check_dtype = False, check_index_type = False)
+
+def test_history_frame_columns(tmp_path):
+	reports = weekly_reports()
+	for date, sheet_df in zip(['2023-07-28', '2023-08-28', '2023-09-28'], reports):
+		vh.write_sheet(sheet_df, os.path.join(tmp_path, date))
+	stored = [vh.StoredSheet(os.path.join(tmp_path, date)) for date in ['2023-09-28', '2023-08-28', '2023-07-28']]
+	columns = ['Country', 'Variant', 'Prevalence']
+	merged = vh.history_frame(stored, columns)
+	whole = vh.history_frame(stored)
+	pd.testing.assert_frame_equal(merged, vd.select_columns(whole, columns))
+	assert np.isfinite(merged.iloc[:, 2:].to_numpy()).any()
@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+import VariantData as vd
+import VariantLineage as vl
+
+# Aliases that hang the synthetic BA, BQ and XBB lineages under B.1.1, which the synthetic report also lists
+aliases = {'BA': 'B.1.1.529', 'BQ': 'B.1.1.529.5.3.1.1.1', 'XBB': 'B.1.1.529.2.10.1'}
+
+
+# A lineages sheet rolled up the lineage tree the plain way: every row is repeated for each of its ancestors, and the
+# Variant Counts summed by location and ancestor.  The WHO Label of an ancestor is the one all its rows share, in any
+# location.
+def plain_rollup(frame, tree):
+	schema = vd.report_schema(frame.columns)
+	counts = list(schema.metric_columns('Variant Count'))
+	isolates = list(schema.metric_columns('Isolates Count'))
+	rows = frame.assign(Node = [[tree.names[tree.position['.'.join(parts[:k])]] for k in range(1, len(parts) + 1)] for parts in (vl.expand_lineage(l, aliases).split('.') for l in frame['PANGO Lineage'])])
+	rows = rows.explode('Node')
+	summed = rows.groupby(['Country', 'Node'])[counts].sum().replace(0, np.nan)
+	who = rows.groupby('Node')['WHO Label'].agg(lambda labels: labels.iloc[0] if (labels.nunique(dropna = False) == 1) else np.nan)
+	location_isolates = frame.groupby('Country')[isolates].max().reindex(summed.index.get_level_values('Country')).to_numpy()
+	prevalence = summed.to_numpy() / location_isolates
+	growth = np.full(prevalence.shape, np.nan)
+	growth[:, :-1] = summed.to_numpy()[:, :-1] / summed.to_numpy()[:, 1:]
+	columns = {'WHO Label': who.reindex(summed.index.get_level_values('Node')).to_numpy()}
+	for month, label in enumerate(schema.month_labels()):
+		columns['Variant Count - '+label] = summed.iloc[:, month]
+		columns['Isolates Count - '+label] = location_isolates[:, month]
+		columns['Prevalence - '+label] = prevalence[:, month]
+		columns['Growth Rate - '+label] = growth[:, month]
+	return(pd.DataFrame(columns, index = summed.index))
+
+
+def test_rollup_frame(report):
+	lineages = report['World - Lineages']
+	tree = vl.LineageTree(lineages['PANGO Lineage'], aliases)
+	assert tree.name('BQ.1') in tree.subtree('B.1.1', lineages['PANGO Lineage'])
+	rolled = vl.rollup_frame(lineages, tree).set_index(['Country', 'PANGO Lineage'])
+	expected = plain_rollup(lineages, tree).rename_axis(['Country', 'PANGO Lineage'])
+	pd.testing.assert_frame_equal(rolled.sort_index().astype({'WHO Label': object}), expected.sort_index()[rolled.columns].astype({'WHO Label': object}), check_dtype = False, check_index_type = False)
@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+import VariantData as vd
+import VariantEncoding as ve
+import VariantParallel as vpl
+
+
+# The sheets shared in the tests: a sheet as read, the same sheet compacted, and one with the Variant column as the
+# covariant categorical main.encode_variants() makes
+def sample_sheets(report):
+	variants = report['World - Variants']
+	encoded = variants.assign(Variant = ve.covariant_store.categorical(variants['Variant']))
+	return({'World - Variants': variants, 'Compact': vd.compact_frame(variants), 'Encoded': encoded})
+
+# The total Variant Count of every covariant in a sheet, the work the pool is given in test_map_shared()
+def covariant_total(covariant, sheets):
+	sheet_df = sheets['Encoded']
+	counts = sheet_df[list(vd.report_schema(sheet_df.columns).metric_columns('Variant Count'))]
+	return(float(np.nansum(counts[(sheet_df['Variant'] == covariant).to_numpy()].to_numpy())))
+
+
+def test_shared_round_trip(report):
+	sheets = sample_sheets(report)
+	shared = vpl.SharedSheets(sheets)
+	try:
+		attached, segments = vpl.attach(shared.layout())
+		for name, frame in sheets.items():
+			pd.testing.assert_frame_equal(attached[name], frame)
+		assert not attached['Compact'].iloc[:, -1].to_numpy().flags.writeable
+		del attached
+		for segment in segments:
+			segment.close()
+	finally:
+		shared.close()
+
+def test_map_shared(report):
+	sheets = sample_sheets(report)
+	covariants = list(report['World - Variants']['Variant'].unique()[:20])
+	totals = vpl.map_shared(covariant_total, covariants, sheets, 2)
+	assert totals == [covariant_total(covariant, sheets) for covariant in covariants]
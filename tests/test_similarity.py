@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import pytest
+import VariantEncoding as ve
+import VariantSimilarity as vsi
+
+
+# Nearest covariants to a query found the plain way: the Jaccard similarity or Hamming distance of the query's set of
+# mutations to every covariant's, sorted best first with ties broken by covariant
+def plain_nearest(query, covariants, top, metric):
+	query = set(query.split(','))
+	scores = pd.DataFrame({'Variant': covariants})
+	shared = scores['Variant'].apply(lambda c: len(query & set(c.split(','))))
+	union = scores['Variant'].apply(lambda c: len(query | set(c.split(','))))
+	if (metric == 'jaccard'):
+		scores['Score'] = shared / union.clip(lower = 1)
+		return(scores.sort_values(by = ['Score', 'Variant'], ascending = [False, True]).head(top))
+	scores['Score'] = union - shared
+	return(scores.sort_values(by = ['Score', 'Variant'], ascending = [True, True]).head(top))
+
+# Indexed covariants and queries: some of the indexed covariants, and one with a mutation none of them has
+@pytest.fixture(scope = 'module')
+def indexed(report):
+	store = ve.CovariantStore()
+	covariants = list(report['World - Variants']['Variant'].unique())
+	index_ids = store.encode(covariants)
+	queries = covariants[::25] + [covariants[0]+',Y9999F']
+	return(store, index_ids, queries)
+
+
+@pytest.mark.parametrize('metric', vsi.metrics)
+def test_bitset_query(indexed, metric):
+	store, index_ids, queries = indexed
+	index = vsi.SimilarityIndex(index_ids, store)
+	for query in queries:
+		positions, shared, score = index.query(store.add(query), 10, metric)
+		expected = plain_nearest(query, [store.covariants[i] for i in index.ids], 10, metric)
+		assert [store.covariants[i] for i in index.ids[positions]] == list(expected['Variant'])
+		np.testing.assert_allclose(score, expected['Score'].to_numpy())
+
+# MinHash signatures only pick the candidates, which are then scored exactly, so every score returned is exact and none
+# beats the true nearest covariants
+@pytest.mark.parametrize('metric', vsi.metrics)
+def test_minhash_query(indexed, metric):
+	store, index_ids, queries = indexed
+	index = vsi.SimilarityIndex(index_ids, store, minhash = 64)
+	for query in queries:
+		positions, shared, score = index.query(store.add(query), 10, metric)
+		found = [store.covariants[i] for i in index.ids[positions]]
+		exact = plain_nearest(query, found, 10, metric)
+		expected = plain_nearest(query, [store.covariants[i] for i in index.ids], 10, metric)
+		np.testing.assert_allclose(score, exact.set_index('Variant').loc[found, 'Score'].to_numpy())
+		assert list(exact['Variant']) == found
+		if (metric == 'jaccard'):
+			assert np.all(score <= expected['Score'].to_numpy()[:len(score)] + 1e-12)
+		else:
+			assert np.all(score >= expected['Score'].to_numpy()[:len(score)])
+		if (store.add(query) in index.ids):
+			assert found[0] == query